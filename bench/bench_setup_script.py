@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# Benchmarks how long setup-script.py takes to start and to render manifests without a cluster. See the README in this
+# directory for how to run it and read the results.
+import argparse
+from datetime import datetime
+import json
+from pathlib import Path
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Tuple
+
+BENCH_DIR = Path(__file__).resolve().parent
+SCRIPT = BENCH_DIR.parent / 'setup-script.py'
+RESULTS_FILE = BENCH_DIR / 'results.jsonl'
+CASES = ['import', 'dry_run', 'dry_run_unchanged', 'library']
+# The packages whose import time is recorded.
+PACKAGES = ['kubernetes', 'pybars', 'yaml']
+LIBRARY_CODE = '''
+import pathlib, runpy, sys, time
+start = time.perf_counter()
+render = runpy.run_path(sys.argv[1])["render"]
+render([{"namespace": f"site{i}", "title": f"Site {i}", "hostname": f"site{i}.org"} for i in range(int(sys.argv[2]))],
+       pathlib.Path(sys.argv[3]))
+print(time.perf_counter() - start)
+'''
+
+
+def write_sites(path: Path, num_sites: int) -> None:
+    with open(path, 'wt', encoding='utf-8') as f:
+        f.write('sites:\n')
+        for i in range(num_sites):
+            f.write(f'  - namespace: site{i}\n    title: Site {i}\n    hostname: site{i}.org\n')
+
+
+def timed_run(cmd: List[str]) -> float:
+    """Runs cmd and returns how many seconds it took."""
+    start = time.perf_counter()
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def import_times(script: Path) -> Dict[str, float]:
+    """Returns the cumulative time, in ms, `python -X importtime` reports for importing each of PACKAGES when the script
+    is loaded, or 0 for the ones it doesn't import.
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import runpy; runpy.run_path({str(script)!r})'],
+                          check=True, capture_output=True, text=True)
+    times = {package: 0.0 for package in PACKAGES}
+    for line in proc.stderr.splitlines():
+        # Lines look like "import time:       346 |     515119 | kubernetes" with nested imports indented.
+        parts = line.split('|')
+        if len(parts) == 3 and parts[2].strip() in times and not parts[2].startswith('  '):
+            times[parts[2].strip()] = round(int(parts[1]) / 1000, 1)
+    return times
+
+
+def run_case(case: str, script: Path, num_sites: int, work_dir: Path) -> float:
+    """Runs case and returns how many seconds it took."""
+    sites_file = work_dir / 'sites.yaml'
+    out = work_dir / 'out'
+    if case == 'import':
+        return timed_run([sys.executable, '-c', f'import runpy; runpy.run_path({str(script)!r})'])
+    if case == 'dry_run':
+        return timed_run([sys.executable, str(script), '--sites', str(sites_file), '--out', str(out), '--dry_run'])
+    if case == 'dry_run_unchanged':
+        # Render once so the second run finds nothing to render.
+        timed_run([sys.executable, str(script), '--sites', str(sites_file), '--out', str(out), '--dry_run'])
+        return timed_run([sys.executable, str(script), '--sites', str(sites_file), '--out', str(out), '--dry_run'])
+    if case == 'library':
+        proc = subprocess.run([sys.executable, '-c', LIBRARY_CODE, str(script), str(num_sites), str(out)],
+                              check=True, capture_output=True, text=True)
+        return float(proc.stdout)
+    raise ValueError(f'Unknown case {case}')
+
+
+def git_commit(script: Path) -> str:
+    """Returns the commit of the script, with a + appended if the script has uncommitted changes."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=script.parent, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        changed = subprocess.run(['git', 'diff', '--quiet', 'HEAD', '--', script.name], cwd=script.parent).returncode
+        return commit + ('+' if changed else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def supports(case: str, script: Path) -> bool:
+    """Returns False for cases the version of the script being benchmarked can't run."""
+    source = script.read_text()
+    if case.startswith('dry_run'):
+        return '--sites' in source
+    if case == 'library':
+        return 'def render(' in source
+    return True
+
+
+def run_benchmarks(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    results = []
+    commit = git_commit(args.script)
+    for case in args.cases:
+        if not supports(case, args.script):
+            print(f'{commit:>9} {case:<18} not supported by this version', flush=True)
+            continue
+        times = []
+        for _ in range(args.repeat):
+            with tempfile.TemporaryDirectory() as tmp:
+                write_sites(Path(tmp) / 'sites.yaml', args.sites)
+                times.append(run_case(case, args.script, args.sites, Path(tmp)))
+        result = {'date': datetime.now().isoformat(timespec='seconds'), 'commit': commit, 'host': platform.node(),
+                  'python': platform.python_version(), 'case': case, 'sites': args.sites,
+                  'seconds': round(statistics.median(times), 3), 'min_seconds': round(min(times), 3)}
+        if case == 'import':
+            result['import_ms'] = import_times(args.script)
+        results.append(result)
+        print_results([result])
+    return results
+
+
+def print_results(results: List[Dict[str, Any]]) -> None:
+    for r in results:
+        imports = ', '.join(f'{k} {v:.0f} ms' for k, v in r.get('import_ms', {}).items())
+        print(f"{r['commit']:>9} {r['case']:<18} {r['sites']:>4} sites {r['seconds']:>7.3f} s (min "
+              f"{r['min_seconds']:.3f} s)  {imports}", flush=True)
+
+
+def compare(results_file: Path) -> None:
+    """Prints, for each case and number of sites, the latest result in results_file and its change from the previous
+    one.
+    """
+    by_key: Dict[Tuple[str, int], List[Dict[str, Any]]] = {}
+    with open(results_file) as f:
+        for line in f:
+            r = json.loads(line)
+            by_key.setdefault((r['case'], r['sites']), []).append(r)
+    for (case, sites), runs in sorted(by_key.items()):
+        latest = runs[-1]
+        print_results([latest])
+        if len(runs) > 1:
+            prev = runs[-2]
+            print(f"{'':>9} vs {prev['commit']}: seconds "
+                  f"{100 * (latest['seconds'] - prev['seconds']) / prev['seconds']:+.0f}%")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmarks the start up and rendering of setup-script.py')
+    parser.add_argument('--script', type=Path, default=SCRIPT,
+                        help='The setup-script.py to benchmark, e.g. one in a git worktree of an older commit. Default '
+                        'is the one in this repository.')
+    parser.add_argument('--sites', type=int, default=20, help='How many sites to render. Default is 20.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='How many times to run each case. The median time is reported. Default is 5.')
+    parser.add_argument('--cases', type=lambda s: s.split(','), default=CASES,
+                        help=f'Comma separated cases to run. Default is all of them: {",".join(CASES)}.')
+    parser.add_argument('--results', type=Path, default=RESULTS_FILE,
+                        help='The file to append results to. Default is results.jsonl next to this script.')
+    parser.add_argument('--compare', action='store_true', default=False,
+                        help="Don't run anything, just compare the latest results with the ones before them.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.compare:
+        compare(args.results)
+        return
+    args.script = args.script.resolve()
+    results = run_benchmarks(args)
+    with open(args.results, 'at') as f:
+        for result in results:
+            f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
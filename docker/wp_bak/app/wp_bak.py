@@ -4,17 +4,40 @@
 # docker run -v `pwd`/src:/src -v `pwd`/dst:/dst -t mvpstudio/wordpress-backup:v0001
 
 import argparse
-from datetime import datetime, timedelta
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import cProfile
+from datetime import datetime, timedelta, timezone
+import grp
+import gzip
+import hashlib
+import hmac
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
 import logging
+import multiprocessing
 import os
 from pathlib import Path
+import pstats
+import pwd
 import re
 import shutil
+import signal
+import sqlite3
+import stat
 import subprocess
 import sys
 import tarfile
+import threading
 import time
-from typing import List
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
+from typing import (Any, BinaryIO, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Pattern, Set, Tuple,
+                    Union)
+import zlib
 
 #############################
 # CONSTANTS
@@ -25,10 +48,213 @@ DST_DIR=Path('/dst')
 SHORT_DIR=DST_DIR.joinpath('shorts')
 LONG_DIR=DST_DIR.joinpath('longs')
 
+# Name of the directory, inside an incremental snapshot, holding the copy of the SRC_DIR tree.
+FILES_DIR_NAME = 'files'
+# Name of the manifest file written into each incremental snapshot. It is written last so a snapshot without it is
+# incomplete and can't be used as the base for the next snapshot.
+MANIFEST_NAME = 'files.manifest.jsonl'
+# Size of the buffer used when copying file contents.
+COPY_BUF_SIZE = 1024 * 1024
+
+# Where the deduplicating chunk store keeps chunks when running with --repository. Each backup directory then holds
+# just a SNAPSHOT_INDEX_NAME file listing the chunks that make up each file and the database dump.
+CHUNK_DIR = DST_DIR.joinpath('chunks')
+SNAPSHOT_INDEX_NAME = 'snapshot.jsonl.gz'
+# Chunk boundaries are chosen by content so that inserting data near the start of a file (e.g. a new row in the dump)
+# doesn't shift and change every chunk after it. Candidate boundaries are the ends of lines and the `),(` separators
+# between rows of mysqldump's extended INSERT statements; we cut at a candidate if the hash of the preceding
+# CHUNK_WINDOW bytes has its low bits clear. Data without any candidates is cut every CHUNK_MAX bytes.
+CHUNK_ANCHOR_RE = re.compile(rb'\n|\),\(')
+CHUNK_WINDOW = 32
+CHUNK_MASK = 0xfff
+CHUNK_MIN = 256 * 1024
+CHUNK_MAX = 4 * 1024 * 1024
+
+# The commands used to compress the database dump, keyed by the --db_compression codec name, and the names of the
+# resulting files. The level, if given, is passed as `-<level>`, along with the minimum and maximum allowed levels.
+COMPRESSORS = {
+    'gzip': {'command': ['gzip', '-c'], 'decompress': ['gzip', '-dc'], 'extension': '.gz', 'levels': (1, 9),
+             'default_level': 6},
+    'zstd': {'command': ['zstd', '-c', '-q'], 'decompress': ['zstd', '-dc', '-q'], 'extension': '.zst',
+             'levels': (1, 19), 'default_level': 3},
+}
+# The file archive is compressed in blocks of this size, in parallel, when using gzip. Each block becomes a separate
+# gzip member; a file of concatenated members is still a normal .gz file that any tool can read.
+GZIP_BLOCK_SIZE = 1024 * 1024
+
+# With --store_media_uncompressed files that are already compressed are stored in this uncompressed tarball next to
+# files.tar.gz rather than being compressed again, which costs a lot of CPU for next to no gain. Files are considered
+# already compressed if they have one of INCOMPRESSIBLE_EXTENSIONS or, for files of at least ENTROPY_SAMPLE_SIZE, if the
+# first ENTROPY_SAMPLE_SIZE bytes don't compress to less than INCOMPRESSIBLE_RATIO of their size.
+STORED_TAR_NAME = 'files-stored.tar'
+INCOMPRESSIBLE_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.avif', '.heic', '.mp4', '.m4v', '.mov', '.webm', '.mkv', '.mp3',
+    '.m4a', '.ogg', '.opus', '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar', '.woff', '.woff2'}
+ENTROPY_SAMPLE_SIZE = 64 * 1024
+INCOMPRESSIBLE_RATIO = 0.95
+
+# Each tar backup has a catalog, an SQLite database, listing every file in the backup along with where its data starts
+# in the uncompressed tarball and where each independently compressed gzip block starts. That lets us list backups and
+# restore single files without decompressing the whole tarball. See the `list` and `restore` commands.
+CATALOG_NAME = 'catalog.sqlite'
+CATALOG_SCHEMA = '''
+CREATE TABLE files (
+    path TEXT PRIMARY KEY,  -- relative to SRC_DIR
+    archive TEXT,           -- the name of the tarball holding the file
+    type TEXT,              -- 'file' or 'link'
+    data_offset INTEGER,    -- offset of the file's data in the uncompressed tarball
+    size INTEGER,
+    mtime INTEGER,
+    mode INTEGER,
+    linkname TEXT           -- the target of links
+);
+CREATE TABLE blocks (
+    archive TEXT,
+    uncompressed_offset INTEGER,
+    compressed_offset INTEGER
+);
+'''
+# The commands that can be given as the first argument to wp_bak.py instead of running the backup loop.
+COMMANDS = ['list', 'restore', 'verify']
+
+# Each backup made with a tarball of the files holds this file mapping the path, relative to the backup, of each archive
+# and database dump to its sha256 and size. They're computed as the files are written. See verify_snapshots.
+CHECKSUMS_NAME = 'checksums.json'
+# The results of the latest verify_snapshots run are saved here so they can be exported in the metrics.
+VERIFY_STATE_PATH = DST_DIR / 'verify.json'
+
+# With --s3_endpoint each backup is copied to the bucket after it's published, to <prefix>/<tier>/<timestamp>/...,
+# where tier is the name of SHORT_DIR or LONG_DIR, with the chunks of --repository backups under <prefix>/chunks. An
+# empty object with this name is written last so a backup whose upload was interrupted isn't taken for a complete one.
+REPLICATED_NAME = '.replicated'
+# The ids of the multipart uploads in progress, by key, so that an interrupted upload of a large file can carry on with
+# the parts that haven't been uploaded yet.
+UPLOAD_STATE_PATH = DST_DIR / 'uploads.json'
+# S3 doesn't allow parts smaller than this, other than the last, or more than S3_MAX_PARTS of them.
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_MAX_PARTS = 10000
+# A single CopyObject request can copy objects up to this size; larger ones are uploaded again.
+S3_MAX_COPY_SIZE = 5 * 1024**3
+# Each request is retried this many times, waiting S3_RETRY_DELAY seconds, doubling each time, if the connection fails
+# or the endpoint returns a 5xx or 429 error.
+S3_RETRIES = 5
+S3_RETRY_DELAY = 1.0
+S3_TIMEOUT = 60
+
+# With --adaptive_throttle the read rate is halved (down to ADAPTIVE_MIN_RATE) whenever, over the last ADAPTIVE_INTERVAL
+# seconds, reads took longer than ADAPTIVE_MAX_LATENCY seconds on average or the 1 minute load average per CPU was above
+# ADAPTIVE_MAX_LOAD, and raised by 10% (up to --read_limit, or ADAPTIVE_START_RATE if there is none) otherwise.
+ADAPTIVE_INTERVAL = 5
+ADAPTIVE_MAX_LATENCY = 0.05
+ADAPTIVE_MAX_LOAD = 1.0
+ADAPTIVE_MIN_RATE = 1024 * 1024
+ADAPTIVE_START_RATE = 50 * 1024 * 1024
+
+# Files and directories that are excluded from the backup unless --no_default_excludes is given. These are caches and
+# temporary files that WordPress and common plugins regenerate as needed. See parse_excludes for the pattern syntax.
+DEFAULT_EXCLUDES = [
+    '/wp-content/cache/',
+    '/wp-content/et-cache/',
+    '/wp-content/wflogs/',
+    '/wp-content/upgrade/',
+    '/wp-content/upgrade-temp-backup/',
+]
+
+# With --db_workers the database is dumped into this directory in the backup, one compressed file per table, along with
+# an index file listing the parts.
+DB_PARTS_DIR_NAME = 'db'
+DB_INDEX_NAME = 'index.json'
+# The comment lines mysqldump writes at the start of the section for each table or view.
+TABLE_SECTION_RE = re.compile(
+    rb'-- (Table structure for table|Temporary table structure for view|Final view structure for view) `(.*)`')
+# Lists the tables and views to be dumped by --db_workers along with their approximate size.
+LIST_TABLES_SQL = ("SELECT TABLE_SCHEMA, TABLE_NAME, TABLE_TYPE, IFNULL(DATA_LENGTH, 0) + IFNULL(INDEX_LENGTH, 0) "
+                   "FROM information_schema.TABLES "
+                   "WHERE TABLE_SCHEMA NOT IN ('information_schema', 'performance_schema', 'sys')")
+# With --incremental_db, gets the server's current time and the last update and creation times of every table. The
+# update time is NULL for tables whose engine doesn't track it and, for InnoDB, until the table is changed after a
+# restart; such tables fall back to CHECKSUM TABLE. See table_states.
+TABLE_STATE_SQL = ("SELECT NOW(), TABLE_SCHEMA, TABLE_NAME, IFNULL(UPDATE_TIME, ''), IFNULL(CREATE_TIME, '') "
+                   "FROM information_schema.TABLES "
+                   "WHERE TABLE_TYPE = 'BASE TABLE' "
+                   "AND TABLE_SCHEMA NOT IN ('information_schema', 'performance_schema', 'sys')")
+# The longest, in seconds, we'll hold the read lock waiting for all the --db_workers to start their transactions.
+DB_LOCK_TIMEOUT = 300
+# The server's log tables can't be locked with LOCK TABLES, so they're left out of the lock lock_tables takes. The
+# server writes to them itself and mysqldump only dumps their structure.
+UNLOCKABLE_TABLES = {('mysql', 'general_log'), ('mysql', 'slow_log')}
+
 DATE_TIME_FORMAT = "%Y-%m-%d-%H-%M-%S"
+# A backup is written to a directory named with this suffix and only renamed to its timestamp once it is complete.
+# get_backup_list ignores such directories so an incomplete backup is never used or pruned as if it were complete.
+IN_PROGRESS_SUFFIX = '.partial'
 # regex that matches timestamps in DATE_TIME_FORMAT
 DATE_TIME_RE = re.compile(r'\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2}')
 
+# Backups are due at --backup_time plus a whole number of --backup_freq intervals counted from this date. For daily
+# backups that's simply every day at --backup_time.
+SCHEDULE_EPOCH = datetime(2000, 1, 1)
+# With --keep_hourly, --keep_daily, --keep_weekly and --keep_monthly the newest backup in each of that many of the
+# latest hours, days, weeks and months is also kept, as (tier, function giving the bucket a backup's time falls in).
+# Hourly and daily backups are kept in SHORT_DIR; weekly and monthly ones in LONG_DIR. See plan_retention.
+RETENTION_BUCKETS = {
+    'hourly': ('short', lambda t: (t.date(), t.hour)),
+    'daily': ('short', lambda t: t.date()),
+    'weekly': ('long', lambda t: t.isocalendar()[:2]),
+    'monthly': ('long', lambda t: (t.year, t.month)),
+}
+# Backups the retention policy no longer keeps are renamed into this directory, which is on the same volume, and then
+# deleted in the background by the Reclaimer so that deleting a big tree doesn't hold up the next backup. Anything left
+# in it when the sidecar stops is deleted when it next starts.
+TRASH_DIR = DST_DIR / 'trash'
+# The Reclaimer sleeps for RECLAIM_PAUSE seconds after deleting every RECLAIM_BATCH files so that it doesn't hog the
+# disk while a backup is being made.
+RECLAIM_BATCH = 1000
+RECLAIM_PAUSE = 0.05
+# An in-progress backup records which phases have finished, and their results, in this file so that if the sidecar is
+# killed part way through (e.g. OOM killed or evicted) the backup can be resumed rather than started over. See
+# Checkpoint. The file, and the progress files below, are deleted before the backup is published.
+CHECKPOINT_NAME = 'checkpoint.json'
+# With --repository the index records of the files stored so far are appended to this file as they're stored.
+FILES_CHECKPOINT_NAME = 'files.checkpoint.jsonl'
+# With --incremental, when resuming, the files already copied are moved here and linked back into the new tree.
+RESUME_DIR_NAME = 'files.resume'
+# With --db_workers the index records of each group of tables are appended to this file, in the temporary directory
+# the parts are written to, as soon as the group has been dumped.
+DB_PROGRESS_NAME = 'progress.jsonl'
+
+# The metrics served on --metrics_port, in the Prometheus text format, as name: (type, help). The ones in RUN_METRICS
+# describe the latest backup and are reset when a backup starts; they're also written to the backup's REPORT_NAME.
+METRICS = {
+    'wp_bak_phase_duration_seconds': ('gauge', 'Seconds spent in each phase of the latest backup. The files and '
+                                      'database phases run at the same time; walk and compress are part of the files '
+                                      'phase and compress is summed over the threads doing it.'),
+    'wp_bak_backup_duration_seconds': ('gauge', 'Seconds taken by the latest backup, from start to publishing it.'),
+    'wp_bak_files_skipped': ('gauge', 'Files and directories left out of the latest backup, by reason.'),
+    'wp_bak_bytes_read': ('gauge', 'Bytes of WordPress files read by the latest backup.'),
+    'wp_bak_bytes_written': ('gauge', 'Bytes of file backups written by the latest backup.'),
+    'wp_bak_bytes_uploaded': ('gauge', 'Bytes uploaded to --s3_endpoint after the latest backup.'),
+    'wp_bak_compression_ratio': ('gauge', 'Bytes read over bytes written for the files in the latest backup.'),
+    'wp_bak_last_success_timestamp_seconds': ('gauge', 'Unix time at which the newest complete backup was made.'),
+    'wp_bak_backups_total': ('counter', 'Backups completed since the sidecar started.'),
+    'wp_bak_snapshots': ('gauge', 'Number of backups in each tier.'),
+    'wp_bak_tier_size_bytes': ('gauge', 'Disk space used by each tier. Data hard linked between tiers counts in each.'),
+    'wp_bak_verify_last_run_timestamp_seconds': ('gauge', 'Unix time at which the latest verification of the backups '
+                                                 'finished.'),
+    'wp_bak_verify_duration_seconds': ('gauge', 'Seconds taken by the latest verification of the backups.'),
+    'wp_bak_verify_files': ('gauge', 'Files checked by the latest verification of the backups, by result.'),
+    'wp_bak_verify_corrupt_snapshots': ('gauge', 'Backups found to be corrupt by the latest verification.'),
+}
+RUN_METRICS = {'wp_bak_phase_duration_seconds', 'wp_bak_backup_duration_seconds', 'wp_bak_files_skipped',
+               'wp_bak_bytes_read', 'wp_bak_bytes_written', 'wp_bak_bytes_uploaded', 'wp_bak_compression_ratio'}
+# Each backup's run report, a JSON file holding the RUN_METRICS, is written into the backup's directory with this name.
+REPORT_NAME = 'report.json'
+# Sending the sidecar SIGUSR1 profiles the phases of the next backup with cProfile, one at a time (see start_profile).
+# The stats are written here, as <timestamp>-<phase>.prof files, and the top PROFILE_TOP_N functions by cumulative time
+# are logged.
+PROFILE_DIR = DST_DIR / 'profiles'
+PROFILE_TOP_N = 25
+
 logging.basicConfig(level=logging.INFO, stream=sys.stderr,
                    format='%(asctime)s %(levelname)-8s %(message)s')
 log = logging.getLogger(__name__)
@@ -61,6 +287,51 @@ def make_timedelta(arg: str) -> timedelta:
     return result
 
 
+def make_port(arg: str) -> int:
+    port = int(arg)
+    if not 0 <= port <= 65535:
+        raise argparse.ArgumentTypeError(f'{port} is not a valid port number')
+    return port
+
+
+def make_time_of_day(arg: str) -> timedelta:
+    """Given a time of day like "02:30" returns the time since midnight, e.g. a timedelta of 2 hours and 30 minutes."""
+    m = re.fullmatch(r'\s*(\d{1,2}):(\d{2})\s*', arg)
+    if m is None or int(m.group(1)) > 23 or int(m.group(2)) > 59:
+        raise argparse.ArgumentTypeError(f'"{arg}" is not a time of day like "02:30"')
+    return timedelta(hours=int(m.group(1)), minutes=int(m.group(2)))
+
+
+def make_byte_rate(arg: str) -> int:
+    """Given a string holding a number of bytes with an optional `K`, `M` or `G` suffix (powers of 1024) returns the
+    number of bytes. For example "50M" would be parsed into 52428800.
+    """
+    m = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMG]?)\s*', arg.upper())
+    if m is None:
+        raise argparse.ArgumentTypeError(f'"{arg}" is not a number of bytes like "512K" or "50M"')
+    return int(float(m.group(1)) * {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3}[m.group(2)])
+
+
+def available_cpus() -> int:
+    """Returns the number of CPUs this container may use, rounded up, based on its cgroup CPU quota if it has one."""
+    cpus = os.cpu_count() or 1
+    try:
+        # cgroup v2 holds "<quota> <period>" or "max <period>" in a single file.
+        quota, period = Path('/sys/fs/cgroup/cpu.max').read_text().split()
+        if quota != 'max':
+            cpus = min(cpus, -(-int(quota) // int(period)))
+    except (OSError, ValueError):
+        try:
+            # cgroup v1 holds them in separate files with -1 for no quota.
+            quota_us = int(Path('/sys/fs/cgroup/cpu/cpu.cfs_quota_us').read_text())
+            period_us = int(Path('/sys/fs/cgroup/cpu/cpu.cfs_period_us').read_text())
+            if quota_us > 0:
+                cpus = min(cpus, -(-quota_us // period_us))
+        except (OSError, ValueError):
+            pass
+    return max(1, cpus)
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description='Backs up a WordPress site')
     parser.add_argument('-b', '--backup_freq', type=make_timedelta, default=timedelta(days=1),
@@ -68,6 +339,16 @@ def parse_args() -> argparse.Namespace:
                        '"h" indicating hours, "m" indicating minutes, and "s" for seconds. Thus a '
                         'string like "2d4h7m" means "make a backup every 2 days, 4 hours and 7 minutes". '
                        'Default is 1 day.')
+    parser.add_argument('--backup_time', type=make_time_of_day, default=timedelta(0),
+                        help='The local time of day, like "02:30", that backups are aligned to. Backups are due at '
+                        'this time and then every --backup_freq after it, regardless of how long each backup takes. '
+                        'Default is midnight.')
+    parser.add_argument('--backup_window', type=make_timedelta, default=None,
+                        help='How long after the time a backup is due it may still be started, e.g. "3h" to only '
+                        'back up in the 3 hours after --backup_time. If the sidecar was down (or busy) for the whole '
+                        'window that backup is skipped and the next one made on schedule. Format is the same as for '
+                        '--backup_freq. Default is --backup_freq, i.e. a missed backup is always made as soon as '
+                        'possible.')
     parser.add_argument('--short_keep', type=make_timedelta, default=timedelta(days=7),
                         help='How long to keep every backup. Format is the same as for --backup_freq. '
                        'Default is 7 days.')
@@ -77,16 +358,155 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument('--long_keep', type=make_timedelta, default=timedelta(days=28),
                         help='How frequently to retain "long" backups (see the main repo README for details). '
                         'Format is the same as for --backup_freq. Default is 28 days.')
+    parser.add_argument('--keep_hourly', type=int, default=0,
+                        help='Also keep the newest short backup in each of this many of the latest hours, on top of '
+                        'the ones kept for --short_keep. Default is 0.')
+    parser.add_argument('--keep_daily', type=int, default=0,
+                        help='Also keep the newest short backup in each of this many of the latest days, on top of '
+                        'the ones kept for --short_keep. Default is 0.')
+    parser.add_argument('--keep_weekly', type=int, default=0,
+                        help='Also promote the first backup of each week to a long one, as well as one every '
+                        '--long_freq, and keep the newest long backup in each of this many of the latest weeks, on top '
+                        'of the ones kept for --long_keep. Default is 0.')
+    parser.add_argument('--keep_monthly', type=int, default=0,
+                        help='Also promote the first backup of each month to a long one, as well as one every '
+                        '--long_freq, and keep the newest long backup in each of this many of the latest months, on '
+                        'top of the ones kept for --long_keep. Default is 0.')
+    parser.add_argument('--dry_run', action='store_true', default=False,
+                        help="Print which backups the retention policy would keep, promote and delete now, and why, "
+                        "and exit without making a backup or deleting anything.")
     parser.add_argument('--db_host', required=True, help='The hostname of the MySQL or MariaDb server')
     parser.add_argument('--db_user', required=True,
                         help='The username to use to connect to the MySQL or MariaDb server')
     parser.add_argument('--db_pass', required=True,
                         help='The password to use to connect to the MySQL or MariaDb server')
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help='Instead of a files.tar.gz, store the files as a tree in which files that have not '
+                        'changed since the previous backup are hard links to the copy in that backup. This saves a '
+                        'great deal of disk space and I/O for sites with lots of media that rarely changes.')
+    parser.add_argument('--repository', action='store_true', default=False,
+                        help='Store the files and the database dump in a deduplicating chunk store under '
+                        f'{CHUNK_DIR}. Each chunk of data is only stored once no matter how many backups contain it. '
+                        'Chunks no longer used by any backup are deleted after old backups are pruned.')
+    parser.add_argument('--db_compression', choices=sorted(COMPRESSORS.keys()), default='gzip',
+                        help='The codec used to compress the database dump. Default is gzip.')
+    parser.add_argument('--db_compression_level', type=int, default=None,
+                        help='The compression level for --db_compression. Default is the default level of the codec.')
+    parser.add_argument('--files_compression', choices=sorted(COMPRESSORS.keys()), default='gzip',
+                        help='The codec used to compress the files.tar archive. Default is gzip.')
+    parser.add_argument('--files_compression_level', type=int, default=None,
+                        help='The compression level for --files_compression. Default is the default level of the '
+                        'codec.')
+    parser.add_argument('--store_media_uncompressed', action='store_true', default=False,
+                        help='Store files that are already compressed, like images, videos and zip files, in a '
+                        f'separate, uncompressed {STORED_TAR_NAME} rather than compressing them again.')
+    parser.add_argument('--exclude', action='append', default=[],
+                        help='A gitignore style pattern for files or directories, relative to the WordPress root, '
+                        'that should not be backed up. For example "/wp-content/uploads/*.tmp" or "node_modules/". '
+                        'May be given more than once.')
+    parser.add_argument('--no_default_excludes', action='store_true', default=False,
+                        help='Back up the caches and temporary directories that are excluded by default: ' +
+                        ', '.join(DEFAULT_EXCLUDES))
+    parser.add_argument('--compress_threads', type=int, default=None,
+                        help='The number of threads used to compress the files.tar archive. Default is the number '
+                        'of CPUs available to the container, based on its CPU limit.')
+    parser.add_argument('--read_limit', type=make_byte_rate, default=None,
+                        help='The maximum rate, in bytes per second, at which to read the WordPress files so that '
+                        'backups don\'t slow down the live site. Accepts K, M and G suffixes, e.g. "20M". Default is '
+                        'no limit.')
+    parser.add_argument('--write_limit', type=make_byte_rate, default=None,
+                        help='The maximum rate, in bytes per second, at which to write the file backups to /dst. Same '
+                        'format as --read_limit. Default is no limit.')
+    parser.add_argument('--adaptive_throttle', action='store_true', default=False,
+                        help='Lower the CPU and I/O priority of the backup and slow down reading the WordPress files '
+                        'whenever reads get slow or the system load gets high, speeding up again when they recover.')
+    parser.add_argument('--incremental_db', action='store_true', default=False,
+                        help='With --db_workers, only dump the tables that changed since the previous backup. '
+                        'Unchanged tables are hard linked from the previous backup so every backup still holds a '
+                        'complete dump.')
+    parser.add_argument('--metrics_port', type=make_port, default=None,
+                        help='Serve Prometheus metrics about the backups (phase durations, bytes read and written, '
+                        'last success, backup counts and sizes, etc.) at http://<pod>:<port>/metrics. Default is to '
+                        'not serve metrics.')
+    parser.add_argument('--s3_endpoint', default=None,
+                        help='Copy every backup, after it is made, to a bucket on this S3-compatible endpoint, e.g. '
+                        'https://s3.us-east-1.amazonaws.com or http://minio:9000. Backups are deleted from the bucket '
+                        'once they are deleted locally by the retention policy. Default is to keep backups only on '
+                        'the local volume.')
+    parser.add_argument('--s3_bucket', default=None, help='The bucket to copy backups to. Required with --s3_endpoint.')
+    parser.add_argument('--s3_prefix', default='',
+                        help='The prefix, e.g. the site name, under which the backups are stored in the bucket.')
+    parser.add_argument('--s3_region', default='us-east-1', help='The region of the bucket.')
+    parser.add_argument('--s3_access_key', default=None, help='The access key for the bucket.')
+    parser.add_argument('--s3_secret_key', default=None, help='The secret key for the bucket.')
+    parser.add_argument('--upload_concurrency', type=int, default=4,
+                        help='How many files, or parts of large files, to upload to the bucket at once. At most this '
+                        'many times --upload_part_size bytes are held in memory.')
+    parser.add_argument('--upload_part_size', type=make_byte_rate, default=16 * 1024**2,
+                        help='Files larger than this are uploaded in parts of this size, which are uploaded in '
+                        'parallel and, if the upload is interrupted, not uploaded again. Must be at least 5M.')
+    parser.add_argument('--verify_freq', type=make_timedelta, default=None,
+                        help='How often to verify all the backups, after a backup finishes, as with the verify '
+                        'command. The verification runs at low CPU and I/O priority and its results are included in '
+                        'the metrics. Default is to never verify them.')
+    parser.add_argument('--db_workers', type=int, default=0,
+                        help='If greater than 0, dump the database with this many mysqldump processes running in '
+                        'parallel, each dumping a share of the tables, into one compressed file per table. All the '
+                        'workers see the database at the same point in time. Default is 0 which dumps all databases '
+                        'with a single mysqldump into one file.')
 
     log.info('Parsing command line: %s', sys.argv)
     parsed = parser.parse_args()
 
     error = False
+    if parsed.incremental and parsed.repository:
+        log.error('--incremental and --repository can not be used together')
+        error = True
+
+    if parsed.db_workers < 0:
+        log.error('--db_workers must not be negative')
+        error = True
+
+    if parsed.db_workers > 0 and parsed.repository:
+        log.error('--db_workers can not be used with --repository')
+        error = True
+
+    if parsed.incremental_db and parsed.db_workers == 0:
+        log.error('--incremental_db requires --db_workers')
+        error = True
+
+    for codec_arg in ('db_compression', 'files_compression'):
+        codec = getattr(parsed, codec_arg)
+        level = getattr(parsed, codec_arg + '_level')
+        if level is not None:
+            min_level, max_level = COMPRESSORS[codec]['levels']
+            if not min_level <= level <= max_level:
+                log.error('--%s_level must be between %s and %s for %s', codec_arg, min_level, max_level, codec)
+                error = True
+
+    if parsed.compress_threads is None:
+        parsed.compress_threads = available_cpus()
+    elif parsed.compress_threads < 1:
+        log.error('--compress_threads must be at least 1')
+        error = True
+
+    if parsed.backup_window is None:
+        parsed.backup_window = parsed.backup_freq
+    elif not timedelta(0) < parsed.backup_window <= parsed.backup_freq:
+        log.error('--backup_window must be more than 0 and no more than --backup_freq')
+        error = True
+
+    if parsed.s3_endpoint is not None:
+        if parsed.s3_bucket is None or parsed.s3_access_key is None or parsed.s3_secret_key is None:
+            log.error('--s3_endpoint requires --s3_bucket, --s3_access_key and --s3_secret_key')
+            error = True
+        if parsed.upload_concurrency < 1:
+            log.error('--upload_concurrency must be at least 1')
+            error = True
+        if parsed.upload_part_size < S3_MIN_PART_SIZE:
+            log.error('--upload_part_size must be at least 5M')
+            error = True
+
     if parsed.backup_freq >= parsed.short_keep:
         log.error('--backup_freq must be less than --short_keep')
         error = True
@@ -97,33 +517,52 @@ def parse_args() -> argparse.Namespace:
     if parsed.long_freq >= parsed.long_keep:
         log.error('--long_freq must be less than --long_keep')
 
+    for rule in RETENTION_BUCKETS:
+        if getattr(parsed, f'keep_{rule}') < 0:
+            log.error('--keep_%s must not be negative', rule)
+            error = True
+
     if error:
         parser.print_help()
         sys.exit(1)
 
     log.info('Settings:')
     log.info('backup_freq: %s', parsed.backup_freq)
+    log.info('backup_time: %s', parsed.backup_time)
+    log.info('backup_window: %s', parsed.backup_window)
     log.info('short_keep: %s', parsed.short_keep)
     log.info('long_freq: %s', parsed.long_freq)
     log.info('long_keep: %s', parsed.long_keep)
+    for rule in RETENTION_BUCKETS:
+        log.info('keep_%s: %s', rule, getattr(parsed, f'keep_{rule}'))
+    log.info('dry_run: %s', parsed.dry_run)
+    log.info('incremental: %s', parsed.incremental)
+    log.info('repository: %s', parsed.repository)
+    log.info('db_compression: %s', parsed.db_compression)
+    log.info('db_compression_level: %s', parsed.db_compression_level)
+    log.info('db_workers: %s', parsed.db_workers)
+    log.info('incremental_db: %s', parsed.incremental_db)
+    log.info('read_limit: %s', parsed.read_limit)
+    log.info('write_limit: %s', parsed.write_limit)
+    log.info('adaptive_throttle: %s', parsed.adaptive_throttle)
+    log.info('metrics_port: %s', parsed.metrics_port)
+    log.info('s3_endpoint: %s', parsed.s3_endpoint)
+    log.info('s3_bucket: %s', parsed.s3_bucket)
+    log.info('s3_prefix: %s', parsed.s3_prefix)
+    log.info('s3_region: %s', parsed.s3_region)
+    log.info('upload_concurrency: %s', parsed.upload_concurrency)
+    log.info('upload_part_size: %s', parsed.upload_part_size)
+    log.info('verify_freq: %s', parsed.verify_freq)
+    log.info('files_compression: %s', parsed.files_compression)
+    log.info('files_compression_level: %s', parsed.files_compression_level)
+    log.info('compress_threads: %s', parsed.compress_threads)
+    log.info('store_media_uncompressed: %s', parsed.store_media_uncompressed)
+    log.info('exclude: %s', parsed.exclude)
+    log.info('no_default_excludes: %s', parsed.no_default_excludes)
 
     return parsed
 
 
-def dirname2age(now: datetime, dirname: str) -> timedelta:
-    """Calculcates the age of a backup directory.
-
-    Parameters
-    ----------
-    now : datetime
-        The time to use as "now" for calculating item's age.
-
-    dirname : string
-        The name of the backup directory to calculate age of.
-    """
-    # Get age from archive-date string
-    return now - datetime.strptime(dirname, DATE_TIME_FORMAT)
-
 def get_backup_list(dir: Path) -> List[Path]:
     """Returns a sorted list of archive files from the specified directory.
 
@@ -141,72 +580,2924 @@ def get_backup_list(dir: Path) -> List[Path]:
     dirs.sort()
     return dirs
 
-def delete_too_old(dir: Path, now: datetime, cutoff: timedelta) -> None:
-    """Deletes everything in the specified directory that is equal to or older than the cutoff.
 
-    Parameters
-    ----------
-    dir : string, name of directory
-        The directory to prune.
+def scan_tiers() -> Dict[str, List[Tuple[datetime, str]]]:
+    """Lists the backups in SHORT_DIR and LONG_DIR, under 'short' and 'long', as (time made, name), oldest first.
+
+    Each directory is listed, and each name parsed, just once so the whole retention policy can then be worked out from
+    this timeline without going back to the disk.
+    """
+    return {tier: [(datetime.strptime(backup.name, DATE_TIME_FORMAT), backup.name) for backup in get_backup_list(dir)]
+            for tier, dir in (('short', SHORT_DIR), ('long', LONG_DIR))}
+
+
+def newest_per_bucket(timeline: List[Tuple[datetime, str]], bucket: Callable[[datetime], Any], count: int) -> List[str]:
+    """Returns the names of the newest backup in each of the latest count buckets, where timeline is as for one tier of
+    scan_tiers and bucket gives the bucket a backup's time falls in.
+
+    As the timeline is sorted the backups in a bucket are next to each other so this is one pass from the newest.
+    """
+    names: List[str] = []
+    last = None
+    for made, name in reversed(timeline):
+        if len(names) == count:
+            break
+        if not names or bucket(made) != last:
+            names.append(name)
+            last = bucket(made)
+    return names
+
+
+def plan_retention(timeline: Dict[str, List[Tuple[datetime, str]]], now: datetime,
+                   args: argparse.Namespace) -> Dict[str, Any]:
+    """Works out, from the timeline returned by scan_tiers, which backups the retention policy keeps and whether the
+    newest short backup is promoted to a long one.
+
+    The newest short is promoted if there are no longs, if the newest long is at least --long_freq old or, with
+    --keep_weekly or --keep_monthly, if it's in a later week or month than the newest long. A short is kept if it's
+    less than --short_keep old or is the newest in one of the latest --keep_hourly hours or --keep_daily days, and a
+    long if it's less than --long_keep old or is the newest in one of the latest --keep_weekly weeks or --keep_monthly
+    months. The newest backup in each tier is always kept.
+
+    Returns a dict with:
+        promote: the name of the short backup to hard link to the longs, or None.
+        backups: the names of the backups in each tier, oldest first, including the one promoted.
+        keep: the names of the backups kept in each tier mapped to the rules keeping them.
+        delete: the names of the backups to delete from each tier, oldest first.
+    """
+    tiers = {tier: list(backups) for tier, backups in timeline.items()}
+    promote = None
+    if tiers['short']:
+        made, name = tiers['short'][-1]
+        longs = tiers['long']
+        if (not longs or (made > longs[-1][0] and (
+                now - longs[-1][0] >= args.long_freq
+                or any(getattr(args, f'keep_{rule}') > 0 and bucket(made) != bucket(longs[-1][0])
+                       for rule, (tier, bucket) in RETENTION_BUCKETS.items() if tier == 'long')))):
+            promote = name
+            longs.append((made, name))
+
+    keep: Dict[str, Dict[str, List[str]]] = {'short': {}, 'long': {}}
+    for tier, cutoff in (('short', args.short_keep), ('long', args.long_keep)):
+        for made, name in tiers[tier]:
+            if now - made < cutoff:
+                keep[tier].setdefault(name, []).append(f'{tier}_keep')
+    for rule, (tier, bucket) in RETENTION_BUCKETS.items():
+        for name in newest_per_bucket(tiers[tier], bucket, getattr(args, f'keep_{rule}')):
+            keep[tier].setdefault(name, []).append(rule)
+    for tier, backups in tiers.items():
+        if backups:
+            keep[tier].setdefault(backups[-1][1], []).append('newest')
+    return {
+        'promote': promote,
+        'backups': {tier: [name for _, name in backups] for tier, backups in tiers.items()},
+        'keep': keep,
+        'delete': {tier: [name for _, name in backups if name not in keep[tier]] for tier, backups in tiers.items()},
+    }
+
+
+def print_retention_plan(plan: Dict[str, Any]) -> None:
+    """Prints, for --dry_run, what plan_retention decided for each backup."""
+    if plan['promote'] is not None:
+        print(f'promote  short/{plan["promote"]} to long/{plan["promote"]}')
+    for tier, names in plan['backups'].items():
+        for name in names:
+            rules = plan['keep'][tier].get(name)
+            print(f'keep     {tier}/{name} ({", ".join(rules)})' if rules else f'delete   {tier}/{name}')
+
+
+def reclaim_backups(reclaimer: 'Reclaimer', plan: Dict[str, Any]) -> None:
+    """Hands the backups plan_retention decided to delete to the reclaimer."""
+    for tier, dir in (('short', SHORT_DIR), ('long', LONG_DIR)):
+        for name in plan['delete'][tier]:
+            reclaimer.reclaim(dir / name)
+
+
+class Reclaimer:
+    """Deletes backups in the background.
+
+    reclaim renames a backup into the trash directory, which is quick as it's on the same volume, so it's gone from the
+    tiers straight away: it's no longer listed, restored, verified or used as the base of the next backup, and with
+    --repository its chunks can be freed. A thread then deletes what's in the trash RECLAIM_BATCH files at a time.
+    """
+    def __init__(self, trash_dir: Path):
+        self.trash_dir = trash_dir
+        self.queue: Deque[Path] = deque()
+        self.cond = threading.Condition()
+        self.busy = False
+
+    def start(self) -> None:
+        """Starts the thread, first queuing anything left in the trash by an earlier run."""
+        self.trash_dir.mkdir(parents=True, exist_ok=True)
+        with self.cond:
+            queued = set(self.queue)
+            self.queue.extend(path for path in sorted(self.trash_dir.iterdir()) if path not in queued)
+        threading.Thread(target=self.run, name='reclaimer', daemon=True).start()
+
+    def reclaim(self, backup_dir: Path) -> None:
+        """Moves backup_dir to the trash and queues it to be deleted."""
+        self.trash_dir.mkdir(parents=True, exist_ok=True)
+        trash = self.trash_dir / f'{backup_dir.parent.name}-{backup_dir.name}'
+        suffix = 1
+        while trash.exists():
+            trash = self.trash_dir / f'{backup_dir.parent.name}-{backup_dir.name}.{suffix}'
+            suffix += 1
+        log.info('Deleting backup - %s', backup_dir)
+        backup_dir.rename(trash)
+        with self.cond:
+            self.queue.append(trash)
+            self.cond.notify_all()
+
+    def wait(self) -> None:
+        """Waits until everything in the trash has been deleted."""
+        with self.cond:
+            self.cond.wait_for(lambda: not self.queue and not self.busy)
+
+    def run(self) -> None:
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: bool(self.queue))
+                path = self.queue.popleft()
+                self.busy = True
+            try:
+                self.delete(path)
+            except OSError as e:
+                log.error('Deleting %s failed: %s', path, e)
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
+
+    def delete(self, path: Path) -> None:
+        """Deletes path, and everything under it, pausing every RECLAIM_BATCH files."""
+        start = time.monotonic()
+        deleted = 0
+        if path.is_dir() and not path.is_symlink():
+            for dir_path, dir_names, file_names in os.walk(path, topdown=False):
+                # Walking bottom up the directories are already empty, apart from symbolic links to directories,
+                # which are listed with the directories but are removed like files.
+                entries = [(name, True) for name in file_names] + [(name, False) for name in dir_names]
+                for name, is_file in entries:
+                    entry = os.path.join(dir_path, name)
+                    if is_file or os.path.islink(entry):
+                        os.unlink(entry)
+                    else:
+                        os.rmdir(entry)
+                    deleted += 1
+                    if deleted % RECLAIM_BATCH == 0:
+                        time.sleep(RECLAIM_PAUSE)
+            os.rmdir(path)
+        else:
+            os.unlink(path)
+        log.info('Freed %s: deleted %s files in %.1f seconds', path.name, deleted, time.monotonic() - start)
+
+def parse_excludes(patterns: List[str]) -> List[Tuple[Pattern, bool]]:
+    """Compiles gitignore style exclude patterns into (regular expression, directories only) pairs for walk_tree.
+
+    As in .gitignore, a pattern containing a `/` other than at its end is matched against the whole path relative to
+    the root of the tree; otherwise it is matched against the name of a file or directory at any depth. A trailing `/`
+    means the pattern only matches directories. `*` matches anything but `/`, `?` matches any single character but
+    `/`, `[...]` matches a character class and `**` matches any number of directories. Negated patterns (`!`) are not
+    supported.
+    """
+    rules = []
+    for pattern in patterns:
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        anchored = '/' in pattern
+        pattern = pattern.lstrip('/')
+        regex = ''
+        i = 0
+        while i < len(pattern):
+            if pattern.startswith('**/', i):
+                regex += '(?:.*/)?'
+                i += 3
+            elif pattern.startswith('**', i):
+                regex += '.*'
+                i += 2
+            elif pattern[i] == '*':
+                regex += '[^/]*'
+                i += 1
+            elif pattern[i] == '?':
+                regex += '[^/]'
+                i += 1
+            elif pattern[i] == '[' and ']' in pattern[i + 1:]:
+                end = pattern.index(']', i + 1)
+                regex += '[' + pattern[i + 1:end].replace('!', '^', 1) + ']'
+                i = end + 1
+            else:
+                regex += re.escape(pattern[i])
+                i += 1
+        if not anchored:
+            regex = '(?:.*/)?' + regex
+        rules.append((re.compile(regex), dir_only))
+    return rules
+
+
+def is_excluded(rel_path: str, is_dir: bool, excludes: List[Tuple[Pattern, bool]]) -> bool:
+    """Returns True if rel_path, a `/` separated path relative to the root of the tree, matches any of excludes."""
+    return any(regex.fullmatch(rel_path) is not None and (is_dir or not dir_only) for regex, dir_only in excludes)
+
+
+class RateLimiter:
+    """A token bucket limiting the rate at which bytes are consumed to rate bytes per second, or not at all if rate is
+    None. Up to one second's worth of bytes may be consumed in a burst.
+    """
+    def __init__(self, rate: Optional[float] = None):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = rate or 0.0
+        self.last = time.monotonic()
+
+    def consume(self, num_bytes: int) -> None:
+        """Records that num_bytes were consumed, sleeping if that puts us over the rate limit."""
+        if self.rate is None:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate) - num_bytes
+            self.last = now
+            # Sleep while holding the lock so that other threads wait their turn rather than all over-consuming.
+            if self.tokens < 0:
+                time.sleep(-self.tokens / self.rate)
+
+
+class Throttle:
+    """Limits, and keeps statistics on, the rate at which backups read the WordPress files and write to DST_DIR.
+
+    There is a single instance, `throttle`, configured from the command line arguments by main. The functions that
+    read files (via read or ThrottledFile) and write backups (via wrote) report to it.
+    """
+    def __init__(self):
+        self.read_limiter = RateLimiter()
+        self.write_limiter = RateLimiter()
+        self.max_read_rate: Optional[float] = None
+        self.write_rate: Optional[float] = None
+        self.adaptive = False
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def configure(self, read_rate: Optional[float], write_rate: Optional[float], adaptive: bool) -> None:
+        self.max_read_rate = read_rate
+        self.write_rate = write_rate
+        self.adaptive = adaptive
+        if adaptive and read_rate is None:
+            read_rate = ADAPTIVE_START_RATE
+        self.read_limiter = RateLimiter(read_rate)
+        self.write_limiter = RateLimiter(write_rate)
+
+    def reset_stats(self) -> None:
+        self.start = time.monotonic()
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.window_start = self.start
+        self.window_reads = 0
+        self.window_read_time = 0.0
+
+    def transferred(self, num_bytes: int, seconds: float) -> None:
+        """Records that num_bytes were read from the WordPress files, taking seconds, and sleeps if needed."""
+        with self.lock:
+            self.bytes_read += num_bytes
+            self.window_reads += 1
+            self.window_read_time += seconds
+            if self.adaptive and time.monotonic() - self.window_start >= ADAPTIVE_INTERVAL:
+                self._adapt()
+        self.read_limiter.consume(num_bytes)
+
+    def read(self, f: BinaryIO, size: int = -1) -> bytes:
+        """Reads up to size bytes from f, which holds WordPress files, subject to the read limit."""
+        start = time.monotonic()
+        data = f.read(size)
+        self.transferred(len(data), time.monotonic() - start)
+        return data
+
+    def wrote(self, num_bytes: int) -> None:
+        """Records that num_bytes were written to DST_DIR, sleeping if that puts us over the write limit."""
+        with self.lock:
+            self.bytes_written += num_bytes
+        self.write_limiter.consume(num_bytes)
+
+    def _adapt(self) -> None:
+        latency = self.window_read_time / max(1, self.window_reads)
+        load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        rate = self.read_limiter.rate
+        if latency > ADAPTIVE_MAX_LATENCY or load > ADAPTIVE_MAX_LOAD:
+            new_rate = max(ADAPTIVE_MIN_RATE, rate / 2)
+        else:
+            new_rate = min(self.max_read_rate or ADAPTIVE_START_RATE, rate * 1.1)
+        if new_rate != rate:
+            log.info('Read latency %.3fs, load %.2f per CPU. Changing the read limit to %.1f MB/s', latency, load,
+                     new_rate / 1024**2)
+            self.read_limiter.rate = new_rate
+        self.window_start = time.monotonic()
+        self.window_reads = 0
+        self.window_read_time = 0.0
+
+    def log_report(self) -> None:
+        """Logs the limits and the throughput achieved since the stats were last reset."""
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        def fmt(rate: Optional[float]) -> str:
+            return 'none' if rate is None else f'{rate / 1024**2:.1f} MB/s'
+        log.info('Read %s bytes at %.1f MB/s (limit %s%s). Wrote %s bytes at %.1f MB/s (limit %s).',
+                 self.bytes_read, self.bytes_read / elapsed / 1024**2, fmt(self.read_limiter.rate),
+                 ', adaptive' if self.adaptive else '', self.bytes_written, self.bytes_written / elapsed / 1024**2,
+                 fmt(self.write_rate))
+
+
+throttle = Throttle()
+
+
+class Metrics:
+    """Holds the values of the METRICS, each of which may have labels, and renders them in the Prometheus text format.
+
+    There is a single instance, `metrics`, which the rest of the code updates and which start_metrics_server serves.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values: Dict[str, Dict[Tuple[Tuple[str, str], ...], float]] = {name: {} for name in METRICS}
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        with self.lock:
+            self.values[name][tuple(sorted(labels.items()))] = value
+
+    def inc(self, name: str, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[name][key] = self.values[name].get(key, 0) + amount
+
+    def start_run(self) -> None:
+        """Resets the RUN_METRICS ready for a new backup."""
+        with self.lock:
+            for name in RUN_METRICS:
+                self.values[name] = {}
+
+    def report(self) -> Dict[str, Any]:
+        """Returns the RUN_METRICS as a dict from name to either the value or, for labeled metrics, a dict from label
+        value to value.
+        """
+        result: Dict[str, Any] = {}
+        with self.lock:
+            for name in sorted(RUN_METRICS):
+                for labels, value in self.values[name].items():
+                    if labels:
+                        result.setdefault(name, {})[','.join(v for _, v in labels)] = value
+                    else:
+                        result[name] = value
+        return result
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for name, (kind, help_text) in METRICS.items():
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in sorted(self.values[name].items()):
+                    label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+                    lines.append(f'{name}{{{label_text}}} {value!r}' if labels else f'{name} {value!r}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('metrics request: ' + format, *args)
+
+
+def start_metrics_server(port: int) -> ThreadingHTTPServer:
+    """Serves the metrics on port, from a daemon thread, and returns the server."""
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    log.info('Serving metrics at http://0.0.0.0:%s/metrics', server.server_address[1])
+    return server
+
+
+def inode_usage(dir: Path) -> Dict[Tuple[int, int], int]:
+    """Returns the disk space used by dir and each file and directory under it keyed by (device, inode), so that files
+    with several hard links under it are only counted once.
+    """
+    st = os.lstat(dir)
+    usage = {(st.st_dev, st.st_ino): st.st_blocks * 512}
+    for root, dirs, files in os.walk(dir):
+        for name in dirs + files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            usage[(st.st_dev, st.st_ino)] = st.st_blocks * 512
+    return usage
+
+
+def disk_usage(dir: Path) -> int:
+    """Returns the disk space used by dir and everything under it, counting files with several hard links once."""
+    return sum(inode_usage(dir).values())
+
+
+class TierUsage:
+    """Works out the disk space used by the backups in a tier, counting data hard linked between them once, without
+    walking every backup each time.
+
+    A backup only shares data with the backups next to it: a file is hard linked from the previous backup (unchanged
+    files with --incremental and tables with --incremental_db, and longs from the shorts they were promoted from) until
+    it changes, and then the next backup gets a new copy that later ones link to instead. So the tier uses the space
+    used by its oldest backup plus, for each later backup, the space used by what isn't in the backup before it. Those
+    are cached, along with the name of the backup before, so only new backups and those after a deleted one are walked.
+    The newest backup's inodes are kept so the next backup can be compared with it without walking it again.
+    """
+    def __init__(self):
+        self.added: Dict[str, Tuple[Optional[str], int]] = {}
+        self.newest: Optional[Tuple[str, Dict[Tuple[int, int], int]]] = None
 
-    now : datetime object
-        The time to use as "now" for calculating item's age.
+    def update(self, backups: List[Path]) -> int:
+        """Returns the disk space used by backups, the list of backups in the tier from get_backup_list."""
+        inodes = dict([self.newest]) if self.newest is not None else {}
 
-    cutoff : timedelta object
-        The age, older than which, we delete the file.
+        def walked(backup: Path) -> Dict[Tuple[int, int], int]:
+            if backup.name not in inodes:
+                inodes[backup.name] = inode_usage(backup)
+            return inodes[backup.name]
+
+        added: Dict[str, Tuple[Optional[str], int]] = {}
+        prev: Optional[Path] = None
+        for backup in backups:
+            prev_name = prev.name if prev is not None else None
+            cached = self.added.get(backup.name)
+            if cached is None or cached[0] != prev_name:
+                before = walked(prev) if prev is not None else {}
+                cached = (prev_name, sum(size for key, size in walked(backup).items() if key not in before))
+            added[backup.name] = cached
+            prev = backup
+        self.added = added
+        self.newest = (prev.name, walked(prev)) if prev is not None else None
+        return sum(size for _, size in added.values())
+
+
+tier_usage = {'short': TierUsage(), 'long': TierUsage()}
+
+
+def update_tier_metrics(chunks: bool = False) -> None:
+    """Sets the metrics describing the backups on disk: how many there are and how much space they use, and when the
+    newest was made.
+
+    The space used by the chunks is only worked out if chunks is set, at start up; ChunkStore keeps it up to date as
+    chunks are added and deleted.
+    """
+    newest: Optional[datetime] = None
+    for tier, dir in (('short', SHORT_DIR), ('long', LONG_DIR)):
+        backups = get_backup_list(dir)
+        metrics.set('wp_bak_snapshots', len(backups), tier=tier)
+        metrics.set('wp_bak_tier_size_bytes', tier_usage[tier].update(backups), tier=tier)
+        if backups:
+            made = datetime.strptime(backups[-1].name, DATE_TIME_FORMAT)
+            newest = made if newest is None else max(newest, made)
+    if chunks and CHUNK_DIR.exists():
+        metrics.set('wp_bak_tier_size_bytes', disk_usage(CHUNK_DIR), tier='chunks')
+    if newest is not None:
+        metrics.set('wp_bak_last_success_timestamp_seconds', newest.timestamp())
+
+
+def write_report(backup_dir: Path, name: str) -> None:
+    """Sets the metrics about the data read and written by the backup named name and writes the run report into
+    backup_dir, the backup's directory before it's published, so it's copied to the longs and the bucket with the rest
+    of the backup. It's rewritten with the phases that run after that by update_report.
+    """
+    metrics.set('wp_bak_bytes_read', throttle.bytes_read)
+    metrics.set('wp_bak_bytes_written', throttle.bytes_written)
+    if throttle.bytes_written > 0:
+        metrics.set('wp_bak_compression_ratio', throttle.bytes_read / throttle.bytes_written)
+    save_report(backup_dir, name)
+
+
+def save_report(backup_dir: Path, name: str) -> None:
+    report = {'backup': name, **metrics.report()}
+    tmp = backup_dir / (REPORT_NAME + '.tmp')
+    with open(tmp, 'wt', encoding='utf-8') as f:
+        json.dump(report, f, indent=1)
+    tmp.rename(backup_dir / REPORT_NAME)
+
+
+def update_report(name: str, replicator: Optional['Replicator']) -> None:
+    """Rewrites the run report of the backup named name once its last phase has finished, so that it includes the
+    phases that ran after it was published (hardlink, prune, replicate and verify). The report is rewritten in the
+    backup's short and, if it was promoted, long directory and, if the backup is there, in the bucket.
+    """
+    backup_dirs = [dir / name for dir in (SHORT_DIR, LONG_DIR) if (dir / name).is_dir()]
+    for backup_dir in backup_dirs:
+        save_report(backup_dir, name)
+    if replicator is not None:
+        # As for replication, the bucket being unreachable doesn't stop the backups.
+        try:
+            for backup_dir in backup_dirs:
+                replicator.replace_file(backup_dir.parent.name, backup_dir, REPORT_NAME)
+        except (S3Error, OSError) as e:
+            log.error('Updating the report in the bucket failed: %s', e)
+
+
+def record_run() -> None:
+    """Updates the metrics once a backup has been made, and retention applied."""
+    metrics.inc('wp_bak_backups_total')
+    update_tier_metrics()
+    metrics.set('wp_bak_last_success_timestamp_seconds', time.time())
+
+
+profile_requested = threading.Event()
+# Held while a phase is being profiled. Only one profiler can be active at a time from Python 3.12 on.
+profile_lock = threading.Lock()
+
+def request_profile(signum: int, frame: Any) -> None:
+    """Signal handler that arranges for the phases of the next backup to be profiled (see run_phase)."""
+    log.info('Profiling the next backup. Stats will be written to %s', PROFILE_DIR)
+    profile_requested.set()
+
+
+def start_profile(name: str) -> Optional[cProfile.Profile]:
+    """Starts profiling the phase name if profile_requested is set and no other phase is being profiled, e.g. the
+    files phase while the database phase, which runs at the same time, is. Returns the profiler, to pass to
+    stop_profile, or None if the phase isn't profiled, including if the profiler can't be started.
+    """
+    if not profile_requested.is_set() or not profile_lock.acquire(blocking=False):
+        return None
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except Exception as e:
+        # E.g. another profiler, not started by us, is already active.
+        profile_lock.release()
+        log.warning('Unable to profile the %s phase: %s', name, e)
+        return None
+    return profile
+
+
+def stop_profile(profile: cProfile.Profile, name: str) -> None:
+    """Stops profile, started by start_profile for the phase name, and saves and logs its stats. Errors are logged
+    rather than raised so that profiling can never fail a backup.
+    """
+    try:
+        profile.disable()
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        path = PROFILE_DIR / f'{datetime.now().strftime(DATE_TIME_FORMAT)}-{name}.prof'
+        profile.dump_stats(path)
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(PROFILE_TOP_N)
+        log.info('Profile of the %s phase, saved to %s:\n%s', name, path, out.getvalue())
+    except Exception as e:
+        log.warning('Unable to save the profile of the %s phase: %s', name, e)
+    finally:
+        profile_lock.release()
+
+
+class ThrottledFile:
+    """Wraps a file of WordPress data so that reading it is subject to throttle's read limit."""
+    def __init__(self, f: BinaryIO):
+        self.f = f
+
+    def read(self, size: int = -1) -> bytes:
+        return throttle.read(self.f, size)
+
+
+def lower_priority() -> None:
+    """Lowers the CPU and, where the kernel allows it, the I/O priority of this process and its future children."""
+    os.nice(10)
+    try:
+        subprocess.run(['ionice', '-c', '2', '-n', '7', '-p', str(os.getpid())], check=True)
+        log.info('Lowered the CPU and I/O priority of the backup')
+    except (OSError, subprocess.CalledProcessError) as e:
+        log.warning('Unable to lower the I/O priority of the backup: %s', e)
+
+
+class BackupCancelled(Exception):
+    """Raised when a backup phase stops early because another phase of the same backup failed."""
+
+
+def walk_tree(start_dir: Path, excludes: Optional[List[Tuple[Pattern, bool]]] = None,
+              cancel: Optional[threading.Event] = None) -> Iterator[Tuple[os.DirEntry, str, os.stat_result]]:
+    """Yields (entry, path relative to start_dir, lstat result) for every file, directory and symlink under start_dir
+    that isn't excluded by excludes (see parse_excludes). Excluded directories aren't descended into. Directories are
+    yielded before their contents. Symlinks are never followed.
+
+    This uses os.scandir which gets the type of each entry from the directory listing itself so the only other system
+    call per entry is the single lstat whose result we yield. Directories or files that can't be read are logged and
+    skipped.
+
+    If cancel is set the walk stops with a BackupCancelled exception. The time spent walking, not counting the time the
+    caller spends on each entry, is added to the walk phase's metric.
+    """
+    excludes = excludes or []
+    to_add = [start_dir]
+    walk_time = 0.0
+    resumed = time.monotonic()
+    try:
+        while len(to_add) > 0:
+            if cancel is not None and cancel.is_set():
+                raise BackupCancelled()
+            cur_dir = to_add.pop()
+            try:
+                with os.scandir(cur_dir) as it:
+                    entries = list(it)
+            except Exception as e:
+                log.warning('Error handling directory %s: %s. It will not be saved in the backup.', cur_dir, e)
+                metrics.inc('wp_bak_files_skipped', reason='error')
+                continue
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    rel = os.path.relpath(entry.path, start_dir)
+                    if is_excluded(rel.replace(os.sep, '/'), is_dir, excludes):
+                        metrics.inc('wp_bak_files_skipped', reason='excluded')
+                        continue
+                    st = entry.stat(follow_symlinks=False)
+                except Exception as e:
+                    log.warning('Error handling file or directory %s: %s. It will not be saved in the backup.',
+                                entry.path, e)
+                    metrics.inc('wp_bak_files_skipped', reason='error')
+                    continue
+                if is_dir:
+                    to_add.append(Path(entry.path))
+                walk_time += time.monotonic() - resumed
+                yield entry, rel, st
+                resumed = time.monotonic()
+        walk_time += time.monotonic() - resumed
+    finally:
+        metrics.inc('wp_bak_phase_duration_seconds', walk_time, phase='walk')
+
+
+_uname_cache: Dict[int, str] = {}
+_gname_cache: Dict[int, str] = {}
+
+def make_tarinfo(path: str, st: os.stat_result) -> Optional[tarfile.TarInfo]:
+    """Builds the TarInfo for the file at path from its lstat result, st, so that it doesn't need to be stat'ed again.
+
+    This mirrors what TarFile.gettarinfo does except that hard links are stored as regular files and user and group
+    name lookups are cached. Returns None for special files (fifos, devices, etc.) which we don't back up.
+    """
+    info = tarfile.TarInfo(path.replace(os.sep, '/').lstrip('/'))
+    if stat.S_ISREG(st.st_mode):
+        info.type = tarfile.REGTYPE
+        info.size = st.st_size
+    elif stat.S_ISDIR(st.st_mode):
+        info.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(st.st_mode):
+        info.type = tarfile.SYMTYPE
+        info.linkname = os.readlink(path)
+    else:
+        return None
+    info.mode = st.st_mode & 0o7777
+    info.uid = st.st_uid
+    info.gid = st.st_gid
+    info.mtime = st.st_mtime
+    if st.st_uid not in _uname_cache:
+        try:
+            _uname_cache[st.st_uid] = pwd.getpwuid(st.st_uid).pw_name
+        except KeyError:
+            _uname_cache[st.st_uid] = ''
+    if st.st_gid not in _gname_cache:
+        try:
+            _gname_cache[st.st_gid] = grp.getgrgid(st.st_gid).gr_name
+        except KeyError:
+            _gname_cache[st.st_gid] = ''
+    info.uname = _uname_cache[st.st_uid]
+    info.gname = _gname_cache[st.st_gid]
+    return info
+
+
+class HashingWriter:
+    """Wraps a binary file, computing the sha256 and size of everything written through it, so a backup file's checksum
+    is known as soon as it's been written without reading it back. out may be replaced to carry on hashing into another
+    file, e.g. one that's being appended to.
+    """
+    def __init__(self, out: Optional[BinaryIO] = None):
+        self.out = out
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.out.write(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def checksum(self) -> Dict[str, Any]:
+        """Returns the record for CHECKSUMS_NAME."""
+        return {'sha256': self.sha256.hexdigest(), 'size': self.size}
+
+
+def start_copier(src: BinaryIO, out: HashingWriter, close: bool = False) -> threading.Thread:
+    """Starts a thread copying src, e.g. the stdout of a compressor, to out until EOF, then closing src, and returns it.
+    If close is set the file wrapped by out is closed too once everything has been copied.
+    """
+    def copy():
+        with src:
+            while True:
+                buf = src.read(COPY_BUF_SIZE)
+                if not buf:
+                    break
+                out.write(buf)
+                throttle.wrote(len(buf))
+        if close:
+            out.out.close()
+    thread = threading.Thread(target=copy, daemon=True)
+    thread.start()
+    return thread
+
+
+class ParallelGzipWriter:
+    """A write-only file object that gzips what is written to it, using several threads, and writes the result to out.
+
+    The data is cut into blocks of block_size which are compressed independently on a thread pool (zlib releases the
+    GIL while compressing) and written to out, in order, as separate gzip members. At most 2 blocks per thread are
+    held in memory at once.
+
+    Since each member can be decompressed on its own, the (uncompressed offset, compressed offset) of the start of
+    each block is kept in blocks so that a reader can seek straight to the block holding any given offset.
+    """
+    def __init__(self, out: BinaryIO, threads: int, level: int = 6, block_size: int = GZIP_BLOCK_SIZE):
+        self.out = out
+        self.threads = threads
+        self.level = level
+        self.block_size = block_size
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.pending: Deque[Tuple[int, Future]] = deque()
+        self.buf = bytearray()
+        self.blocks: List[Tuple[int, int]] = []
+        self.uncompressed_offset = 0
+        self.compressed_offset = 0
+
+    def write(self, data: bytes) -> int:
+        self.buf += data
+        while len(self.buf) >= self.block_size:
+            self._submit(bytes(self.buf[:self.block_size]))
+            del self.buf[:self.block_size]
+        return len(data)
+
+    def _submit(self, block: bytes) -> None:
+        self.pending.append((self.uncompressed_offset, self.pool.submit(self._compress, block)))
+        self.uncompressed_offset += len(block)
+        while len(self.pending) > 2 * self.threads:
+            self._write_oldest()
+
+    def _compress(self, block: bytes) -> bytes:
+        start = time.monotonic()
+        compressed = gzip.compress(block, self.level, mtime=0)
+        metrics.inc('wp_bak_phase_duration_seconds', time.monotonic() - start, phase='compress')
+        return compressed
+
+    def _write_oldest(self) -> None:
+        uncompressed_offset, future = self.pending.popleft()
+        compressed = future.result()
+        self.blocks.append((uncompressed_offset, self.compressed_offset))
+        self.out.write(compressed)
+        throttle.wrote(len(compressed))
+        self.compressed_offset += len(compressed)
+
+    def close(self) -> None:
+        """Compresses and writes any remaining data. This does not close out."""
+        if len(self.buf) > 0:
+            self._submit(bytes(self.buf))
+            self.buf = bytearray()
+        while len(self.pending) > 0:
+            self._write_oldest()
+        self.pool.shutdown()
+
+
+def is_incompressible(path: str, size: int) -> bool:
+    """Returns True if the file at path, which is size bytes long, looks like it's already compressed.
+
+    See INCOMPRESSIBLE_EXTENSIONS for details.
+    """
+    if os.path.splitext(path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return True
+    if size < ENTROPY_SAMPLE_SIZE:
+        return False
+    with open(path, 'rb') as f:
+        sample = f.read(ENTROPY_SAMPLE_SIZE)
+    return len(zlib.compress(sample, 1)) >= INCOMPRESSIBLE_RATIO * len(sample)
+
+
+class StoredTarWriter:
+    """Writes an uncompressed tarball, copying the contents of files into it a buffer at a time so that they're hashed
+    (see checksum) on the way through without a copy being made.
     """
-    backups = get_backup_list(dir)
-    for backup in backups:
-        if dirname2age(now, backup.name) >= cutoff:
-            # Delete the file
-            log.info('Deleting aged backup - %s', backup)
-            shutil.rmtree(backup)
+    def __init__(self, path: Path):
+        self.out = open(path, 'wb', buffering=0)
+        self.offset = 0
+        self.sha256 = hashlib.sha256()
+        self.buf = bytearray(COPY_BUF_SIZE)
+
+    def _write(self, data: Union[bytes, memoryview]) -> None:
+        # The file is unbuffered and os.write may write less than asked.
+        view = memoryview(data)
+        while view:
+            written = self.out.write(view)
+            view = view[written:]
+        self.sha256.update(data)
+        throttle.wrote(len(data))
+        self.offset += len(data)
+
+    def checksum(self) -> Dict[str, Any]:
+        """Returns the record for CHECKSUMS_NAME."""
+        return {'sha256': self.sha256.hexdigest(), 'size': self.offset}
+
+    def add(self, path: str, info: tarfile.TarInfo) -> int:
+        """Adds the file at path, described by info (see make_tarinfo), to the tarball and returns the offset of its
+        data in the tarball.
+        """
+        if not info.isreg():
+            self._write(info.tobuf(tarfile.DEFAULT_FORMAT, 'utf-8', 'surrogateescape'))
+            return self.offset
+        with open(path, 'rb') as f:
+            self._write(info.tobuf(tarfile.DEFAULT_FORMAT, 'utf-8', 'surrogateescape'))
+            data_offset = self.offset
+            copied = 0
+            view = memoryview(self.buf)
+            while copied < info.size:
+                start = time.monotonic()
+                num_read = f.readinto(view[:min(COPY_BUF_SIZE, info.size - copied)])
+                if not num_read:
+                    break
+                throttle.transferred(num_read, time.monotonic() - start)
+                self._write(view[:num_read])
+                copied += num_read
+        if copied < info.size:
+            # The file shrank after we wrote its header so we pad it with zeros to keep the tarball valid.
+            log.warning('%s was truncated while being backed up. Padding it with zeros.', path)
+            self._write(bytes(info.size - copied))
+        remainder = info.size % tarfile.BLOCKSIZE
+        if remainder > 0:
+            self._write(bytes(tarfile.BLOCKSIZE - remainder))
+        return data_offset
 
-def create_tarfile(tar_path: Path, start_dir: Path) -> None:
+    def close(self) -> None:
+        # A tarball ends with 2 empty blocks and is padded to a multiple of the record size.
+        self._write(bytes(2 * tarfile.BLOCKSIZE))
+        remainder = self.offset % tarfile.RECORDSIZE
+        if remainder > 0:
+            self._write(bytes(tarfile.RECORDSIZE - remainder))
+        self.out.close()
+
+
+def create_tarfile(tar_path: Path, start_dir: Path, codec: str = 'gzip', level: Optional[int] = None,
+                   threads: int = 1, stored_tar_path: Optional[Path] = None,
+                   excludes: Optional[List[Tuple[Pattern, bool]]] = None,
+                   catalog_path: Optional[Path] = None, cancel: Optional[threading.Event] = None) -> Dict[str, int]:
     """Recursively tars up start_dir and adds all the files in it to the tarball that will be created at tar_path.
 
+    The tarball is compressed with codec using up to threads CPUs. For gzip that's done by a ParallelGzipWriter, and
+    for zstd by the zstd command which is multi-threaded itself. If stored_tar_path is given, files that are already
+    compressed (see is_incompressible) are instead added, uncompressed, to a tarball at stored_tar_path.
+
+    Returns the number of files and bytes that were compressed and that were stored uncompressed.
+
+    Files and directories matching excludes (see parse_excludes) are skipped. The tree is walked with walk_tree and the
+    stat results it returns are used to build the tar headers so each file is only stat'ed once.
+
+    If catalog_path is given a catalog of the files, and of the gzip blocks, is written there. See CATALOG_NAME.
+
+    The returned stats include the sha256 and size of each archive, under checksums, for CHECKSUMS_NAME.
+
+    If cancel is set the backup stops early with a BackupCancelled exception.
+
     Note that you can simply add the main directory to the tarball and it will handle recursively adding all the files
     under it. However, if adding any single file fails that the entire tarball creation fails and we don't want that.
     For example, there are lost+found directories owned by root that we can't read, a user might manually create some
     files with bad permissions, etc. so we want to log any files we skip but we still want to back up what we can. We
     therefore manually add each file in a try/catch block.
     """
-    tar = tarfile.open(tar_path, mode='w:gz')
-    to_add = [start_dir]
-    while len(to_add) > 0:
-        cur_dir = to_add.pop()
+    if level is None:
+        level = COMPRESSORS[codec]['default_level']
+    out = HashingWriter(open(tar_path, 'wb'))
+    compressor: Optional[subprocess.Popen] = None
+    writer: Any = None
+    stored: Optional[StoredTarWriter] = None
+    catalog = None
+    catalog_tmp: Optional[Path] = None
+    try:
+        if codec == 'gzip':
+            writer = ParallelGzipWriter(out, threads, level)
+        else:
+            compressor = subprocess.Popen(compressor_command(codec, level, threads), stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE)
+            copier = start_copier(compressor.stdout, out)
+            writer = compressor.stdin
+        tar = tarfile.open(fileobj=writer, mode='w|')
+        if stored_tar_path is not None:
+            stored = StoredTarWriter(stored_tar_path)
+        stats = {'compressed_files': 0, 'compressed_bytes': 0, 'stored_files': 0, 'stored_bytes': 0}
+        if catalog_path is not None:
+            catalog_tmp = catalog_path.with_name(catalog_path.name + '.tmp')
+            if catalog_tmp.exists():
+                catalog_tmp.unlink()
+            catalog = sqlite3.connect(str(catalog_tmp))
+            catalog.executescript(CATALOG_SCHEMA)
+        for entry, rel, st in walk_tree(start_dir, excludes, cancel):
+            if entry.is_dir(follow_symlinks=False):
+                continue
+            try:
+                info = make_tarinfo(entry.path, st)
+                if info is None:
+                    log.warning('Skipping special file %s', entry.path)
+                    metrics.inc('wp_bak_files_skipped', reason='special')
+                    continue
+                if stored is not None and info.isreg() and is_incompressible(entry.path, info.size):
+                    archive = stored_tar_path.name
+                    data_offset = stored.add(entry.path, info)
+                    stats['stored_files'] += 1
+                    stats['stored_bytes'] += info.size
+                else:
+                    archive = tar_path.name
+                    if info.isreg():
+                        with open(entry.path, 'rb') as f:
+                            tar.addfile(info, ThrottledFile(f))
+                    else:
+                        tar.addfile(info)
+                    # The data ends at the current offset, padded to a multiple of the tar block size.
+                    data_offset = tar.offset - -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                    stats['compressed_files'] += 1
+                    stats['compressed_bytes'] += info.size
+                if catalog is not None:
+                    catalog.execute('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (rel, archive, 'link' if info.issym() else 'file', data_offset, info.size,
+                                     int(info.mtime), info.mode, info.linkname or None))
+            except Exception as e:
+                log.warning('Error handling file or directory %s: %s. It will not be saved in the backup.',
+                            entry.path, e)
+                metrics.inc('wp_bak_files_skipped', reason='error')
+        tar.close()
+        writer.close()
+        if compressor is not None:
+            rc = compressor.wait()
+            copier.join()
+            if rc != 0:
+                raise subprocess.CalledProcessError(rc, compressor.args)
+        out.out.close()
+        stats['checksums'] = {tar_path.name: out.checksum()}
+        if stored is not None:
+            stored.close()
+            stats['checksums'][stored_tar_path.name] = stored.checksum()
+        if catalog is not None:
+            if isinstance(writer, ParallelGzipWriter):
+                catalog.executemany('INSERT INTO blocks VALUES (?, ?, ?)',
+                                    ((tar_path.name, u, c) for u, c in writer.blocks))
+            catalog.commit()
+            catalog.close()
+            catalog_tmp.rename(catalog_path)
+    except BaseException:
+        # Like dump_db, don't leave a truncated tarball or catalog behind, e.g. when the backup is cancelled.
+        if compressor is not None:
+            compressor.kill()
+            try:
+                compressor.stdin.close()
+            except OSError:
+                pass
+            compressor.wait()
+            copier.join()
+        elif writer is not None:
+            writer.pool.shutdown()
+        if stored is not None:
+            stored.out.close()
+        if catalog is not None:
+            catalog.close()
+        out.out.close()
+        for path in (tar_path, stored_tar_path, catalog_tmp):
+            if path is not None and path.exists():
+                path.unlink()
+        raise
+    log.info('Compressed %s files (%s bytes), stored %s already compressed files (%s bytes) uncompressed',
+             stats['compressed_files'], stats['compressed_bytes'], stats['stored_files'], stats['stored_bytes'])
+    return stats
+
+
+def codec_for_archive(archive: Path) -> Optional[str]:
+    """Returns the codec from COMPRESSORS used to compress archive, based on its extension, or None if it isn't."""
+    for codec, info in COMPRESSORS.items():
+        if archive.name.endswith(info['extension']):
+            return codec
+    return None
+
+
+def copy_bytes(src: BinaryIO, out: BinaryIO, size: int) -> None:
+    """Copies size bytes from src to out, or discards them if out is None."""
+    while size > 0:
+        buf = src.read(min(size, COPY_BUF_SIZE))
+        if not buf:
+            raise EOFError('Unexpected end of archive')
+        if out is not None:
+            out.write(buf)
+        size -= len(buf)
+
+
+def extract_member_data(archive: Path, blocks: List[Tuple[int, int]], data_offset: int, size: int,
+                        out: BinaryIO) -> None:
+    """Writes the size bytes starting at data_offset in the uncompressed archive to out.
+
+    blocks is a sorted list of (uncompressed offset, compressed offset) of independently compressed blocks of a gzip
+    archive (see ParallelGzipWriter) and lets us start decompressing at the block holding data_offset rather than at
+    the start of the archive. Uncompressed archives are simply seeked.
+    """
+    codec = codec_for_archive(archive)
+    if codec is None:
+        with open(archive, 'rb') as f:
+            f.seek(data_offset)
+            copy_bytes(f, out, size)
+    elif codec == 'gzip':
+        i = bisect_right([b[0] for b in blocks], data_offset) - 1
+        uncompressed_offset, compressed_offset = blocks[i] if i >= 0 else (0, 0)
+        with open(archive, 'rb') as f:
+            f.seek(compressed_offset)
+            with gzip.GzipFile(fileobj=f, mode='rb') as gz:
+                copy_bytes(gz, None, data_offset - uncompressed_offset)
+                copy_bytes(gz, out, size)
+    else:
+        with subprocess.Popen(COMPRESSORS[codec]['decompress'] + [str(archive)], stdout=subprocess.PIPE) as proc:
+            try:
+                copy_bytes(proc.stdout, None, data_offset)
+                copy_bytes(proc.stdout, out, size)
+            finally:
+                proc.kill()
+
+
+def snapshot_entries(snapshot_dir: Path) -> Iterator[dict]:
+    """Yields a dict with the path, type ('file' or 'link'), size and mtime of every file in a backup of any kind.
+
+    This uses the catalog, manifest or index of the backup so no archive is opened.
+    """
+    if (snapshot_dir / CATALOG_NAME).exists():
+        with sqlite3.connect(str(snapshot_dir / CATALOG_NAME)) as catalog:
+            for path, type, size, mtime in catalog.execute('SELECT path, type, size, mtime FROM files ORDER BY path'):
+                yield {'path': path, 'type': type, 'size': size, 'mtime': mtime}
+    elif (snapshot_dir / MANIFEST_NAME).exists():
+        for record in read_manifest(snapshot_dir).values():
+            if 'link' in record:
+                yield {'path': record['path'], 'type': 'link', 'size': 0, 'mtime': None}
+            else:
+                yield {'path': record['path'], 'type': 'file', 'size': record['size'],
+                       'mtime': record['mtime_ns'] // 10**9}
+    elif (snapshot_dir / SNAPSHOT_INDEX_NAME).exists():
+        for record in read_snapshot_index(snapshot_dir):
+            if record['type'] in ('file', 'link'):
+                yield {'path': record['path'], 'type': record['type'], 'size': record.get('size', 0),
+                       'mtime': record['mtime_ns'] // 10**9 if 'mtime_ns' in record else None}
+
+
+def path_matches(path: str, wanted: str) -> bool:
+    """Returns True if path is wanted or is under the directory wanted."""
+    wanted = wanted.strip('/')
+    return path == wanted or path.startswith(wanted + '/')
+
+
+def restore_path(snapshot_dir: Path, wanted: str, dest: Path) -> int:
+    """Restores the file, or all the files under the directory, wanted (relative to SRC_DIR) from the backup in
+    snapshot_dir to the same relative location under dest. Returns the number of files restored.
+
+    For tar backups only the compressed blocks holding the wanted files are decompressed (see extract_member_data).
+    """
+    restored = 0
+    if (snapshot_dir / CATALOG_NAME).exists():
+        with sqlite3.connect(str(snapshot_dir / CATALOG_NAME)) as catalog:
+            blocks: Dict[str, List[Tuple[int, int]]] = {}
+            for archive, u, c in catalog.execute('SELECT * FROM blocks ORDER BY archive, uncompressed_offset'):
+                blocks.setdefault(archive, []).append((u, c))
+            wanted = wanted.strip('/')
+            rows = catalog.execute(
+                'SELECT path, archive, type, data_offset, size, mtime, mode, linkname FROM files '
+                'WHERE path = ? OR substr(path, 1, ?) = ? ORDER BY archive, data_offset',
+                (wanted, len(wanted) + 1, wanted + '/')).fetchall()
+        for path, archive, type, data_offset, size, mtime, mode, linkname in rows:
+            out_path = dest / path
+            out_path.parent.mkdir(parents=True, exist_ok=True)
+            if type == 'link':
+                os.symlink(linkname, out_path)
+            else:
+                with open(out_path, 'wb') as out:
+                    extract_member_data(snapshot_dir / archive, blocks.get(archive, []), data_offset, size, out)
+                os.chmod(out_path, mode)
+                os.utime(out_path, (mtime, mtime))
+            restored += 1
+    elif (snapshot_dir / MANIFEST_NAME).exists():
+        for path, record in read_manifest(snapshot_dir).items():
+            if path_matches(path, wanted):
+                out_path = dest / path
+                out_path.parent.mkdir(parents=True, exist_ok=True)
+                if 'link' in record:
+                    os.symlink(record['link'], out_path)
+                else:
+                    shutil.copy2(snapshot_dir / FILES_DIR_NAME / path, out_path)
+                restored += 1
+    elif (snapshot_dir / SNAPSHOT_INDEX_NAME).exists():
+        store = ChunkStore(CHUNK_DIR)
+        for record in read_snapshot_index(snapshot_dir):
+            if record['type'] in ('file', 'link') and path_matches(record['path'], wanted):
+                out_path = dest / record['path']
+                out_path.parent.mkdir(parents=True, exist_ok=True)
+                if record['type'] == 'link':
+                    os.symlink(record['target'], out_path)
+                else:
+                    with open(out_path, 'wb') as out:
+                        store.write_chunks(record['chunks'], out)
+                    os.chmod(out_path, record['mode'])
+                    os.utime(out_path, ns=(record['mtime_ns'], record['mtime_ns']))
+                restored += 1
+    else:
+        raise ValueError(f'{snapshot_dir} has no catalog, manifest or index')
+    return restored
+
+
+def all_snapshots() -> Dict[str, Path]:
+    """Returns a dict from the name of every backup, short or long, to its directory. Since long backups are hard
+    linked copies of short ones the short one is returned if there are both.
+    """
+    snapshots = {}
+    for backup_dir in get_backup_list(LONG_DIR) + get_backup_list(SHORT_DIR):
+        snapshots[backup_dir.name] = backup_dir
+    return dict(sorted(snapshots.items()))
+
+
+def find_file_versions(wanted: str) -> List[Tuple[str, int, dict]]:
+    """Returns (snapshot name, version number, entry as returned by snapshot_entries) for every backup containing the
+    file wanted. The version number starts at 1 and goes up each time the file's size or mtime changes from one
+    backup to the next.
+    """
+    wanted = wanted.strip('/')
+    result = []
+    version = 0
+    last = None
+    for name, snapshot_dir in all_snapshots().items():
+        if (snapshot_dir / CATALOG_NAME).exists():
+            # A quick lookup by primary key rather than a scan of every file.
+            with sqlite3.connect(str(snapshot_dir / CATALOG_NAME)) as catalog:
+                row = catalog.execute('SELECT path, type, size, mtime FROM files WHERE path = ?', (wanted,)).fetchone()
+            entry = dict(zip(('path', 'type', 'size', 'mtime'), row)) if row is not None else None
+        else:
+            entry = next((e for e in snapshot_entries(snapshot_dir) if e['path'] == wanted), None)
+        if entry is None:
+            continue
+        if (entry['size'], entry['mtime']) != last:
+            version += 1
+            last = (entry['size'], entry['mtime'])
+        result.append((name, version, entry))
+    return result
+
+
+class HashingReader:
+    """Wraps a binary file, computing the sha256 and size of everything read through it."""
+    def __init__(self, f: BinaryIO):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.f.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+    def drain(self) -> None:
+        """Reads, and so hashes, the rest of the file."""
+        while self.read(COPY_BUF_SIZE):
+            pass
+
+
+def feed_process(src: HashingReader, proc: subprocess.Popen) -> threading.Thread:
+    """Starts a thread writing all of src to proc's stdin, then closing it, and returns it."""
+    def feed():
         try:
-            for file_or_dir in cur_dir.iterdir():
+            while True:
+                buf = src.read(COPY_BUF_SIZE)
+                if not buf:
+                    break
+                proc.stdin.write(buf)
+        except BrokenPipeError:
+            # The process gave up on corrupt data. Carry on reading so the whole file is hashed.
+            src.drain()
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+    thread = threading.Thread(target=feed, daemon=True)
+    thread.start()
+    return thread
+
+
+def verify_archive(path: Path, expected: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Checks that the archive or database dump at path can be read to the end and, if expected (its record from
+    CHECKSUMS_NAME) is given, that its sha256 and size match.
+
+    The file is read once: it's hashed as it's decompressed and, for a tarball, as every member is read. Returns a
+    result dict with the file, whether it's ok and, if not, the error and the tar member being read when it happened.
+    """
+    result: Dict[str, Any] = {'file': str(path), 'ok': True, 'error': None, 'member': None}
+    codec = codec_for_archive(path)
+    member = None
+    with open(path, 'rb') as raw:
+        reader = HashingReader(raw)
+        proc: Optional[subprocess.Popen] = None
+        feeder: Optional[threading.Thread] = None
+        try:
+            stream: Any = reader
+            if codec == 'gzip':
+                stream = gzip.GzipFile(fileobj=reader, mode='rb')
+            elif codec is not None:
+                proc = subprocess.Popen(COMPRESSORS[codec]['decompress'], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                feeder = feed_process(reader, proc)
+                stream = proc.stdout
+            if '.tar' in path.name:
+                with tarfile.open(fileobj=stream, mode='r|') as tar:
+                    for info in tar:
+                        member = info.name
+                        if info.isreg():
+                            data = tar.extractfile(info)
+                            while data.read(COPY_BUF_SIZE):
+                                pass
+                    member = None
+            while stream.read(COPY_BUF_SIZE):
+                pass
+            if proc is not None:
+                feeder.join()
+                if proc.wait() != 0:
+                    raise OSError(proc.stderr.read().decode('utf-8', 'replace').strip() or 'decompression failed')
+        except (OSError, EOFError, tarfile.TarError, zlib.error) as e:
+            result.update(ok=False, error=f'{type(e).__name__}: {e}', member=member)
+        finally:
+            if proc is not None:
+                proc.kill()
+                feeder.join()
+                proc.wait()
+                proc.stdout.close()
+                proc.stderr.close()
+        reader.drain()
+    if result['ok'] and expected is not None:
+        if reader.size != expected['size']:
+            result.update(ok=False, error=f'size is {reader.size}, expected {expected["size"]}')
+        elif reader.sha256.hexdigest() != expected['sha256']:
+            result.update(ok=False, error='sha256 does not match the checksum recorded when it was written')
+    return result
+
+
+def verify_incremental_snapshot(snapshot_dir: Path) -> List[Dict[str, Any]]:
+    """Checks every file in an incremental snapshot against the sha256 in its manifest. Returns a result, as for
+    verify_archive, for each file that doesn't match and one for the snapshot as a whole.
+    """
+    results = []
+    for rel, record in read_manifest(snapshot_dir).items():
+        if record.get('sha256') is None:
+            continue
+        path = snapshot_dir / FILES_DIR_NAME / rel
+        try:
+            with open(path, 'rb') as f:
+                reader = HashingReader(f)
+                reader.drain()
+            error = None if reader.sha256.hexdigest() == record['sha256'] else 'sha256 does not match the manifest'
+        except OSError as e:
+            error = f'{type(e).__name__}: {e}'
+        if error is not None:
+            results.append({'file': str(path), 'ok': False, 'error': error, 'member': None})
+    results.append({'file': str(snapshot_dir / MANIFEST_NAME), 'ok': True, 'error': None, 'member': None})
+    return results
+
+
+def verify_repository_snapshot(snapshot_dir: Path, chunk_dir: Path) -> List[Dict[str, Any]]:
+    """Checks that every chunk used by a repository snapshot is in the store and that its contents still hash to its
+    id. Returns a result for each file, or the database dump, with a bad chunk and one for the snapshot as a whole.
+    """
+    store = ChunkStore(chunk_dir)
+    bad: Dict[str, str] = {}
+    checked: Set[str] = set()
+    results = []
+    for record in read_snapshot_index(snapshot_dir):
+        for chunk_id in record.get('chunks', []):
+            if chunk_id not in checked:
+                checked.add(chunk_id)
                 try:
-                    if file_or_dir.is_dir():
-                        to_add.append(file_or_dir)
-                    else:
-                        tar.add(str(file_or_dir))
-                except Exception as e:
-                    log.warning('Error handling file or directory %s: %s. It will not be saved in the backup.',
-                                file_or_dir, e)
-        except Exception as e:
-            log.warning('Error handling directory %s: %s. It will not be saved in the backup.', cur_dir, e)
-    tar.close()
+                    if hashlib.sha256(store.get(chunk_id)).hexdigest() != chunk_id:
+                        bad[chunk_id] = 'contents do not match the chunk id'
+                except (OSError, zlib.error) as e:
+                    bad[chunk_id] = f'{type(e).__name__}: {e}'
+            if chunk_id in bad:
+                name = record.get('path', 'database dump')
+                results.append({'file': str(snapshot_dir / SNAPSHOT_INDEX_NAME), 'ok': False,
+                                'error': f'chunk {chunk_id}: {bad[chunk_id]}', 'member': name})
+                break
+    results.append({'file': str(snapshot_dir / SNAPSHOT_INDEX_NAME), 'ok': True, 'error': None, 'member': None})
+    return results
+
+
+def verify_tasks(snapshot_dir: Path) -> List[Tuple[Callable[..., Any], tuple]]:
+    """Returns the (function, args) calls that verify the backup in snapshot_dir. Each returns a result dict, or a list
+    of them, and they can be run in parallel.
+    """
+    if (snapshot_dir / SNAPSHOT_INDEX_NAME).exists():
+        return [(verify_repository_snapshot, (snapshot_dir, CHUNK_DIR))]
+    if (snapshot_dir / MANIFEST_NAME).exists():
+        return [(verify_incremental_snapshot, (snapshot_dir,))]
+    checksums_path = snapshot_dir / CHECKSUMS_NAME
+    if checksums_path.exists():
+        with open(checksums_path, 'rt', encoding='utf-8') as f:
+            checksums = json.load(f)
+        return [(verify_archive, (snapshot_dir / rel, record)) for rel, record in sorted(checksums.items())]
+    # Backups made before checksums were recorded can still be checked for corrupt or truncated data.
+    archives = (list(snapshot_dir.glob('files*.tar*')) + list(snapshot_dir.glob('dbdump.sql*')) +
+                list((snapshot_dir / DB_PARTS_DIR_NAME).glob('*.sql*')))
+    return [(verify_archive, (path, None)) for path in sorted(archives)]
+
+
+def run_verify_task(snapshot: str, fn: Callable[..., Any], args: tuple) -> List[Dict[str, Any]]:
+    results = fn(*args)
+    results = results if isinstance(results, list) else [results]
+    for result in results:
+        result['snapshot'] = snapshot
+    return results
+
+
+def verify_snapshots(snapshots: Dict[str, Path], workers: int, low_priority: bool = False) -> Dict[str, Any]:
+    """Verifies snapshots, a dict from backup name to directory, using a pool of workers processes and returns a
+    summary with a result for every file that isn't ok.
+
+    The files are independent so they're checked in parallel; decompression is CPU bound so we use processes rather
+    than threads. With low_priority the workers lower their CPU and I/O priority first so they don't slow down the site.
+    """
+    start = time.monotonic()
+    failures = []
+    num_ok = 0
+    # The sidecar has threads running (the metrics server, the reclaimer) by the time it verifies, and forking a process
+    # with threads can deadlock it, so the workers are started afresh.
+    with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=multiprocessing.get_context('spawn'),
+                             initializer=lower_priority if low_priority else None) as pool:
+        futures = [pool.submit(run_verify_task, name, fn, args)
+                   for name, snapshot_dir in snapshots.items() for fn, args in verify_tasks(snapshot_dir)]
+        for future in as_completed(futures):
+            for result in future.result():
+                if result['ok']:
+                    num_ok += 1
+                else:
+                    log.error('%s is corrupt: %s%s', result['file'], result['error'],
+                              f' (at {result["member"]})' if result['member'] else '')
+                    failures.append(result)
+    summary = {'finished_at': time.time(), 'duration': time.monotonic() - start, 'snapshots': len(snapshots),
+               'ok': num_ok, 'corrupt': len(failures),
+               'corrupt_snapshots': sorted({r['snapshot'] for r in failures}), 'failures': failures}
+    log.info('Verified %s backups in %.1f seconds: %s files ok, %s corrupt', len(snapshots), summary['duration'],
+             num_ok, len(failures))
+    return summary
+
+
+def verify_due(now: float, verify_freq: Optional[timedelta]) -> bool:
+    """Returns True if it's time to verify the backups again, given the unix time now and --verify_freq."""
+    if verify_freq is None:
+        return False
+    summary = load_verify_summary()
+    return summary is None or now - summary['finished_at'] >= verify_freq.total_seconds()
+
+
+def verify_all_snapshots() -> None:
+    """Verifies all the backups at low priority and saves the results, for the sidecar's scheduled verification."""
+    save_verify_summary(verify_snapshots(all_snapshots(), available_cpus(), low_priority=True))
+
+
+def save_verify_summary(summary: Dict[str, Any]) -> None:
+    """Saves the summary from verify_snapshots to VERIFY_STATE_PATH and exports it in the metrics."""
+    tmp = VERIFY_STATE_PATH.with_name(VERIFY_STATE_PATH.name + '.tmp')
+    with open(tmp, 'wt', encoding='utf-8') as f:
+        json.dump(summary, f, indent=1)
+    tmp.rename(VERIFY_STATE_PATH)
+    update_verify_metrics(summary)
+
+
+def load_verify_summary() -> Optional[Dict[str, Any]]:
+    """Returns the summary saved by save_verify_summary, or None if there isn't one."""
+    try:
+        with open(VERIFY_STATE_PATH, 'rt', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def update_verify_metrics(summary: Dict[str, Any]) -> None:
+    metrics.set('wp_bak_verify_last_run_timestamp_seconds', summary['finished_at'])
+    metrics.set('wp_bak_verify_duration_seconds', summary['duration'])
+    metrics.set('wp_bak_verify_files', summary['ok'], result='ok')
+    metrics.set('wp_bak_verify_files', summary['corrupt'], result='corrupt')
+    metrics.set('wp_bak_verify_corrupt_snapshots', len(summary['corrupt_snapshots']))
+
+
+def parse_command_args(argv: List[str]) -> argparse.Namespace:
+    """Parses the arguments for the commands in COMMANDS."""
+    parser = argparse.ArgumentParser(description='Lists and restores files from WordPress backups')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    list_parser = subparsers.add_parser('list', help='With no arguments, lists all backups. With --snapshot, lists the '
+                                        'files in that backup. With --path, lists every backup containing that file.')
+    list_parser.add_argument('--snapshot', help='The name (timestamp) of the backup to list.')
+    list_parser.add_argument('--path', help='A file path, relative to the WordPress root, to find in all backups.')
+    restore_parser = subparsers.add_parser('restore', help='Restores a file or directory from a backup.')
+    restore_parser.add_argument('--snapshot', required=True, help='The name (timestamp) of the backup to restore from.')
+    restore_parser.add_argument('--path', required=True,
+                                help='The file or directory, relative to the WordPress root, to restore.')
+    restore_parser.add_argument('--to', required=True, type=Path,
+                                help='The directory to restore to. The file is written to the same relative path '
+                                'under this directory.')
+    verify_parser = subparsers.add_parser('verify', help='Checks that backups can be read in full and match the '
+                                          'checksums recorded when they were made. Exits with status 1 if any are '
+                                          'corrupt.')
+    verify_parser.add_argument('--snapshot', help='The name (timestamp) of the backup to verify. Default is all of '
+                               'them.')
+    verify_parser.add_argument('--workers', type=int, default=available_cpus(),
+                               help='How many processes to verify with. Default is the number of CPUs available.')
+    verify_parser.add_argument('--low_priority', action='store_true', default=False,
+                               help='Lower the CPU and I/O priority of the verification.')
+    return parser.parse_args(argv)
+
+
+def run_command(args: argparse.Namespace) -> None:
+    """Runs one of the COMMANDS, printing its results to stdout."""
+    snapshots = all_snapshots()
+    if args.command == 'list' and args.path is not None:
+        for name, version, entry in find_file_versions(args.path):
+            mtime = datetime.fromtimestamp(entry['mtime']) if entry['mtime'] is not None else ''
+            print(f'{name}\tversion {version}\t{entry["size"]}\t{mtime}')
+    elif args.command == 'list' and args.snapshot is not None:
+        if args.snapshot not in snapshots:
+            log.error('There is no backup named %s', args.snapshot)
+            sys.exit(1)
+        for entry in snapshot_entries(snapshots[args.snapshot]):
+            print(f'{entry["path"]}\t{entry["type"]}\t{entry["size"]}')
+    elif args.command == 'list':
+        for name, snapshot_dir in snapshots.items():
+            tiers = [tier for tier, dir in (('short', SHORT_DIR), ('long', LONG_DIR)) if (dir / name).exists()]
+            print(f'{name}\t{",".join(tiers)}')
+    elif args.command == 'restore':
+        if args.snapshot not in snapshots:
+            log.error('There is no backup named %s', args.snapshot)
+            sys.exit(1)
+        restored = restore_path(snapshots[args.snapshot], args.path, args.to)
+        log.info('Restored %s files to %s', restored, args.to)
+        if restored == 0:
+            sys.exit(1)
+    elif args.command == 'verify':
+        if args.snapshot is not None:
+            if args.snapshot not in snapshots:
+                log.error('There is no backup named %s', args.snapshot)
+                sys.exit(1)
+            snapshots = {args.snapshot: snapshots[args.snapshot]}
+        summary = verify_snapshots(snapshots, args.workers, args.low_priority)
+        for result in summary['failures']:
+            print(f'{result["snapshot"]}\t{result["file"]}\t{result["member"] or ""}\t{result["error"]}')
+        if args.snapshot is None:
+            save_verify_summary(summary)
+        if summary['corrupt'] > 0:
+            sys.exit(1)
 
 
 def hardlink_files(src_dir: Path, dest_dir: Path) -> None:
-    """Create dest_dir and then hard link all of the files in src_dir into dest_dir."""
+    """Create dest_dir and then hard link all of the files in src_dir into dest_dir.
+
+    Sub-directories (e.g. the files tree of an incremental snapshot) are re-created in dest_dir and their contents are
+    hard linked recursively. Symbolic links are linked themselves, not the files they point to.
+    """
     dest_dir.mkdir(parents=True)
     for file in src_dir.iterdir():
-        if file.is_dir():
-            log.warning('Found unexpected directory: %s', file)
+        if file.is_dir() and not file.is_symlink():
+            hardlink_files(file, dest_dir / file.name)
+        else:
+            os.link(file, dest_dir / file.name, follow_symlinks=False)
+
+
+def read_checkpoint(path: Path) -> List[dict]:
+    """Returns the records in a JSON lines progress file, or an empty list if it doesn't exist.
+
+    The file may have been cut off part way through a line when the sidecar was killed; that line is ignored.
+    """
+    records = []
+    if path.exists():
+        with open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+    return records
+
+
+def find_previous_snapshot(dir: Path, exclude: Path, index_name: str = MANIFEST_NAME) -> Optional[Path]:
+    """Returns the newest complete incremental snapshot in dir other than exclude, or None if there isn't one.
+
+    A snapshot is complete if its manifest (or index_name, for other kinds of snapshot) has been written.
+    """
+    for backup in reversed(get_backup_list(dir)):
+        if backup != exclude and (backup / index_name).exists():
+            return backup
+    return None
+
+
+def read_manifest(snapshot_dir: Path) -> Dict[str, dict]:
+    """Reads the manifest of an incremental snapshot and returns a dict from relative path to manifest record."""
+    result = {}
+    with open(snapshot_dir / MANIFEST_NAME, 'rt', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            result[record['path']] = record
+    return result
+
+
+def copy_and_hash(src: str, dest: Path) -> str:
+    """Copies src to dest, preserving mode and timestamps, and returns the sha256 hex digest of the contents.
+
+    The hash is computed as the data is copied so the file is only read once.
+    """
+    h = hashlib.sha256()
+    with open(src, 'rb') as inf, open(dest, 'wb') as outf:
+        while True:
+            buf = throttle.read(inf, COPY_BUF_SIZE)
+            if not buf:
+                break
+            h.update(buf)
+            outf.write(buf)
+            throttle.wrote(len(buf))
+    shutil.copystat(src, dest)
+    return h.hexdigest()
+
+
+def create_incremental_snapshot(snapshot_dir: Path, start_dir: Path, prev_snapshot: Optional[Path],
+                                excludes: Optional[List[Tuple[Pattern, bool]]] = None,
+                                cancel: Optional[threading.Event] = None) -> None:
+    """Copies the tree under start_dir to snapshot_dir / FILES_DIR_NAME and writes a manifest describing it.
+
+    Files whose size, mtime and inode match the record in prev_snapshot's manifest are not read at all; instead the
+    copy in prev_snapshot is hard linked into the new snapshot. Every snapshot is therefore a complete tree that can be
+    restored with a plain `cp -a` but unchanged files only take up disk space once. Since the filesystem reference
+    counts hard links, deleting any one snapshot (e.g. by the retention policy) never affects the others.
+
+    As with create_tarfile, files and directories matching excludes are skipped, those that can't be read are logged
+    and skipped, and the snapshot stops early if cancel is set.
+
+    If snapshot_dir holds the partial tree and manifest of an earlier, interrupted, attempt the files it had already
+    copied are linked rather than copied again.
+    """
+    # Maps the relative path of each file we may be able to link to its manifest record and the tree it's in.
+    bases: Dict[str, Tuple[dict, Path]] = {}
+    if prev_snapshot is not None:
+        log.info('Using %s as the base for the incremental snapshot', prev_snapshot)
+        bases = {rel: (record, prev_snapshot / FILES_DIR_NAME) for rel, record in read_manifest(prev_snapshot).items()}
+
+    files_dir = snapshot_dir / FILES_DIR_NAME
+    manifest_tmp = snapshot_dir / (MANIFEST_NAME + '.tmp')
+    resume_dir = snapshot_dir / RESUME_DIR_NAME
+    if files_dir.exists():
+        if resume_dir.exists():
+            shutil.rmtree(resume_dir)
+        files_dir.rename(resume_dir)
+        done = read_checkpoint(manifest_tmp)
+        log.info('Resuming the incremental snapshot: %s files already copied', len(done))
+        bases.update((record['path'], (record, resume_dir)) for record in done)
+    files_dir.mkdir(parents=True)
+    num_linked = 0
+    num_copied = 0
+    with open(manifest_tmp, 'wt', encoding='utf-8') as manifest:
+        for entry, rel, st in walk_tree(start_dir, excludes, cancel):
+            try:
+                dest = files_dir / rel
+                if stat.S_ISDIR(st.st_mode):
+                    dest.mkdir()
+                elif stat.S_ISLNK(st.st_mode):
+                    target = os.readlink(entry.path)
+                    os.symlink(target, dest)
+                    record = {'path': rel, 'link': target}
+                    manifest.write(json.dumps(record) + '\n')
+                elif stat.S_ISREG(st.st_mode):
+                    record = {'path': rel, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                              'inode': st.st_ino, 'sha256': None}
+                    prev, base_dir = bases.get(rel, (None, None))
+                    if (prev is not None and prev.get('size') == st.st_size and
+                            prev.get('mtime_ns') == st.st_mtime_ns and prev.get('inode') == st.st_ino):
+                        try:
+                            os.link(base_dir / rel, dest)
+                            record['sha256'] = prev['sha256']
+                            num_linked += 1
+                        except OSError as e:
+                            log.warning('Unable to link %s from the previous snapshot: %s. Copying it.', rel, e)
+                    if record['sha256'] is None:
+                        record['sha256'] = copy_and_hash(entry.path, dest)
+                        num_copied += 1
+                    manifest.write(json.dumps(record) + '\n')
+                else:
+                    log.warning('Skipping special file %s', entry.path)
+                    metrics.inc('wp_bak_files_skipped', reason='special')
+            except Exception as e:
+                log.warning('Error handling file or directory %s: %s. It will not be saved in the backup.',
+                            entry.path, e)
+                metrics.inc('wp_bak_files_skipped', reason='error')
+    manifest_tmp.rename(snapshot_dir / MANIFEST_NAME)
+    if resume_dir.exists():
+        shutil.rmtree(resume_dir)
+    log.info('Incremental snapshot complete: %s files copied, %s unchanged files linked', num_copied, num_linked)
+
+
+def split_chunks(stream: BinaryIO) -> Iterator[bytes]:
+    """Reads stream to the end and yields it as a series of content-defined chunks.
+
+    See CHUNK_ANCHOR_RE for how the boundaries are chosen. Only about CHUNK_MAX bytes are held in memory at a time.
+    """
+    buf = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buf) < CHUNK_MAX:
+            data = stream.read(COPY_BUF_SIZE)
+            if not data:
+                eof = True
+            buf += data
+        if len(buf) == 0:
+            return
+
+        cut = min(len(buf), CHUNK_MAX)
+        for m in CHUNK_ANCHOR_RE.finditer(buf, CHUNK_MIN, CHUNK_MAX):
+            end = m.end()
+            if zlib.crc32(buf[end - CHUNK_WINDOW:end]) & CHUNK_MASK == 0:
+                cut = end
+                break
+        yield bytes(buf[:cut])
+        del buf[:cut]
+
+
+class ChunkStore:
+    """A content-addressed store of chunks of data.
+
+    Each chunk is stored once, under the sha256 of its contents, in a file at root/<first 2 hex digits>/<hash>. Chunks
+    are zlib compressed unless that doesn't make them smaller (e.g. for chunks of JPEGs). The first byte of each chunk
+    file indicates which.
+    """
+    COMPRESSED = b'z'
+    RAW = b'r'
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.bytes_written = 0
+        self.bytes_deduplicated = 0
+        self.lock = threading.Lock()
+
+    def chunk_path(self, chunk_id: str) -> Path:
+        return self.root / chunk_id[:2] / chunk_id
+
+    def put(self, data: bytes) -> str:
+        """Adds data to the store, if it isn't already there, and returns its id."""
+        chunk_id = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(chunk_id)
+        if path.exists():
+            with self.lock:
+                self.bytes_deduplicated += len(data)
+            return chunk_id
+
+        compressed = zlib.compress(data, 6)
+        if len(compressed) < len(data):
+            contents = self.COMPRESSED + compressed
         else:
-            os.link(file, dest_dir / file.name)
+            contents = self.RAW + data
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temp file and rename so a crash can never leave a truncated chunk under a valid id. The name is
+        # unique per thread as the files and the database dump may be stored at the same time.
+        tmp = path.with_name(f'{chunk_id}.{threading.get_ident()}.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(contents)
+            f.flush()
+            metrics.inc('wp_bak_tier_size_bytes', os.fstat(f.fileno()).st_blocks * 512, tier='chunks')
+        tmp.rename(path)
+        throttle.wrote(len(contents))
+        with self.lock:
+            self.bytes_written += len(contents)
+        return chunk_id
+
+    def get(self, chunk_id: str) -> bytes:
+        """Returns the contents of the chunk with the given id."""
+        with open(self.chunk_path(chunk_id), 'rb') as f:
+            contents = f.read()
+        if contents[:1] == self.COMPRESSED:
+            return zlib.decompress(contents[1:])
+        return contents[1:]
+
+    def put_stream(self, stream: BinaryIO) -> List[str]:
+        """Splits stream into chunks, stores them, and returns the list of chunk ids in order."""
+        return [self.put(chunk) for chunk in split_chunks(stream)]
+
+    def write_chunks(self, chunk_ids: Iterable[str], out: BinaryIO) -> None:
+        """Writes the concatenated contents of chunk_ids to out."""
+        for chunk_id in chunk_ids:
+            out.write(self.get(chunk_id))
+
+    def collect_garbage(self, referenced: Set[str]) -> None:
+        """Deletes every chunk (and any leftover temp file) that isn't in referenced."""
+        if not self.root.exists():
+            return
+        num_deleted = 0
+        for subdir in self.root.iterdir():
+            for chunk in subdir.iterdir():
+                if chunk.name not in referenced:
+                    metrics.inc('wp_bak_tier_size_bytes', -chunk.lstat().st_blocks * 512, tier='chunks')
+                    chunk.unlink()
+                    num_deleted += 1
+        log.info('Garbage collection deleted %s unreferenced chunks', num_deleted)
+
+
+def read_snapshot_index(snapshot_dir: Path) -> Iterator[dict]:
+    """Yields the records in the index of a --repository snapshot."""
+    with gzip.open(snapshot_dir / SNAPSHOT_INDEX_NAME, 'rt', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def create_repository_snapshot(snapshot_dir: Path, start_dir: Path, store: ChunkStore,
+                               db_chunks: Union[List[str], Future], prev_snapshot: Optional[Path],
+                               excludes: Optional[List[Tuple[Pattern, bool]]] = None,
+                               cancel: Optional[threading.Event] = None) -> None:
+    """Stores the tree under start_dir in store and writes an index listing the chunks that make up each file, and the
+    chunks of the database dump (see store_db_dump), to snapshot_dir / SNAPSHOT_INDEX_NAME.
+
+    db_chunks may be a Future, for a dump that's running at the same time, in which case the index is completed once
+    its result is available.
+
+    Files whose size, mtime and inode match the record in prev_snapshot's index aren't read at all; their chunk list is
+    re-used. As with create_tarfile, files and directories matching excludes are skipped, those that can't be read are
+    logged and skipped, and the snapshot stops early if cancel is set.
+
+    The record of each file that is stored is also appended to snapshot_dir / FILES_CHECKPOINT_NAME. If the snapshot is
+    interrupted, running it again re-uses those records, just like those of prev_snapshot, rather than re-reading the
+    files. Their chunks are safe from collect_repository_garbage as it only runs after a backup has been published.
+    """
+    prev_files: Dict[str, dict] = {}
+    if prev_snapshot is not None:
+        log.info('Using %s as the base for the repository snapshot', prev_snapshot)
+        prev_files = {r['path']: r for r in read_snapshot_index(prev_snapshot) if r['type'] == 'file'}
+
+    snapshot_dir.mkdir(parents=True, exist_ok=True)
+    checkpoint_path = snapshot_dir / FILES_CHECKPOINT_NAME
+    done = read_checkpoint(checkpoint_path)
+    if done:
+        log.info('Resuming the repository snapshot: %s files already stored', len(done))
+        prev_files.update((r['path'], r) for r in done)
+    index_tmp = snapshot_dir / (SNAPSHOT_INDEX_NAME + '.tmp')
+    with gzip.open(index_tmp, 'wt', encoding='utf-8') as index, \
+            open(checkpoint_path, 'at', encoding='utf-8') as checkpoint:
+        for entry, rel, st in walk_tree(start_dir, excludes, cancel):
+            try:
+                if stat.S_ISDIR(st.st_mode):
+                    record = {'type': 'dir', 'path': rel, 'mode': st.st_mode & 0o7777}
+                elif stat.S_ISLNK(st.st_mode):
+                    record = {'type': 'link', 'path': rel, 'target': os.readlink(entry.path)}
+                elif stat.S_ISREG(st.st_mode):
+                    record = {'type': 'file', 'path': rel, 'mode': st.st_mode & 0o7777, 'size': st.st_size,
+                              'mtime_ns': st.st_mtime_ns, 'inode': st.st_ino}
+                    prev = prev_files.get(rel)
+                    if (prev is not None and prev['size'] == st.st_size and
+                            prev['mtime_ns'] == st.st_mtime_ns and prev['inode'] == st.st_ino):
+                        record['chunks'] = prev['chunks']
+                    else:
+                        with open(entry.path, 'rb') as f:
+                            record['chunks'] = store.put_stream(ThrottledFile(f))
+                        checkpoint.write(json.dumps(record) + '\n')
+                        checkpoint.flush()
+                else:
+                    log.warning('Skipping special file %s', entry.path)
+                    metrics.inc('wp_bak_files_skipped', reason='special')
+                    continue
+                index.write(json.dumps(record) + '\n')
+            except Exception as e:
+                log.warning('Error handling file or directory %s: %s. It will not be saved in the backup.',
+                            entry.path, e)
+                metrics.inc('wp_bak_files_skipped', reason='error')
+
+        if isinstance(db_chunks, Future):
+            db_chunks = db_chunks.result()
+        index.write(json.dumps({'type': 'db', 'chunks': db_chunks}) + '\n')
+    index_tmp.rename(snapshot_dir / SNAPSHOT_INDEX_NAME)
+    checkpoint_path.unlink()
+    log.info('Repository snapshot complete: %s bytes written, %s bytes already in the store',
+             store.bytes_written, store.bytes_deduplicated)
+
+
+def restore_repository_snapshot(snapshot_dir: Path, store: ChunkStore, files_dest: Path, db_dest: Path) -> None:
+    """Restores the files in a --repository snapshot to files_dest and the database dump, gzipped, to db_dest."""
+    files_dest.mkdir(parents=True, exist_ok=True)
+    dir_records = []
+    for record in read_snapshot_index(snapshot_dir):
+        if record['type'] == 'db':
+            with gzip.open(db_dest, 'wb') as out:
+                store.write_chunks(record['chunks'], out)
+            continue
+        dest = files_dest / record['path']
+        if record['type'] == 'dir':
+            dest.mkdir(parents=True, exist_ok=True)
+            dir_records.append(record)
+        elif record['type'] == 'link':
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            os.symlink(record['target'], dest)
+        else:
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            with open(dest, 'wb') as out:
+                store.write_chunks(record['chunks'], out)
+            os.chmod(dest, record['mode'])
+            os.utime(dest, ns=(record['mtime_ns'], record['mtime_ns']))
+    # Directory permissions are set last in case they don't allow writing the files in them.
+    for record in dir_records:
+        os.chmod(files_dest / record['path'], record['mode'])
+
+
+def collect_repository_garbage(store: ChunkStore, backup_dirs: Iterable[Path]) -> None:
+    """Deletes all chunks in store that are not referenced by the index of any backup in backup_dirs.
+
+    This is a mark and sweep pass: since a chunk can be shared by any number of backups we can only tell it is no
+    longer needed once the backups that have aged out have been deleted and we have checked all the rest.
+    """
+    referenced: Set[str] = set()
+    for backup_dir in backup_dirs:
+        if not (backup_dir / SNAPSHOT_INDEX_NAME).exists():
+            continue
+        for record in read_snapshot_index(backup_dir):
+            referenced.update(record.get('chunks', []))
+    store.collect_garbage(referenced)
+
+
+def mysqldump_command(db_host: str, db_user: str, db_pass: str) -> List[str]:
+    """Returns the command line to dump all databases on db_host to stdout."""
+    return ['mysqldump', '-h', db_host, '-u', db_user, '--password=' + db_pass, '--all-databases']
+
+def kill_on_cancel(proc: subprocess.Popen, cancel: Optional[threading.Event]) -> threading.Event:
+    """Starts a thread that kills proc if cancel is set, checking every second, and returns an event to set once proc
+    is finished with to stop the thread.
+
+    Killing mysqldump closes its output so whatever is reading it sees the end of the dump and returns; the caller then
+    raises BackupCancelled.
+    """
+    done = threading.Event()
+    if cancel is None:
+        return done
+
+    def watch() -> None:
+        while not done.wait(1):
+            if cancel.is_set():
+                proc.kill()
+                return
+
+    threading.Thread(target=watch, daemon=True).start()
+    return done
+
+def store_db_dump(db_host: str, db_user: str, db_pass: str, store: ChunkStore,
+                  cancel: Optional[threading.Event] = None) -> List[str]:
+    """Dump all databases on db_host into store and return the list of chunks that make up the dump.
+
+    If cancel is set the dump is killed and a BackupCancelled exception is raised.
+    """
+    with subprocess.Popen(mysqldump_command(db_host, db_user, db_pass), stdout=subprocess.PIPE) as dump:
+        done = kill_on_cancel(dump, cancel)
+        try:
+            chunks = store.put_stream(dump.stdout)
+        finally:
+            done.set()
+    if cancel is not None and cancel.is_set():
+        raise BackupCancelled()
+    if dump.returncode != 0:
+        raise subprocess.CalledProcessError(dump.returncode, dump.args)
+    return chunks
+
+def compressor_command(codec: str, level: Optional[int], threads: int = 1) -> List[str]:
+    """Returns the command line to compress stdin to stdout with the given codec from COMPRESSORS.
+
+    threads is only used by zstd; gzip is single threaded.
+    """
+    command = list(COMPRESSORS[codec]['command'])
+    if level is not None:
+        command.append(f'-{level}')
+    if codec == 'zstd' and threads > 1:
+        command.append(f'-T{threads}')
+    return command
+
+def dump_db(db_host: str, db_user: str, db_pass: str, dest: Path, codec: str = 'gzip',
+            level: Optional[int] = None, cancel: Optional[threading.Event] = None) -> Dict[str, Any]:
+    """Dump all databases on db_host to file dest, compressed with codec.
+
+    The output of mysqldump is piped straight into the compressor so the uncompressed dump never touches the disk and
+    memory use is bounded by the pipe buffer. The compressed output is written to a temp file which is renamed to dest
+    only if both mysqldump and the compressor succeed so dest is never a partial dump. Returns the sha256 and size of
+    dest, computed as it was written, for CHECKSUMS_NAME.
+
+    If cancel is set the dump is killed and a BackupCancelled exception is raised.
+    """
+    tmp = dest.with_name(dest.name + '.tmp')
+    try:
+        with open(tmp, 'wb') as f:
+            out = HashingWriter(f)
+            dump = subprocess.Popen(mysqldump_command(db_host, db_user, db_pass), stdout=subprocess.PIPE)
+            compress = subprocess.Popen(compressor_command(codec, level), stdin=dump.stdout, stdout=subprocess.PIPE)
+            copier = start_copier(compress.stdout, out)
+            # Close our copy of the pipe so that the compressor sees EOF when mysqldump exits and mysqldump gets a
+            # SIGPIPE, rather than hanging, if the compressor dies.
+            dump.stdout.close()
+            while True:
+                try:
+                    compress_rc = compress.wait(timeout=1)
+                    break
+                except subprocess.TimeoutExpired:
+                    if cancel is not None and cancel.is_set():
+                        dump.kill()
+                        compress.kill()
+                        dump.wait()
+                        compress.wait()
+                        copier.join()
+                        raise BackupCancelled()
+            dump_rc = dump.wait()
+            copier.join()
+        if dump_rc != 0:
+            raise subprocess.CalledProcessError(dump_rc, dump.args[0])
+        if compress_rc != 0:
+            raise subprocess.CalledProcessError(compress_rc, compress.args)
+        tmp.rename(dest)
+        return out.checksum()
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+def mysql_command(db_host: str, db_user: str, db_pass: str) -> List[str]:
+    """Returns the command line to run the mysql client in batch mode, printing each result as soon as it's ready."""
+    return ['mysql', '-h', db_host, '-u', db_user, '--password=' + db_pass, '--batch', '--skip-column-names',
+            '--unbuffered']
+
+def mysqldump_tables_command(db_host: str, db_user: str, db_pass: str, database: str, tables: List[str]) -> List[str]:
+    """Returns the command line to dump tables from database to stdout in a single transaction."""
+    return ['mysqldump', '-h', db_host, '-u', db_user, '--password=' + db_pass, '--single-transaction',
+            database] + tables
+
+def quote_name(name: str) -> str:
+    """Quotes a database, table or view name for use in SQL."""
+    return '`' + name.replace('`', '``') + '`'
+
+def run_query(db_host: str, db_user: str, db_pass: str, sql: str) -> List[List[str]]:
+    """Runs sql with the mysql client and returns the rows of the result as lists of strings."""
+    out = subprocess.check_output(mysql_command(db_host, db_user, db_pass) + ['-e', sql], text=True)
+    return [line.split('\t') for line in out.splitlines()]
 
-def dump_db(db_host: str, db_user: str, db_pass: str, dest: Path) -> None:
-    """Dump all databases on db_host to file dest."""
-    assert dest.suffix == '.gz'
-    with open(dest.parent / dest.stem, 'wb') as uncompressed_out:
-        subprocess.check_call(
-            ['mysqldump', '-h', db_host, '-u', db_user, '--password=' + db_pass, '--all-databases'],
-            stdout = uncompressed_out)
-        subprocess.check_call(['gzip', dest.parent / dest.stem])
+def list_tables(db_host: str, db_user: str, db_pass: str) -> List[Tuple[str, str, str, int]]:
+    """Returns (database, table, table type, size in bytes) for every table and view visible to db_user."""
+    return [(database, table, table_type, int(size))
+            for database, table, table_type, size in run_query(db_host, db_user, db_pass, LIST_TABLES_SQL)]
+
+def table_states(db_host: str, db_user: str, db_pass: str, tables: List[Tuple[str, str]],
+                 checksum: bool = True) -> Dict[Tuple[str, str], dict]:
+    """Returns the change state of each of tables, a list of (database, table), for table_unchanged.
+
+    The state holds the server time it was checked at and the table's last update and creation times. If checksum is
+    set tables whose update time is unknown are checksummed too, which reads the whole table; otherwise just
+    information_schema is read, which is quick.
+    """
+    wanted = set(tables)
+    states = {}
+    for checked_at, database, table, update_time, create_time in run_query(db_host, db_user, db_pass,
+                                                                           TABLE_STATE_SQL):
+        if (database, table) in wanted:
+            states[(database, table)] = {'checked_at': checked_at, 'update_time': update_time or None,
+                                         'create_time': create_time or None}
+    to_checksum = [key for key, state in states.items() if state['update_time'] is None]
+    if checksum and to_checksum:
+        log.info('Checksumming %s tables whose last update time is unknown', len(to_checksum))
+        names = ', '.join(quote_name(d) + '.' + quote_name(t) for d, t in to_checksum)
+        for name, checksum in run_query(db_host, db_user, db_pass, f'CHECKSUM TABLE {names}'):
+            database, table = name.split('.', 1)
+            if (database, table) in states:
+                states[(database, table)]['checksum'] = None if checksum == 'NULL' else checksum
+    return states
+
+def table_unchanged(prev: Optional[dict], cur: dict) -> bool:
+    """Returns True if a table whose state, from table_states, was prev when it was last dumped certainly hasn't
+    changed since, given that its state is now cur.
+
+    The update time only has a resolution of a second so a table updated in the second prev was checked could have
+    been updated again, after the dump, without its update time changing. Such tables count as changed.
+    """
+    if prev is None or prev.get('create_time') != cur['create_time']:
+        return False
+    if cur['update_time'] is not None:
+        return cur['update_time'] == prev.get('update_time') and cur['update_time'] < prev['checked_at']
+    return cur.get('checksum') is not None and cur['checksum'] == prev.get('checksum')
+
+def reuse_unchanged_tables(prev_dir: Path, codec: str, states: Dict[Tuple[str, str], dict],
+                           out_dir: Path) -> List[dict]:
+    """Hard links the dumps of the tables in prev_dir, a dump made by dump_db_parallel, that haven't changed since into
+    out_dir and returns their index records.
+
+    states is the current state of each table, from table_states. Views are never reused as they're cheap to dump.
+    """
+    with open(prev_dir / DB_INDEX_NAME, 'rt', encoding='utf-8') as f:
+        prev_index = json.load(f)
+    if prev_index['codec'] != codec:
+        log.info('Not reusing tables from %s as it was compressed with %s', prev_dir, prev_index['codec'])
+        return []
+    reused = []
+    for part in prev_index['parts']:
+        state = states.get((part['database'], part['table']))
+        if part['kind'] != 'table' or state is None or not table_unchanged(part.get('state'), state):
+            continue
+        dest = out_dir / part['file']
+        if dest.exists():
+            dest.unlink()
+        try:
+            os.link(prev_dir / part['file'], dest)
+        except OSError as e:
+            log.warning('Unable to link %s from the previous backup: %s. Copying it.', part['file'], e)
+            shutil.copy2(prev_dir / part['file'], dest)
+        reused.append({**part, 'reused_from': prev_dir.parent.name})
+    log.info('Reusing %s unchanged tables from %s', len(reused), prev_dir)
+    return reused
+
+def partition_tables(tables: List[Tuple[str, str, str, int]], num_workers: int) -> List[Tuple[str, List[str]]]:
+    """Splits tables, as returned by list_tables, into (database, [table, ...]) groups, one per worker, so the groups
+    have roughly the same total size.
+
+    A single mysqldump can only dump tables from one database so each group holds tables from just one database. There
+    are therefore max(num_workers, number of databases) groups at most.
+    """
+    databases = {t[0] for t in tables}
+    groups: List[Tuple[str, List[str]]] = []
+    sizes: List[int] = []
+    # Greedily put the biggest remaining table in the group with the smallest total size.
+    for database, table, _, size in sorted(tables, key=lambda t: t[3], reverse=True):
+        candidates = [i for i, g in enumerate(groups) if g[0] == database]
+        dbs_without_group = databases - {g[0] for g in groups} - {database}
+        if len(candidates) == 0 or len(groups) + len(dbs_without_group) < num_workers:
+            groups.append((database, []))
+            sizes.append(0)
+            candidates = [len(groups) - 1]
+        best = min(candidates, key=lambda i: sizes[i])
+        groups[best][1].append(table)
+        sizes[best] += size
+    return groups
+
+def start_compressor(dest: Path, codec: str, level: Optional[int], out: HashingWriter,
+                     append: bool = False) -> subprocess.Popen:
+    """Starts a compressor that writes what is written to its stdin to dest, through out so that it's hashed.
+
+    If append is true the output is appended to dest, and out carries on hashing from where it was. Both gzip and zstd
+    files may consist of several concatenated members, which are decompressed as if they were one, so this is a valid
+    way to add to a compressed file.
+    """
+    out.out = open(dest, 'ab' if append else 'wb')
+    compressor = subprocess.Popen(compressor_command(codec, level), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    # finish_compressor waits for the copier.
+    compressor.copier = start_copier(compressor.stdout, out, close=True)  # type: ignore[attr-defined]
+    return compressor
+
+def finish_compressor(compressor: subprocess.Popen) -> None:
+    """Closes the stdin of a compressor started by start_compressor and checks that it succeeded."""
+    compressor.stdin.close()
+    rc = compressor.wait()
+    compressor.copier.join()  # type: ignore[attr-defined]
+    if rc != 0:
+        raise subprocess.CalledProcessError(rc, compressor.args)
+
+def split_table_dump(stream: BinaryIO, database: str, out_dir: Path, codec: str, level: Optional[int],
+                     started: threading.Event) -> List[dict]:
+    """Splits the output of mysqldump for some of the tables in database into one compressed file per table or view in
+    out_dir and returns the index records describing them, including the sha256 and size of each file.
+
+    The header mysqldump writes before the first table (which sets the character set, disables foreign key checks,
+    etc.) is copied to the start of every file so that each can be loaded on its own. mysqldump writes a placeholder
+    table for each view and then, at the end, the real view definition; both are written to the view's file.
+
+    started is set once the first table or view section is read, or the dump ends. mysqldump --single-transaction
+    writes the header before it runs START TRANSACTION WITH CONSISTENT SNAPSHOT, so the header only shows that it
+    connected, but it reads the definition of the first table, and so writes its section, after; seeing that section
+    confirms that the dump's snapshot has been taken. Output buffering can only delay this, not make it early.
+    """
+    header: List[bytes] = []
+    parts: Dict[str, dict] = {}
+    writers: Dict[str, HashingWriter] = {}
+    cur: Optional[subprocess.Popen] = None
+    try:
+        for line in stream:
+            m = TABLE_SECTION_RE.fullmatch(line.rstrip(b'\n'))
+            if m is not None:
+                started.set()
+                if cur is not None:
+                    finish_compressor(cur)
+                name = m.group(2).decode('utf-8').replace('``', '`')
+                if name in parts:
+                    cur = start_compressor(out_dir / parts[name]['file'], codec, level, writers[name], append=True)
+                else:
+                    file_name = (database + '.' + name).replace(os.sep, '_') + '.sql' + COMPRESSORS[codec]['extension']
+                    parts[name] = {'database': database, 'table': name, 'file': file_name, 'kind': 'table'}
+                    writers[name] = HashingWriter()
+                    cur = start_compressor(out_dir / file_name, codec, level, writers[name])
+                    cur.stdin.write(b''.join(header))
+                if m.group(1).endswith(b'view'):
+                    parts[name]['kind'] = 'view'
+            if cur is None:
+                header.append(line)
+            else:
+                cur.stdin.write(line)
+    finally:
+        started.set()
+        if cur is not None:
+            finish_compressor(cur)
+    for name, part in parts.items():
+        part.update(writers[name].checksum())
+    return list(parts.values())
+
+def dump_table_group(db_host: str, db_user: str, db_pass: str, database: str, tables: List[str], out_dir: Path,
+                     codec: str, level: Optional[int], started: threading.Event,
+                     cancel: Optional[threading.Event] = None) -> List[dict]:
+    """Dumps tables from database with a single mysqldump into one file per table in out_dir.
+
+    See split_table_dump for the meaning of the return value and started. If cancel is set the dump is killed and a
+    BackupCancelled exception is raised.
+    """
+    with subprocess.Popen(mysqldump_tables_command(db_host, db_user, db_pass, database, tables),
+                          stdout=subprocess.PIPE) as dump:
+        done = kill_on_cancel(dump, cancel)
+        try:
+            parts = split_table_dump(dump.stdout, database, out_dir, codec, level, started)
+        finally:
+            done.set()
+    if cancel is not None and cancel.is_set():
+        raise BackupCancelled()
+    if dump.returncode != 0:
+        raise subprocess.CalledProcessError(dump.returncode, dump.args[0])
+    return parts
+
+def lock_tables(db_host: str, db_user: str, db_pass: str, tables: List[Tuple[str, str]]) -> Optional[subprocess.Popen]:
+    """Starts a mysql session holding a read lock on tables, a list of (database, table), apart from the
+    UNLOCKABLE_TABLES, and returns it once the lock is held. Release the lock with unlock_tables.
+
+    The lock blocks writes, not reads. Returns None, after logging a warning, if the lock can't be taken (e.g. because
+    db_user lacks the LOCK TABLES privilege).
+    """
+    session = subprocess.Popen(mysql_command(db_host, db_user, db_pass), stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, text=True)
+    names = ', '.join(quote_name(d) + '.' + quote_name(t) + ' READ' for d, t in tables
+                      if (d, t) not in UNLOCKABLE_TABLES)
+    session.stdin.write(f'LOCK TABLES {names};\nSELECT "locked";\n')
+    session.stdin.flush()
+    if session.stdout.readline().strip() != 'locked':
+        session.stdin.close()
+        session.wait()
+        log.warning('Unable to lock the tables. Each --db_workers process will see the database at a slightly '
+                    'different point in time.')
+        return None
+    return session
+
+def unlock_tables(session: subprocess.Popen) -> None:
+    """Releases a lock taken by lock_tables."""
+    session.stdin.write('UNLOCK TABLES;\n')
+    session.stdin.close()
+    session.wait()
+
+def dump_db_parallel(db_host: str, db_user: str, db_pass: str, dest_dir: Path, num_workers: int,
+                     codec: str = 'gzip', level: Optional[int] = None, incremental: bool = False,
+                     prev_dir: Optional[Path] = None, cancel: Optional[threading.Event] = None) -> List[dict]:
+    """Dump all databases on db_host into dest_dir, one compressed file per table, using num_workers mysqldump processes
+    running in parallel. An index of the parts is written to dest_dir / DB_INDEX_NAME and the parts are returned.
+
+    To get a consistent backup all the workers must see the same point in time. Each worker uses --single-transaction
+    so we hold a read lock on all the tables, blocking writes, until every worker has started its transaction. A worker
+    only writes its first table section after its transaction has started (see split_table_dump) so we release the
+    lock as soon as every worker has written one, which is normally well under a second, or after DB_LOCK_TIMEOUT. The
+    dump is written to a temp directory which is renamed to dest_dir only once every worker has succeeded.
+
+    As each worker finishes, the parts it wrote are recorded in the temp directory's DB_PROGRESS_NAME file. If the dump
+    is interrupted, running it again only dumps the tables that weren't finished. Those tables are then from a later
+    point in time than the ones that were; a warning is logged and they're listed under `resumed` in the index.
+
+    If incremental is set the change state of each table (see table_states) is recorded in the index and the tables
+    that haven't changed since prev_dir, the previous such dump, was made are hard linked from it rather than dumped
+    again (see reuse_unchanged_tables). The states are checked while we hold the read lock so that they describe the
+    same point in time as the dump. Tables whose update time is unknown are checksummed before the lock is taken, as
+    that reads the whole table and would block writes for as long; if such a table is changed before the lock is taken
+    InnoDB then knows its update time, so it counts as changed. dest_dir then still holds a complete dump which can be
+    restored on its own.
+
+    If cancel is set the workers are killed and a BackupCancelled exception is raised.
+    """
+    tmp_dir = dest_dir.with_name(dest_dir.name + '.tmp')
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    progress_path = tmp_dir / DB_PROGRESS_NAME
+    done_parts = read_checkpoint(progress_path)
+    done_tables = {(p['database'], p['table']) for p in done_parts}
+    tables = [t for t in list_tables(db_host, db_user, db_pass) if (t[0], t[1]) not in done_tables]
+    if done_parts:
+        log.warning('Resuming the database dump: %s tables were already dumped, earlier than the remaining %s',
+                    len(done_parts), len(tables))
+    try:
+        base_tables = [(t[0], t[1]) for t in tables if t[2] == 'BASE TABLE']
+        checksummed = table_states(db_host, db_user, db_pass, base_tables) if incremental and base_tables else {}
+        lock = lock_tables(db_host, db_user, db_pass, base_tables) if base_tables else None
+        try:
+            states: Dict[Tuple[str, str], dict] = {}
+            if incremental and base_tables:
+                states = table_states(db_host, db_user, db_pass, base_tables, checksum=False)
+                for key, state in states.items():
+                    before = checksummed.get(key)
+                    if (state['update_time'] is None and before is not None and before['update_time'] is None
+                            and before['create_time'] == state['create_time'] and 'checksum' in before):
+                        state['checksum'] = before['checksum']
+                if prev_dir is not None:
+                    reused = reuse_unchanged_tables(prev_dir, codec, states, tmp_dir)
+                    with open(progress_path, 'at', encoding='utf-8') as progress:
+                        for part in reused:
+                            progress.write(json.dumps(part) + '\n')
+                    done_parts += reused
+                    reused_tables = {(p['database'], p['table']) for p in reused}
+                    tables = [t for t in tables if (t[0], t[1]) not in reused_tables]
+            groups = partition_tables(tables, num_workers)
+            log.info('Dumping %s tables with %s workers', len(tables), len(groups))
+            started = [threading.Event() for _ in groups]
+            with ThreadPoolExecutor(max_workers=max(1, len(groups))) as pool:
+                futures = [pool.submit(dump_table_group, db_host, db_user, db_pass, database, group_tables, tmp_dir,
+                                       codec, level, started[i], cancel)
+                           for i, (database, group_tables) in enumerate(groups)]
+                if lock is not None:
+                    for event in started:
+                        event.wait(DB_LOCK_TIMEOUT)
+                    if not all(event.is_set() for event in started):
+                        log.warning('Not every --db_workers process had started its transaction after %s seconds so '
+                                    'they may see the database at slightly different points in time', DB_LOCK_TIMEOUT)
+                    unlock_tables(lock)
+                    lock = None
+                with open(progress_path, 'at', encoding='utf-8') as progress:
+                    for f in as_completed(futures):
+                        for part in f.result():
+                            if (part['database'], part['table']) in states:
+                                part['state'] = states[(part['database'], part['table'])]
+                            progress.write(json.dumps(part) + '\n')
+                        progress.flush()
+                parts = [part for f in futures for part in f.result()]
+        finally:
+            if lock is not None:
+                unlock_tables(lock)
+        index = {'codec': codec, 'parts': done_parts + parts}
+        if any('reused_from' not in p for p in done_parts):
+            index['resumed'] = [p['table'] for p in parts]
+        with open(tmp_dir / DB_INDEX_NAME, 'wt', encoding='utf-8') as f:
+            json.dump(index, f, indent=1)
+        progress_path.unlink()
+        tmp_dir.rename(dest_dir)
+        return index['parts']
+    finally:
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+
+def load_db_part(part_file: Path, database: str, codec: str, db_host: str, db_user: str, db_pass: str) -> None:
+    """Loads one file written by dump_db_parallel into database."""
+    decompress = subprocess.Popen(COMPRESSORS[codec]['decompress'] + [str(part_file)], stdout=subprocess.PIPE)
+    load = subprocess.Popen(mysql_command(db_host, db_user, db_pass) + [database], stdin=decompress.stdout)
+    decompress.stdout.close()
+    load_rc = load.wait()
+    decompress_rc = decompress.wait()
+    if decompress_rc != 0:
+        raise subprocess.CalledProcessError(decompress_rc, decompress.args)
+    if load_rc != 0:
+        raise subprocess.CalledProcessError(load_rc, load.args[0])
+
+def restore_db_parallel(db_dir: Path, db_host: str, db_user: str, db_pass: str, num_workers: int) -> None:
+    """Restores a dump written by dump_db_parallel, loading up to num_workers tables at a time.
+
+    Views are loaded after all the tables as they can only be created once the tables they use exist.
+    """
+    with open(db_dir / DB_INDEX_NAME, 'rt', encoding='utf-8') as f:
+        index = json.load(f)
+    parts = index['parts']
+    for database in sorted({p['database'] for p in parts}):
+        subprocess.check_call(mysql_command(db_host, db_user, db_pass) +
+                              ['-e', f'CREATE DATABASE IF NOT EXISTS {quote_name(database)}'])
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool:
+        futures = [pool.submit(load_db_part, db_dir / p['file'], p['database'], index['codec'], db_host, db_user,
+                               db_pass)
+                   for p in parts if p['kind'] == 'table']
+        for f in futures:
+            f.result()
+    for p in parts:
+        if p['kind'] == 'view':
+            load_db_part(db_dir / p['file'], p['database'], index['codec'], db_host, db_user, db_pass)
+
+class Checkpoint:
+    """Records which phases of a backup have finished, and their results, in a JSON file so that a backup that was
+    interrupted can be resumed without repeating them.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.phases: Dict[str, Any] = {}
+        if path.exists():
+            with open(path, 'rt', encoding='utf-8') as f:
+                self.phases = json.load(f)
+
+    def __contains__(self, phase: str) -> bool:
+        return phase in self.phases
+
+    def get(self, phase: str) -> Any:
+        return self.phases[phase]
+
+    def set(self, phase: str, result: Any = None) -> None:
+        """Records that phase finished with result, which must be JSON serializable."""
+        with self.lock:
+            self.phases[phase] = result
+            tmp = self.path.with_name(self.path.name + '.tmp')
+            with open(tmp, 'wt', encoding='utf-8') as f:
+                json.dump(self.phases, f)
+            tmp.rename(self.path)
+
+
+def schedule_backup(now: datetime, last_backup: Optional[datetime], freq: timedelta, backup_time: timedelta,
+                    window: timedelta) -> Tuple[bool, datetime]:
+    """Decides whether a backup should be started now.
+
+    Backups are due at SCHEDULE_EPOCH + backup_time + a whole number of freq. A backup is made now if the latest one
+    that was due hasn't been made yet, i.e. last_backup (the time of the newest complete backup, if any) is before it,
+    and it was due less than window ago. So however many backups were missed while the sidecar was down at most one is
+    made to catch up, and only within the window.
+
+    Returns whether to back up now and, if not, when the next backup is due.
+    """
+    anchor = SCHEDULE_EPOCH + backup_time
+    due = anchor + ((now - anchor) // freq) * freq
+    if (last_backup is None or last_backup < due) and now < due + window:
+        return True, now
+    return False, due + freq
+
+
+def resume_partial_backup(backup_dir: Path) -> None:
+    """If a previous backup was interrupted, renames the newest such backup so that make_backup(backup_dir) resumes
+    it, and deletes any older ones.
+    """
+    partials = sorted(SHORT_DIR.glob('*' + IN_PROGRESS_SUFFIX))
+    for partial in partials[:-1]:
+        log.warning('Deleting incomplete backup %s', partial)
+        shutil.rmtree(partial)
+    if partials:
+        log.info('Resuming incomplete backup %s', partials[-1])
+        partials[-1].rename(backup_dir.with_name(backup_dir.name + IN_PROGRESS_SUFFIX))
+
+
+class S3Error(Exception):
+    """Raised when a request to the S3 endpoint fails, after any retries. status is its HTTP status, if it had one."""
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+def s3_quote(s: str, safe: str = '/') -> str:
+    """URI encodes s as AWS Signature Version 4 requires."""
+    return urllib.parse.quote(s, safe='-_.~' + safe)
+
+
+class S3Client:
+    """A minimal client for S3-compatible object stores (AWS S3, MinIO, Ceph, etc.) covering just the requests needed
+    to replicate backups. It uses path-style URLs and AWS Signature Version 4.
+
+    It may be used from several threads at once; each thread keeps its own connection to the endpoint.
+    """
+    def __init__(self, endpoint: str, bucket: str, access_key: str, secret_key: str, region: str = 'us-east-1'):
+        url = urllib.parse.urlsplit(endpoint)
+        self.connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.host = url.netloc
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.local = threading.local()
+
+    def _sign(self, method: str, path: str, query: str, headers: Dict[str, str], payload_hash: str) -> None:
+        """Adds the date, payload hash and Authorization headers to headers."""
+        amz_date = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        headers.update({'Host': self.host, 'X-Amz-Date': amz_date, 'X-Amz-Content-Sha256': payload_hash})
+        canonical_headers = sorted((k.lower(), str(v).strip()) for k, v in headers.items())
+        signed_headers = ';'.join(k for k, _ in canonical_headers)
+        canonical_request = '\n'.join([method, path, query, ''.join(f'{k}:{v}\n' for k, v in canonical_headers),
+                                       signed_headers, payload_hash])
+        scope = f'{amz_date[:8]}/{self.region}/s3/aws4_request'
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+                                    hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+        key = ('AWS4' + self.secret_key).encode('utf-8')
+        for part in (amz_date[:8], self.region, 's3', 'aws4_request'):
+            key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+        headers['Authorization'] = (f'AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, '
+                                    f'SignedHeaders={signed_headers}, Signature={signature}')
+
+    def request(self, method: str, key: str = '', params: Optional[Dict[str, str]] = None, body: bytes = b'',
+                headers: Optional[Dict[str, str]] = None, ok: Tuple[int, ...] = (200,)
+                ) -> Tuple[int, http.client.HTTPMessage, bytes]:
+        """Makes a request for key in the bucket and returns the status, headers and body of the response. Raises
+        S3Error if the status isn't in ok.
+        """
+        path = s3_quote(f'/{self.bucket}/{key}')
+        query = '&'.join(f'{s3_quote(k, "")}={s3_quote(v, "")}' for k, v in sorted((params or {}).items()))
+        payload_hash = hashlib.sha256(body).hexdigest()
+        status = None
+        for attempt in range(S3_RETRIES + 1):
+            if attempt > 0:
+                time.sleep(S3_RETRY_DELAY * 2**(attempt - 1))
+            request_headers = dict(headers or {})
+            self._sign(method, path, query, request_headers, payload_hash)
+            connection = getattr(self.local, 'connection', None)
+            if connection is None:
+                connection = self.local.connection = self.connection_class(self.host, timeout=S3_TIMEOUT)
+            try:
+                connection.request(method, path + ('?' + query if query else ''), body=body, headers=request_headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                self.local.connection = None
+                error = f'{method} {path}: {e}'
+                continue
+            if response.status in ok:
+                return response.status, response.headers, data
+            status = response.status
+            error = f'{method} {path}: HTTP {status}'
+            if data:
+                try:
+                    root = ElementTree.fromstring(data)
+                    error += f' {root.findtext("{*}Code") or root.findtext("Code")}: ' \
+                             f'{root.findtext("{*}Message") or root.findtext("Message")}'
+                except ElementTree.ParseError:
+                    pass
+            if status < 500 and status != 429:
+                break
+        raise S3Error(error, status)
+
+    def put_object(self, key: str, data: bytes) -> None:
+        self.request('PUT', key, body=data)
+
+    def copy_object(self, src_key: str, key: str) -> None:
+        """Copies src_key to key within the bucket, without downloading and uploading the data."""
+        _, _, data = self.request('PUT', key, headers={'X-Amz-Copy-Source': s3_quote(f'/{self.bucket}/{src_key}')})
+        # A copy can fail after the 200 status has been sent, in which case the body holds an error.
+        if b'<Error>' in data:
+            raise S3Error(f'Copying {src_key} to {key} failed: {data[:200]!r}')
+
+    def object_exists(self, key: str) -> bool:
+        status, _, _ = self.request('HEAD', key, ok=(200, 404))
+        return status == 200
+
+    def get_object(self, key: str) -> Optional[bytes]:
+        """Returns the contents of key, or None if there's no such object."""
+        status, _, data = self.request('GET', key, ok=(200, 404))
+        return data if status == 200 else None
+
+    def delete_object(self, key: str) -> None:
+        self.request('DELETE', key, ok=(200, 204))
+
+    def list_objects(self, prefix: str, delimiter: Optional[str] = None) -> Tuple[List[str], List[str]]:
+        """Returns the keys starting with prefix and, with a delimiter, the common prefixes of those that contain the
+        delimiter after prefix, i.e. the "subdirectories" of prefix, which are then left out of the keys.
+        """
+        keys: List[str] = []
+        prefixes: List[str] = []
+        params = {'list-type': '2', 'prefix': prefix}
+        if delimiter is not None:
+            params['delimiter'] = delimiter
+        while True:
+            _, _, data = self.request('GET', params=params)
+            root = ElementTree.fromstring(data)
+            keys.extend(e.text for e in root.findall('{*}Contents/{*}Key'))
+            prefixes.extend(e.text for e in root.findall('{*}CommonPrefixes/{*}Prefix'))
+            if root.findtext('{*}IsTruncated') != 'true':
+                return keys, prefixes
+            params['continuation-token'] = root.findtext('{*}NextContinuationToken')
+
+    def create_multipart_upload(self, key: str) -> str:
+        _, _, data = self.request('POST', key, params={'uploads': ''})
+        return ElementTree.fromstring(data).findtext('{*}UploadId')
+
+    def upload_part(self, key: str, upload_id: str, part_number: int, data: bytes) -> str:
+        """Uploads one part of a multipart upload and returns its ETag."""
+        _, headers, _ = self.request('PUT', key, params={'partNumber': str(part_number), 'uploadId': upload_id},
+                                     body=data)
+        return headers['ETag']
+
+    def list_parts(self, key: str, upload_id: str) -> Optional[Dict[int, str]]:
+        """Returns the ETag of each part of a multipart upload that has been uploaded, by part number, or None if the
+        upload no longer exists.
+        """
+        parts: Dict[int, str] = {}
+        params = {'uploadId': upload_id}
+        while True:
+            status, _, data = self.request('GET', key, params=params, ok=(200, 404))
+            if status == 404:
+                return None
+            root = ElementTree.fromstring(data)
+            for part in root.findall('{*}Part'):
+                parts[int(part.findtext('{*}PartNumber'))] = part.findtext('{*}ETag')
+            if root.findtext('{*}IsTruncated') != 'true':
+                return parts
+            params['part-number-marker'] = root.findtext('{*}NextPartNumberMarker')
+
+    def complete_multipart_upload(self, key: str, upload_id: str, parts: Dict[int, str]) -> None:
+        body = ''.join(f'<Part><PartNumber>{n}</PartNumber><ETag>{etag}</ETag></Part>'
+                       for n, etag in sorted(parts.items()))
+        _, _, data = self.request('POST', key, params={'uploadId': upload_id},
+                                  body=f'<CompleteMultipartUpload>{body}</CompleteMultipartUpload>'.encode('utf-8'))
+        if b'<Error>' in data:
+            raise S3Error(f'Completing the upload of {key} failed: {data[:200]!r}')
+
+    def abort_multipart_upload(self, key: str, upload_id: str) -> None:
+        self.request('DELETE', key, params={'uploadId': upload_id}, ok=(200, 204, 404))
+
+
+class Replicator:
+    """Copies backups to an S3-compatible bucket and applies the same retention to them there.
+
+    Only what isn't in the bucket already is uploaded. A file hard linked to the same file in a backup that's already
+    in the bucket (an unchanged file in an --incremental backup, an unchanged table with --incremental_db, or any file
+    of a long backup) is copied within the bucket instead, and only the chunks of a --repository backup that aren't in
+    the bucket yet are uploaded. Everything is uploaded on a pool of upload_concurrency threads; files larger than
+    part_size are uploaded in parts which are uploaded in parallel too. Each thread reads the data it's about to
+    upload so at most upload_concurrency * part_size bytes are held in memory.
+    """
+    def __init__(self, client: S3Client, prefix: str, upload_concurrency: int, part_size: int,
+                 state_path: Path = UPLOAD_STATE_PATH):
+        self.client = client
+        self.prefix = prefix.strip('/')
+        self.upload_concurrency = upload_concurrency
+        self.part_size = part_size
+        self.state_path = state_path
+        self.lock = threading.Lock()
+        # The backups known to be complete in the bucket, as (tier, name).
+        self.replicated: Set[Tuple[str, str]] = set()
+        # The ids of the chunks in the bucket, listed when first needed.
+        self.remote_chunks: Optional[Set[str]] = None
+        # The ids of the chunks used by each --repository backup in the bucket, by (tier, name), read from its index.
+        self.snapshot_chunks: Dict[Tuple[str, str], Set[str]] = {}
+        try:
+            with open(state_path, 'rt', encoding='utf-8') as f:
+                self.uploads: Dict[str, dict] = json.load(f)
+        except (OSError, ValueError):
+            self.uploads = {}
+
+    def key(self, *parts: str) -> str:
+        return '/'.join(([self.prefix] if self.prefix else []) + list(parts))
+
+    def _save_uploads(self) -> None:
+        tmp = self.state_path.with_name(self.state_path.name + '.tmp')
+        with self.lock:
+            with open(tmp, 'wt', encoding='utf-8') as f:
+                json.dump(self.uploads, f)
+            tmp.rename(self.state_path)
+
+    def is_replicated(self, tier: str, name: str) -> bool:
+        if (tier, name) not in self.replicated and self.client.object_exists(self.key(tier, name, REPLICATED_NAME)):
+            self.replicated.add((tier, name))
+        return (tier, name) in self.replicated
+
+    def _put_file(self, path: Path, key: str) -> None:
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.client.put_object(key, data)
+        metrics.inc('wp_bak_bytes_uploaded', len(data))
+
+    def _put_part(self, path: Path, key: str, upload_id: str, part_number: int) -> Tuple[int, str]:
+        with open(path, 'rb') as f:
+            data = os.pread(f.fileno(), self.part_size, (part_number - 1) * self.part_size)
+        etag = self.client.upload_part(key, upload_id, part_number, data)
+        metrics.inc('wp_bak_bytes_uploaded', len(data))
+        return part_number, etag
+
+    def _start_multipart(self, path: Path, key: str, st: os.stat_result) -> Tuple[str, Dict[int, str]]:
+        """Returns the id of the multipart upload of path to key, carrying on with an interrupted one if it was of the
+        same file, and the parts already uploaded.
+        """
+        record = self.uploads.get(key)
+        if record is not None and (record['size'], record['mtime_ns'], record['part_size']) == \
+                (st.st_size, st.st_mtime_ns, self.part_size):
+            parts = self.client.list_parts(key, record['upload_id'])
+            if parts is not None:
+                log.info('Resuming the upload of %s: %s parts were already uploaded', key, len(parts))
+                return record['upload_id'], parts
+        upload_id = self.client.create_multipart_upload(key)
+        self.uploads[key] = {'upload_id': upload_id, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                             'part_size': self.part_size}
+        self._save_uploads()
+        return upload_id, {}
+
+    def replicate(self, tier: str, backup_dir: Path, bases: List[Tuple[str, Path]]) -> None:
+        """Copies backup_dir to <prefix>/<tier>/<name> in the bucket. bases are (tier, dir) of backups already in the
+        bucket whose files backup_dir may be hard linked to.
+        """
+        start = time.monotonic()
+        counts = {'uploaded': 0, 'copied': 0, 'chunks': 0}
+        multipart: Dict[str, Tuple[str, Dict[int, str], List[Future]]] = {}
+        futures: List[Future] = []
+        with ThreadPoolExecutor(max_workers=self.upload_concurrency) as pool:
+            for dir_path, _, file_names in os.walk(backup_dir):
+                for file_name in sorted(file_names):
+                    path = Path(dir_path) / file_name
+                    st = path.lstat()
+                    if not stat.S_ISREG(st.st_mode):
+                        # Symbolic links in --incremental backups are recorded in the manifest.
+                        continue
+                    rel = path.relative_to(backup_dir).as_posix()
+                    key = self.key(tier, backup_dir.name, rel)
+                    base_key = None
+                    for base_tier, base_dir in bases:
+                        try:
+                            base_st = (base_dir / rel).lstat()
+                        except OSError:
+                            continue
+                        if (base_st.st_dev, base_st.st_ino) == (st.st_dev, st.st_ino) and \
+                                st.st_size <= S3_MAX_COPY_SIZE:
+                            base_key = self.key(base_tier, base_dir.name, rel)
+                            break
+                    if base_key is not None:
+                        counts['copied'] += 1
+                        futures.append(pool.submit(self.client.copy_object, base_key, key))
+                    elif st.st_size <= self.part_size:
+                        counts['uploaded'] += 1
+                        futures.append(pool.submit(self._put_file, path, key))
+                    else:
+                        counts['uploaded'] += 1
+                        num_parts = -(-st.st_size // self.part_size)
+                        if num_parts > S3_MAX_PARTS:
+                            raise S3Error(f'{path} needs {num_parts} parts, more than the {S3_MAX_PARTS} allowed; '
+                                          'increase --upload_part_size')
+                        upload_id, done = self._start_multipart(path, key, st)
+                        multipart[key] = (upload_id, done,
+                                          [pool.submit(self._put_part, path, key, upload_id, n)
+                                           for n in range(1, num_parts + 1) if n not in done])
+            if (backup_dir / SNAPSHOT_INDEX_NAME).exists():
+                if self.remote_chunks is None:
+                    keys, _ = self.client.list_objects(self.key('chunks') + '/')
+                    self.remote_chunks = {k.rsplit('/', 1)[-1] for k in keys}
+                store = ChunkStore(CHUNK_DIR)
+                chunk_ids = {chunk_id for record in read_snapshot_index(backup_dir)
+                             for chunk_id in record.get('chunks', [])}
+                for chunk_id in sorted(chunk_ids - self.remote_chunks):
+                    counts['chunks'] += 1
+                    futures.append(pool.submit(self._put_file, store.chunk_path(chunk_id),
+                                               self.key('chunks', chunk_id[:2], chunk_id)))
+            # Wait for everything, rather than stopping at the first error, so that all the parts that can be uploaded
+            # are and don't need uploading again next time.
+            errors = [f.exception() for f in futures + [f for _, _, fs in multipart.values() for f in fs]]
+        errors = [e for e in errors if e is not None]
+        if errors:
+            raise errors[0]
+        for key, (upload_id, parts, part_futures) in multipart.items():
+            parts.update(f.result() for f in part_futures)
+            self.client.complete_multipart_upload(key, upload_id, parts)
+            del self.uploads[key]
+            self._save_uploads()
+        if self.remote_chunks is not None and (backup_dir / SNAPSHOT_INDEX_NAME).exists():
+            self.remote_chunks |= chunk_ids
+        self.client.put_object(self.key(tier, backup_dir.name, REPLICATED_NAME), b'')
+        self.replicated.add((tier, backup_dir.name))
+        log.info('Replicated %s in %.1f seconds: %s files uploaded, %s copied from earlier backups, %s chunks uploaded',
+                 backup_dir, time.monotonic() - start, counts['uploaded'], counts['copied'], counts['chunks'])
+
+    def replace_file(self, tier: str, backup_dir: Path, rel: str) -> None:
+        """Uploads the file rel of backup_dir again, after it was changed, if the backup is in tier in the bucket."""
+        if self.is_replicated(tier, backup_dir.name):
+            self._put_file(backup_dir / rel, self.key(tier, backup_dir.name, rel))
+
+    def replicate_all(self, tier_dirs: List[Path]) -> None:
+        """Replicates every backup in tier_dirs that isn't in the bucket yet, oldest first."""
+        replicated_dirs: Dict[str, Path] = {}
+        for tier_dir in tier_dirs:
+            prev: Optional[Path] = None
+            for backup_dir in get_backup_list(tier_dir):
+                tier = tier_dir.name
+                if not self.is_replicated(tier, backup_dir.name):
+                    # Long backups are hard links of short ones with the same name; incremental backups share files
+                    # with the previous one.
+                    bases = [(d.parent.name, d) for d in (replicated_dirs.get(backup_dir.name), prev) if d is not None]
+                    self.replicate(tier, backup_dir, bases)
+                replicated_dirs.setdefault(backup_dir.name, backup_dir)
+                prev = backup_dir
+        # Uploads of files that are gone, e.g. backups deleted before they could be replicated, will never complete.
+        for key, record in list(self.uploads.items()):
+            log.info('Abandoning the upload of %s', key)
+            self.client.abort_multipart_upload(key, record['upload_id'])
+            del self.uploads[key]
+            self._save_uploads()
+
+    def _delete_prefix(self, prefix: str) -> None:
+        keys, _ = self.client.list_objects(prefix)
+        with ThreadPoolExecutor(max_workers=self.upload_concurrency) as pool:
+            for future in [pool.submit(self.client.delete_object, key) for key in keys]:
+                future.result()
+
+    def list_backups(self, tier: str) -> List[Tuple[datetime, str]]:
+        """Lists the backups in tier, in the bucket, as (time made, name), oldest first, as for one tier of scan_tiers.
+        Backups that are only partly replicated are included.
+        """
+        _, prefixes = self.client.list_objects(self.key(tier) + '/', delimiter='/')
+        names = sorted(name for name in (prefix.rstrip('/').rsplit('/', 1)[-1] for prefix in prefixes)
+                       if DATE_TIME_RE.fullmatch(name) is not None)
+        return [(datetime.strptime(name, DATE_TIME_FORMAT), name) for name in names]
+
+    def delete_backup(self, tier: str, name: str) -> None:
+        """Deletes the backup name in tier from the bucket."""
+        log.info('Deleting backup from the bucket - %s', self.key(tier, name))
+        # Delete the marker first so a partly deleted backup doesn't look complete.
+        self.client.delete_object(self.key(tier, name, REPLICATED_NAME))
+        self.replicated.discard((tier, name))
+        self.snapshot_chunks.pop((tier, name), None)
+        self._delete_prefix(self.key(tier, name) + '/')
+
+    def read_snapshot_chunks(self, tier: str, name: str) -> Optional[Set[str]]:
+        """Returns the ids of the chunks used by the backup name in tier, read from its index in the bucket, or None if
+        it has no index, i.e. it isn't a --repository backup or its index wasn't uploaded yet.
+        """
+        chunk_ids = self.snapshot_chunks.get((tier, name))
+        if chunk_ids is not None:
+            return chunk_ids
+        key = self.key(tier, name, SNAPSHOT_INDEX_NAME)
+        data = self.client.get_object(key)
+        if data is None:
+            return None
+        try:
+            chunk_ids = {chunk_id for line in gzip.decompress(data).splitlines()
+                         for chunk_id in json.loads(line).get('chunks', [])}
+        except (OSError, EOFError, ValueError) as e:
+            raise S3Error(f'Unable to read {key}: {e}')
+        # The index of a complete backup never changes so it's only read once.
+        if self.is_replicated(tier, name):
+            self.snapshot_chunks[(tier, name)] = chunk_ids
+        return chunk_ids
+
+    def collect_garbage(self, tiers: List[str]) -> None:
+        """Deletes the chunks in the bucket that aren't used by any of the backups in tiers in the bucket.
+
+        Which chunks are used is read from the indexes of the backups in the bucket, never from what's in the local
+        chunk store, so the chunks in the bucket are safe if the local volume is lost. Nothing is deleted if there are
+        no indexes in the bucket at all.
+        """
+        in_use: Set[str] = set()
+        num_indexes = 0
+        for tier in tiers:
+            for _, name in self.list_backups(tier):
+                chunk_ids = self.read_snapshot_chunks(tier, name)
+                if chunk_ids is not None:
+                    num_indexes += 1
+                    in_use |= chunk_ids
+        if num_indexes == 0:
+            log.warning('There are no --repository backups in the bucket so no chunks are deleted from it')
+            return
+        keys, _ = self.client.list_objects(self.key('chunks') + '/')
+        doomed = [key for key in keys if key.rsplit('/', 1)[-1] not in in_use]
+        with ThreadPoolExecutor(max_workers=self.upload_concurrency) as pool:
+            for future in [pool.submit(self.client.delete_object, key) for key in doomed]:
+                future.result()
+        if self.remote_chunks is not None:
+            self.remote_chunks -= {key.rsplit('/', 1)[-1] for key in doomed}
+        log.info('Deleted %s unused chunks from the bucket', len(doomed))
+
+
+def replicate_backups(replicator: Replicator, args: argparse.Namespace, now: datetime) -> None:
+    """Copies new backups to the bucket and deletes the ones the retention policy doesn't keep from it.
+
+    What to delete is planned by plan_retention from the backups listed in the bucket, as for the local tiers, and never
+    from which backups are missing locally: if the local volume is lost the copies in the bucket are kept.
+    """
+    replicator.replicate_all([SHORT_DIR, LONG_DIR])
+    tiers = {'short': SHORT_DIR.name, 'long': LONG_DIR.name}
+    plan = plan_retention({tier: replicator.list_backups(name) for tier, name in tiers.items()}, now, args)
+    for tier, name in tiers.items():
+        for backup in plan['delete'][tier]:
+            replicator.delete_backup(name, backup)
+    if args.repository:
+        # An empty or missing chunk store or tiers means the volume was lost or isn't mounted, so leave the chunks in
+        # the bucket alone until there are local backups again.
+        if any(dir.is_dir() and get_backup_list(dir) for dir in (SHORT_DIR, LONG_DIR)) and CHUNK_DIR.is_dir() and \
+                any(CHUNK_DIR.iterdir()):
+            replicator.collect_garbage(list(tiers.values()))
+        else:
+            log.warning('There are no local backups or chunks so no chunks are deleted from the bucket')
+
+
+def run_phase(name: str, fn: Callable[..., Any], *args: Any) -> Any:
+    """Calls fn(*args), logging how long it took, and returns its result.
+
+    The time is added to the phase's metric. If profile_requested is set the call is profiled; see start_profile.
+    """
+    start = time.monotonic()
+    log.info('Starting the %s phase', name)
+    profile = start_profile(name)
+    try:
+        return fn(*args)
+    finally:
+        elapsed = time.monotonic() - start
+        log.info('The %s phase took %.1f seconds', name, elapsed)
+        metrics.inc('wp_bak_phase_duration_seconds', elapsed, phase=name)
+        if profile is not None:
+            stop_profile(profile, name)
+
+def backup_files(args: argparse.Namespace, dest_dir: Path, excludes: List[Tuple[Pattern, bool]],
+                 store: Optional[ChunkStore], db_chunks: Optional[Future], checkpoint: Checkpoint,
+                 cancel: threading.Event) -> None:
+    """Backs up SRC_DIR to dest_dir in the format chosen by args, unless checkpoint says that's already been done.
+
+    The --incremental and --repository formats resume where an interrupted attempt left off; a tarball is started over.
+    """
+    if 'files' in checkpoint:
+        log.info('The files were backed up before the backup was interrupted')
+        return
+    final_dir = dest_dir.with_name(dest_dir.name[:-len(IN_PROGRESS_SUFFIX)])
+    if args.repository:
+        create_repository_snapshot(dest_dir, SRC_DIR, store, db_chunks,
+                                   find_previous_snapshot(SHORT_DIR, final_dir, SNAPSHOT_INDEX_NAME), excludes, cancel)
+    elif args.incremental:
+        create_incremental_snapshot(dest_dir, SRC_DIR, find_previous_snapshot(SHORT_DIR, final_dir), excludes, cancel)
+    else:
+        stats = create_tarfile(dest_dir / ('files.tar' + COMPRESSORS[args.files_compression]['extension']), SRC_DIR,
+                               args.files_compression, args.files_compression_level, args.compress_threads,
+                               dest_dir / STORED_TAR_NAME if args.store_media_uncompressed else None, excludes,
+                               dest_dir / CATALOG_NAME, cancel)
+        checkpoint.set('checksums.files', stats['checksums'])
+    checkpoint.set('files')
+
+def backup_db(args: argparse.Namespace, dest_dir: Path, store: Optional[ChunkStore], checkpoint: Checkpoint,
+              cancel: threading.Event) -> Optional[List[str]]:
+    """Dumps the database to dest_dir, or to store with --repository in which case the chunk list is returned.
+
+    If checkpoint says the dump was finished before the backup was interrupted it isn't repeated. A --db_workers dump
+    that was interrupted part way through only dumps the tables that weren't finished.
+    """
+    if 'db' in checkpoint:
+        log.info('The database was backed up before the backup was interrupted')
+        return checkpoint.get('db')
+    if args.repository:
+        chunks = store_db_dump(args.db_host, args.db_user, args.db_pass, store, cancel)
+        checkpoint.set('db', chunks)
+        return chunks
+    elif args.db_workers > 0:
+        prev_dir = None
+        if args.incremental_db:
+            final_dir = dest_dir.with_name(dest_dir.name[:-len(IN_PROGRESS_SUFFIX)])
+            prev = find_previous_snapshot(SHORT_DIR, final_dir, DB_PARTS_DIR_NAME + '/' + DB_INDEX_NAME)
+            prev_dir = prev / DB_PARTS_DIR_NAME if prev is not None else None
+        parts = dump_db_parallel(args.db_host, args.db_user, args.db_pass, dest_dir / DB_PARTS_DIR_NAME,
+                                 args.db_workers, args.db_compression, args.db_compression_level, args.incremental_db,
+                                 prev_dir, cancel)
+        checkpoint.set('checksums.db', {DB_PARTS_DIR_NAME + '/' + p['file']: {'sha256': p['sha256'], 'size': p['size']}
+                                        for p in parts if 'sha256' in p})
+    else:
+        dump_name = 'dbdump.sql' + COMPRESSORS[args.db_compression]['extension']
+        checksum = dump_db(args.db_host, args.db_user, args.db_pass, dest_dir / dump_name, args.db_compression,
+                           args.db_compression_level, cancel)
+        checkpoint.set('checksums.db', {dump_name: checksum})
+    checkpoint.set('db')
+    return None
+
+def make_backup(args: argparse.Namespace, backup_dir: Path, excludes: List[Tuple[Pattern, bool]]) -> None:
+    """Makes a complete backup of the files and the database in backup_dir.
+
+    The files and the database are backed up at the same time, in separate threads, so the backup takes about as long
+    as the slower of the two rather than their sum and the files and database are closer to the same point in time.
+    If either fails the other is cancelled and the exception is re-raised. Everything is written to a temp directory
+    which is only renamed to backup_dir once both have succeeded.
+
+    If the temp directory already exists it holds a backup that was interrupted when the sidecar was killed (see
+    resume_partial_backup) and the backup carries on from its checkpoint.
+    """
+    tmp_dir = backup_dir.with_name(backup_dir.name + IN_PROGRESS_SUFFIX)
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    checkpoint = Checkpoint(tmp_dir / CHECKPOINT_NAME)
+    start = time.monotonic()
+    throttle.reset_stats()
+    cancel = threading.Event()
+    store = ChunkStore(CHUNK_DIR) if args.repository else None
+    try:
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            db = pool.submit(run_phase, 'database', backup_db, args, tmp_dir, store, checkpoint, cancel)
+            files = pool.submit(run_phase, 'files', backup_files, args, tmp_dir, excludes, store, db, checkpoint,
+                                cancel)
+            error: Optional[BaseException] = None
+            for f in as_completed([db, files]):
+                if f.exception() is not None and error is None:
+                    error = f.exception()
+                    cancel.set()
+            if error is not None:
+                raise error
+        checksums = {}
+        for phase in ('checksums.files', 'checksums.db'):
+            if phase in checkpoint:
+                checksums.update(checkpoint.get(phase))
+        if checksums:
+            with open(tmp_dir / CHECKSUMS_NAME, 'wt', encoding='utf-8') as f:
+                json.dump(checksums, f, indent=1, sort_keys=True)
+        metrics.set('wp_bak_backup_duration_seconds', time.monotonic() - start)
+        write_report(tmp_dir, backup_dir.name)
+        checkpoint.path.unlink()
+        tmp_dir.rename(backup_dir)
+    finally:
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+    log.info('Backup took %.1f seconds', time.monotonic() - start)
+    throttle.log_report()
 
 def main():
     """Wakes up every day and makes a backup in the short-term directory. 
@@ -216,44 +3507,82 @@ def main():
     The numbers stated above are examples, and are settable by editing the 
     constants above. 
     """
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        run_command(parse_command_args(sys.argv[1:]))
+        return
+
     args = parse_args()
     SHORT_DIR.mkdir(parents=True, exist_ok=True)
     LONG_DIR.mkdir(parents=True, exist_ok=True)
+    if args.dry_run:
+        print_retention_plan(plan_retention(scan_tiers(), datetime.now(), args))
+        return
+    excludes = parse_excludes(([] if args.no_default_excludes else DEFAULT_EXCLUDES) + args.exclude)
+    throttle.configure(args.read_limit, args.write_limit, args.adaptive_throttle)
+    if args.adaptive_throttle:
+        lower_priority()
+    signal.signal(signal.SIGUSR1, request_profile)
+    update_tier_metrics(chunks=True)
+    summary = load_verify_summary()
+    if summary is not None:
+        update_verify_metrics(summary)
+    if args.metrics_port is not None:
+        start_metrics_server(args.metrics_port)
+    reclaimer = Reclaimer(TRASH_DIR)
+    reclaimer.start()
+    replicator = None
+    if args.s3_endpoint is not None:
+        replicator = Replicator(S3Client(args.s3_endpoint, args.s3_bucket, args.s3_access_key, args.s3_secret_key,
+                                         args.s3_region),
+                                args.s3_prefix, args.upload_concurrency, args.upload_part_size)
 
     while True:
         now = datetime.now()
+        backups = get_backup_list(SHORT_DIR)
+        last_backup = datetime.strptime(backups[-1].name, DATE_TIME_FORMAT) if backups else None
+        due, next_backup = schedule_backup(now, last_backup, args.backup_freq, args.backup_time, args.backup_window)
+        if not due:
+            log.info('Sleeping until the next backup is due at %s', next_backup)
+            time.sleep(max(0.0, (next_backup - datetime.now()).total_seconds()))
+            continue
         timestamp = now.strftime(DATE_TIME_FORMAT)
 
-        # Archive the directory
+        # Archive the directory. Any in progress backup was interrupted when the container was stopped so carry on
+        # with it rather than starting over.
         log.info('Archiving %s', timestamp)
         backup_dir = SHORT_DIR / timestamp
-        backup_dir.mkdir(parents=True)
-        log.info('Backing up files')
-        create_tarfile(backup_dir / 'files.tar.gz', SRC_DIR)
-        log.info('Dumping the database')
-        dump_db(args.db_host, args.db_user, args.db_pass, backup_dir / 'dbdump.sql.gz')
+        resume_partial_backup(backup_dir)
+        metrics.start_run()
+        make_backup(args, backup_dir, excludes)
         log.info('Archive at %s complete', timestamp)
 
-        # Delete the archves that are too old
-        delete_too_old(SHORT_DIR, now, args.short_keep)
+        # Promote the new backup to a long one if one is due and move the backups the retention policy no longer
+        # keeps to the trash, from which they're deleted in the background.
+        plan = plan_retention(scan_tiers(), now, args)
+        if plan['promote'] is not None:
+            log.info('Hard linking %s to longs', SHORT_DIR / plan['promote'])
+            run_phase('hardlink', hardlink_files, SHORT_DIR / plan['promote'], LONG_DIR / plan['promote'])
+        run_phase('prune', reclaim_backups, reclaimer, plan)
 
-        # Archive long-term copy if necessary
-        # If there are no long-term copies
-        if len(os.listdir(LONG_DIR)) == 0:
-            # Make hard links of the files to save disk space
-            long_backup_dir = LONG_DIR / backup_dir.name
-            hardlink_files(backup_dir, long_backup_dir)
-        else:
-            long_backups = get_backup_list(LONG_DIR)
-            # Update long-term archive if newest one is older than long duration
-            if dirname2age(now, long_backups[-1].name) >= args.long_freq:
-                log.info('Hard linking %s to longs', backup_dir)
-                long_backup_dir = LONG_DIR / backup_dir.name
-                hardlink_files(backup_dir, long_backup_dir)
-                delete_too_old(LONG_DIR, now, args.long_keep)
-
-        log.info('Sleeping for %s == %s seconds', args.backup_freq, args.backup_freq.total_seconds())
-        time.sleep(args.backup_freq.total_seconds())
+        if args.repository:
+            # Now that old backups are gone, free the chunks only they were using.
+            run_phase('prune', collect_repository_garbage, ChunkStore(CHUNK_DIR),
+                      get_backup_list(SHORT_DIR) + get_backup_list(LONG_DIR))
+
+        if replicator is not None:
+            # The backups are safe locally so don't stop making them if the bucket can't be reached; anything that
+            # wasn't replicated is retried after the next backup.
+            try:
+                run_phase('replicate', replicate_backups, replicator, args, now)
+            except (S3Error, OSError) as e:
+                log.error('Replicating the backups failed: %s', e)
+
+        record_run()
+
+        if verify_due(time.time(), args.verify_freq):
+            run_phase('verify', verify_all_snapshots)
+        update_report(timestamp, replicator)
+        profile_requested.clear()
 
 if __name__ == '__main__':
     main()
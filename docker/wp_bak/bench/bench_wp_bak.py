@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# Benchmarks the expensive parts of wp_bak.py against synthetic WordPress trees and a stand-in mysqldump. See the
+# README in this directory for how to run it and read the results.
+import argparse
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+from pathlib import Path
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent / 'app'))
+import wp_bak  # noqa: E402
+
+RESULTS_FILE = BENCH_DIR / 'results.jsonl'
+CASES = ['create_tarfile', 'dump_db', 'hardlink_files', 'delete_inline', 'reclaim']
+# The stand-in mysqldump reads how much SQL to write, and how fast, from these environment variables.
+FAKE_DUMP_BYTES_ENV = 'FAKE_MYSQLDUMP_BYTES'
+FAKE_DUMP_RATE_ENV = 'FAKE_MYSQLDUMP_RATE'
+# How many old backups delete_inline and reclaim have to delete.
+NUM_OLD_BACKUPS = 10
+MB = 1024 * 1024
+
+# The synthetic trees roughly follow the WordPress sites we host: most files are small PHP, CSS and JS files from core,
+# themes and plugins, most of the bytes are in uploaded images and the resized thumbnails WordPress makes of each, and
+# a few large video or audio files. Each entry is (share of the total bytes, extensions, min size, max size) and file
+# sizes are drawn log-uniformly between min and max.
+TREE_PROFILE = [
+    (0.15, ['.php', '.css', '.js'], 512, 64 * 1024),
+    (0.55, ['.jpg', '.png', '.webp'], 8 * 1024, 300 * 1024),
+    (0.30, ['.mp4', '.mp3'], 5 * MB, 40 * MB),
+]
+CODE_WORDS = (b'function', b'return', b'$post', b'$wpdb', b'if', b'else', b'array(', b');', b'echo', b'esc_html(',
+              b'get_option(', b"'the_content'", b'add_action(', b'foreach', b'as', b'$key', b'=>', b'null', b'{', b'}')
+SQL_ROW = (b"(%d,1,'2021-04-05 11:00:00','2021-04-05 11:00:00','<p>Lorem ipsum dolor sit amet, consectetur adipiscing "
+           b"elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua.</p>','Post %d','','publish')")
+
+log = logging.getLogger('bench')
+
+
+def code_bytes(rng: random.Random, size: int) -> bytes:
+    """Returns size bytes of PHP-like text, which compresses about as well as real WordPress code."""
+    out = bytearray(b'<?php\n')
+    while len(out) < size:
+        out += b' '.join(rng.choice(CODE_WORDS) for _ in range(rng.randint(3, 12))) + b'\n'
+    return bytes(out[:size])
+
+
+def make_tree(root: Path, total_bytes: int, seed: int = 0) -> Tuple[int, int]:
+    """Writes a synthetic WordPress tree of about total_bytes under root and returns (number of files, bytes).
+
+    The tree only depends on total_bytes and seed so runs are comparable.
+    """
+    rng = random.Random(seed)
+    num_files = 0
+    written = 0
+    for share, extensions, min_size, max_size in TREE_PROFILE:
+        budget = int(total_bytes * share)
+        while budget > 0:
+            size = min(budget, int(min_size * (max_size / min_size) ** rng.random()))
+            ext = rng.choice(extensions)
+            if ext in ('.php', '.css', '.js'):
+                path = root / 'wp-content' / 'plugins' / f'plugin{rng.randrange(40)}' / f'file{num_files}{ext}'
+                data = code_bytes(rng, size)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(data)
+            else:
+                path = root / 'wp-content' / 'uploads' / str(2015 + rng.randrange(7)) / f'{rng.randrange(1, 13):02}'
+                path = path / f'media{num_files}{ext}'
+                path.parent.mkdir(parents=True, exist_ok=True)
+                # Random bytes don't compress, like real media. Write them in pieces to keep our memory use down.
+                with open(path, 'wb') as f:
+                    for offset in range(0, size, MB):
+                        f.write(rng.randbytes(min(MB, size - offset)))
+            num_files += 1
+            written += size
+            budget -= size
+    return num_files, written
+
+
+def fake_mysqldump() -> None:
+    """Stands in for mysqldump: writes FAKE_MYSQLDUMP_BYTES of INSERT statements to stdout, no faster than
+    FAKE_MYSQLDUMP_RATE bytes per second if that's set. Arguments are ignored.
+    """
+    total = int(os.environ[FAKE_DUMP_BYTES_ENV])
+    rate = float(os.environ.get(FAKE_DUMP_RATE_ENV) or 0)
+    out = sys.stdout.buffer
+    out.write(b'-- MariaDB dump 10.19\n/*!40101 SET NAMES utf8mb4 */;\n')
+    start = time.monotonic()
+    written = 0
+    row = 0
+    while written < total:
+        values = []
+        for _ in range(200):
+            row += 1
+            values.append(SQL_ROW % (row, row))
+        line = b'INSERT INTO `wp_posts` VALUES ' + b','.join(values) + b';\n'
+        out.write(line)
+        written += len(line)
+        if rate > 0:
+            ahead = written / rate - (time.monotonic() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+    out.flush()
+
+
+def read_proc_io() -> Dict[str, int]:
+    """Returns this process's I/O counters, including those of children it has waited for."""
+    with open('/proc/self/io') as f:
+        return {k: int(v) for k, v in (line.split(': ') for line in f)}
+
+
+def peak_rss_mb() -> float:
+    """Returns the peak RSS of this process since it started.
+
+    This uses VmHWM rather than getrusage's ru_maxrss as the latter includes the peak of the parent before exec.
+    """
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return round(int(line.split()[1]) / 1024, 1)
+    return 0.0
+
+
+def measure(fn: Callable[[], Any]) -> Dict[str, Any]:
+    """Calls fn and returns how long it took, the CPU time and read and write syscalls used, and the peak RSS of this
+    process and of its children (e.g. mysqldump and the compressor).
+
+    The children's peak RSS comes from getrusage and so is that of the largest child, including the part of our own
+    memory it shared before it exec'd; treat it as an upper bound. Metadata syscalls like stat, link and unlink aren't
+    counted anywhere so compare those cases by time and the number of files.
+    """
+    io_before = read_proc_io()
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.monotonic()
+    fn()
+    seconds = time.monotonic() - start
+    io_after = read_proc_io()
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'seconds': round(seconds, 3),
+        'cpu_seconds': round(self_after.ru_utime + self_after.ru_stime + children_after.ru_utime +
+                             children_after.ru_stime - self_before.ru_utime - self_before.ru_stime -
+                             children_before.ru_utime - children_before.ru_stime, 3),
+        'peak_rss_mb': peak_rss_mb(),
+        # ru_maxrss is in KiB on Linux.
+        'children_peak_rss_mb': round(children_after.ru_maxrss / 1024, 1),
+        'read_syscalls': io_after['syscr'] - io_before['syscr'],
+        'write_syscalls': io_after['syscw'] - io_before['syscw'],
+        'bytes_written': io_after['wchar'] - io_before['wchar'],
+    }
+
+
+def run_case(case: str, work_dir: Path, src: Path, data_bytes: int, dump_rate: float) -> Dict[str, Any]:
+    """Runs one benchmark case in this process and returns its measurements. This is run in a fresh process for each
+    case (see main) so that the peak RSS is that of the case alone.
+    """
+    now = datetime.now()
+    out = work_dir / 'out'
+    out.mkdir()
+    if case == 'create_tarfile':
+        return measure(lambda: wp_bak.create_tarfile(out / 'files.tar.gz', src, 'gzip', None, wp_bak.available_cpus(),
+                                                     None, [], out / wp_bak.CATALOG_NAME))
+    elif case == 'dump_db':
+        fake_bin = work_dir / 'bin'
+        fake_bin.mkdir()
+        mysqldump = fake_bin / 'mysqldump'
+        mysqldump.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{Path(__file__).resolve()}" fake_mysqldump\n')
+        mysqldump.chmod(0o755)
+        os.environ['PATH'] = f'{fake_bin}{os.pathsep}{os.environ["PATH"]}'
+        os.environ[FAKE_DUMP_BYTES_ENV] = str(data_bytes)
+        os.environ[FAKE_DUMP_RATE_ENV] = str(dump_rate)
+        return measure(lambda: wp_bak.dump_db('db', 'user', 'pass', out / 'dbdump.sql.gz'))
+    elif case == 'hardlink_files':
+        return measure(lambda: wp_bak.hardlink_files(src, out / 'linked'))
+    elif case in ('delete_inline', 'reclaim'):
+        wp_bak.SHORT_DIR, wp_bak.LONG_DIR = out / 'shorts', out / 'longs'
+        wp_bak.LONG_DIR.mkdir()
+        for i in range(NUM_OLD_BACKUPS + 1):
+            name = (now - timedelta(days=30 * i)).strftime(wp_bak.DATE_TIME_FORMAT)
+            wp_bak.hardlink_files(src, wp_bak.SHORT_DIR / name)
+        args = argparse.Namespace(short_keep=timedelta(days=7), long_freq=timedelta(days=7),
+                                  long_keep=timedelta(days=28), keep_hourly=0, keep_daily=0, keep_weekly=0,
+                                  keep_monthly=0)
+        if case == 'delete_inline':
+            # The baseline for reclaim: the same plan with the backups deleted before the backup loop carries on.
+            def delete_inline():
+                plan = wp_bak.plan_retention(wp_bak.scan_tiers(), now, args)
+                for tier, dir in (('short', wp_bak.SHORT_DIR), ('long', wp_bak.LONG_DIR)):
+                    for name in plan['delete'][tier]:
+                        shutil.rmtree(dir / name)
+            return measure(delete_inline)
+        # Only the time the backup loop waits for, planning and moving the backups to the trash, is measured; the
+        # deleting is done afterwards by the reclaimer's thread.
+        reclaimer = wp_bak.Reclaimer(out / 'trash')
+        result = measure(lambda: wp_bak.reclaim_backups(
+            reclaimer, wp_bak.plan_retention(wp_bak.scan_tiers(), now, args)))
+        reclaimer.start()
+        reclaimer.wait()
+        return result
+    raise ValueError(f'Unknown case {case}')
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_benchmarks(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    results = []
+    commit = git_commit()
+    for size_mb in args.sizes:
+        with tempfile.TemporaryDirectory(dir=args.work_dir) as tmp:
+            src = Path(tmp) / 'src'
+            log.info('Generating a %s MB tree', size_mb)
+            num_files, data_bytes = make_tree(src, size_mb * MB)
+            for case in args.cases:
+                case_dir = Path(tmp) / case
+                case_dir.mkdir()
+                log.info('Running %s on %s MB', case, size_mb)
+                proc = subprocess.run([sys.executable, __file__, 'run_case', case, str(case_dir), str(src),
+                                       str(data_bytes), str(args.dump_rate)],
+                                      stdout=subprocess.PIPE, check=True, text=True)
+                shutil.rmtree(case_dir)
+                result = {'date': datetime.now().isoformat(timespec='seconds'), 'commit': commit,
+                          'host': platform.node(), 'python': platform.python_version(),
+                          'cpus': wp_bak.available_cpus(), 'case': case, 'size_mb': size_mb,
+                          'files': num_files, 'data_bytes': data_bytes, **json.loads(proc.stdout)}
+                result['mb_per_second'] = round(data_bytes / MB / max(result['seconds'], 1e-6), 1)
+                results.append(result)
+                print_results([result])
+    return results
+
+
+def print_results(results: List[Dict[str, Any]]) -> None:
+    for r in results:
+        print(f"{r['commit']:>9} {r['case']:<15} {r['size_mb']:>6} MB {r['seconds']:>8.2f} s "
+              f"{r['mb_per_second']:>8.1f} MB/s  rss {r['peak_rss_mb']:>6.1f} MB (children "
+              f"{r['children_peak_rss_mb']:>6.1f} MB)  syscalls {r['read_syscalls']:>8} read "
+              f"{r['write_syscalls']:>8} write", flush=True)
+
+
+def compare(results_file: Path) -> None:
+    """Prints, for each case and size, the latest result in results_file and its change from the one before."""
+    by_key: Dict[Tuple[str, int], List[Dict[str, Any]]] = {}
+    with open(results_file) as f:
+        for line in f:
+            r = json.loads(line)
+            by_key.setdefault((r['case'], r['size_mb']), []).append(r)
+    for (case, size_mb), runs in sorted(by_key.items()):
+        latest = runs[-1]
+        print_results([latest])
+        if len(runs) > 1:
+            prev = runs[-2]
+            changes = []
+            for key in ('seconds', 'peak_rss_mb', 'read_syscalls', 'write_syscalls'):
+                if prev[key]:
+                    changes.append(f'{key} {100 * (latest[key] - prev[key]) / prev[key]:+.0f}%')
+            print(f"{'':>9} vs {prev['commit']}: {', '.join(changes)}")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmarks wp_bak.py')
+    parser.add_argument('--sizes', type=lambda s: [int(x) for x in s.split(',')], default=[50, 200],
+                        help='Comma separated sizes, in MB, of the synthetic trees and database dumps to benchmark. '
+                        'Default is "50,200".')
+    parser.add_argument('--cases', type=lambda s: s.split(','), default=CASES,
+                        help=f'Comma separated cases to run. Default is all of them: {",".join(CASES)}.')
+    parser.add_argument('--dump_rate', type=wp_bak.make_byte_rate, default=0,
+                        help='How fast the fake mysqldump writes SQL, e.g. "20M" for 20 MB per second. Default is as '
+                        'fast as it can.')
+    parser.add_argument('--work_dir', default=None,
+                        help='Where to create the synthetic trees. Use a directory on the same kind of disk as /src '
+                        'and /dst. Default is the system temp directory.')
+    parser.add_argument('--results', type=Path, default=RESULTS_FILE,
+                        help='The file to append results to. Default is results.jsonl next to this script.')
+    parser.add_argument('--compare', action='store_true', default=False,
+                        help="Don't run anything, just compare the latest results with the ones before them.")
+    return parser.parse_args()
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'fake_mysqldump':
+        fake_mysqldump()
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'run_case':
+        # Keep stdout for the result.
+        logging.basicConfig(level=logging.WARNING, stream=sys.stderr, force=True)
+        case, work_dir, src, data_bytes, dump_rate = sys.argv[2:]
+        print(json.dumps(run_case(case, Path(work_dir), Path(src), int(data_bytes), float(dump_rate))))
+        return
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr, format='%(asctime)s %(levelname)-8s %(message)s',
+                        force=True)
+    args = parse_args()
+    if args.compare:
+        compare(args.results)
+        return
+    results = run_benchmarks(args)
+    with open(args.results, 'at') as f:
+        for r in results:
+            f.write(json.dumps(r) + '\n')
+    log.info('Appended %s results to %s', len(results), args.results)
+
+
+if __name__ == '__main__':
+    main()
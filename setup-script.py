@@ -1,20 +1,51 @@
+from __future__ import annotations
+
 import argparse
 import base64
+from concurrent.futures import ThreadPoolExecutor
+import difflib
+import functools
+import hashlib
+import json
 import logging
 from pathlib import Path
 import secrets
-import shutil
 import string
 import subprocess
 import sys
-from typing import Dict, List, cast
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, List, Optional, Tuple, cast
+
+import yaml
 
-from kubernetes import kubernetes
-from pybars import Compiler
+# kubernetes (which imports google-auth, requests, urllib3 and more) and pybars (which compiles its grammar when
+# imported) each take the best part of a second to import. So they're imported by the functions that need them: the
+# cluster isn't needed to render the manifests and pybars isn't needed when no template has to be rendered.
+if TYPE_CHECKING:
+    from kubernetes import kubernetes
 
 
 THIS_DIR = Path(__file__).parent
 K8_DIR = THIS_DIR / 'k8s'
+# The manifests are applied with server-side apply under the field manager kubectl uses by default, so the generated
+# files can still be edited and re-applied by hand with `kubectl apply --server-side`. The generated manifests are the
+# source of truth so the apply takes over, with --force-conflicts, any field another manager set: fields set by
+# earlier, client-side, `kubectl apply` runs (manager kubectl-client-side-apply) and by `kubectl edit` are overwritten,
+# as they were by client-side apply.
+FIELD_MANAGER = 'kubectl'
+# How often, in seconds, to check whether the StatefulSets are ready after applying the manifests.
+READY_POLL_INTERVAL = 5
+TEMPLATE_SUFFIX = '.tmpl.yml'
+# Each output directory holds this file recording, for every file written there, a hash of what it was generated from
+# (the template and the template variables), a hash of what was written and a hash of what was last applied. See
+# render_manifests and mark_applied.
+RENDER_CACHE_NAME = '.render-cache.json'
+# The steps of provisioning a site with --sites, in order, as shown in the summary table.
+SITE_STEPS = ['secrets', 'render', 'apply', 'ready']
+
+# The files under K8_DIR as returned by load_templates.
+Templates = List[Tuple[Path, str, Optional[Callable[[Dict[str, str]], str]]]]
 
 log = logging.getLogger(__name__)
 
@@ -31,6 +62,13 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument('--no_secrets', action='store_true', default=False,
                         help='Skip the automatic generation of the database and WordPress secrets. You will have to '
                         'manually create the secrets.')
+    parser.add_argument('-s', '--sites', type=Path, default=None,
+                        help='Provision many sites at once from this YAML file instead of the single site given by '
+                        '--namespace, --title, etc. It holds a `sites` list with the namespace, title, hostname and, '
+                        'optionally, project_name and routing of each site. Each site\'s files are written to '
+                        '--out/<namespace>. A table showing how each site went is printed at the end.')
+    parser.add_argument('-j', '--max_workers', type=int, default=8,
+                        help='With --sites, how many sites to provision at the same time.')
     parser.add_argument('-n', '--namespace', type=str,
                         help='The Kubernetes namespace to which the WordPress site will be deployed.')
     parser.add_argument('-t', '--title', type=str, 
@@ -45,9 +83,22 @@ def parse_args() -> argparse.Namespace:
                         help='By default this script generating a routing.yml file but it does not apply it as only '
                         'MVP Studio admins have permissions to do so. However, if you _are_ an admin you can have the '
                         'script apply that file as well by passing this argument.')
+    parser.add_argument('-f', '--force_apply', action='store_true', default=False,
+                        help='Apply all the manifest files. By default only the files that changed since they were '
+                        'last generated in --out are applied.')
+    parser.add_argument('-w', '--wait_timeout', type=int, default=600,
+                        help='After applying the manifests, wait up to this many seconds for the StatefulSets to be '
+                        'ready and exit with an error if they are not. Pass 0 to not wait.')
 
     parsed = parser.parse_args()
 
+    if parsed.sites is not None:
+        if parsed.max_workers < 1:
+            log.error('--max_workers must be at least 1')
+            parser.print_help()
+            sys.exit(1)
+        return parsed
+
     prompt_if_missing = ['namespace', 'title', 'hostname']
 
     parsed_dict = vars(parsed)
@@ -85,6 +136,7 @@ def gen_and_store_mdb_secrets(k8_client: kubernetes.client.CoreV1Api, namespace:
         k8_client: a configured CoreV1Api k8's client.
         namespace: the namespace in which to create the secrets.
     """
+    from kubernetes import kubernetes
     body = kubernetes.client.V1Secret(
         string_data={
             'user-password': gen_password(),
@@ -112,6 +164,7 @@ def gen_and_store_wp_secrets(k8_client: kubernetes.client.CoreV1Api, namespace:
     Returns:
         The password for the admin user. This can be used to log into the new WordPress instance.
     """
+    from kubernetes import kubernetes
     admin_pass = gen_password()
     body = kubernetes.client.V1Secret(string_data={'admin-password': admin_pass})
     body.metadata = {'name': 'wpsecrets'}
@@ -130,34 +183,115 @@ def gen_and_store_wp_secrets(k8_client: kubernetes.client.CoreV1Api, namespace:
     return admin_pass
 
 
-def apply_k8_running(out_dir: Path) -> None:
-    """Apply all the k8's manifest files under out_dir / running.
+def apply_manifests(groups: List[List[Path]]) -> None:
+    """Server-side apply the k8's manifests in groups. Each group is a list of files or directories, which are searched
+    recursively.
+
+    Each group is applied by a single `kubectl` process, so kubectl start up, reading the kubeconfig and API discovery
+    happen once per group rather than once per file, and the processes all run at the same time. Make one group per
+    namespace: the objects in different namespaces don't depend on each other.
 
     Note that here we shell out to `kubectl` rather than using the kubernetes.ApiClient. That's because if you create
     resources with the API client it doesn't save information about the file from which the resources were created and
     it is then not safe to modify one of the manifests and re-run `kubectl apply` to update the resource; k8's then
-    can't figure out what's changed.
+    can't figure out what's changed. With server-side apply the API server records which fields each manager set so
+    later applies of edited manifests update exactly what changed. Fields last set by another manager are overwritten,
+    see FIELD_MANAGER.
     """
-    to_explore = [out_dir / 'running']
-    while len(to_explore) > 0:
-        cur_dir = to_explore.pop().absolute()
-        log.info('Looking for Kubernetes files to apply in %s', cur_dir)
-        for file_or_dir in cur_dir.iterdir():
-            if file_or_dir.is_dir():
-                to_explore.append(file_or_dir)
-            else:
-                log.info('Applying %s', file_or_dir)
-                subprocess.check_call(['kubectl', 'apply', '-f', str(file_or_dir)])
-
-def generate_manifests(template_vars: Dict[str, str], dest: Path) -> None:
-    """Given template_vars, a dict from template variable name to the value for that variable, recursively find all
-    files under K8_DIR, expand them as handlebars templates if they have a .tmpl.yml extension, and copy them to the
-    same relative location in dest.  Files found under K8_DIR that do not end with .tmpl.yml are copied unchanged to
-    dest.
+    procs = []
+    for paths in groups:
+        cmd = ['kubectl', 'apply', '--server-side', '--force-conflicts', '--field-manager=' + FIELD_MANAGER,
+               '--recursive']
+        for path in paths:
+            log.info('Applying %s', path)
+            cmd += ['-f', str(path.absolute())]
+        procs.append(subprocess.Popen(cmd))
+    for proc in procs:
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+def apply_k8_running(out_dir: Path, routing: bool = False, changed: Optional[List[Path]] = None) -> List[Path]:
+    """Apply all the k8's manifest files under out_dir / running and, if routing is True, out_dir / routing.yml.
+
+    If changed, a list of paths relative to out_dir as returned by render_manifests, is given only those files are
+    applied. Returns the files and directories that were applied, relative to out_dir, for mark_applied; the list is
+    empty if nothing was applied.
+
+    The routing objects live in a different namespace so the two are applied at the same time. See apply_manifests.
+    """
+    if changed is None:
+        groups = [[Path('running')]] + ([[Path('routing.yml')]] if routing else [])
+    else:
+        running = [path for path in changed if path.parts[0] == 'running']
+        groups = [running] if running else []
+        if routing and Path('routing.yml') in changed:
+            groups.append([Path('routing.yml')])
+    if not groups:
+        log.info('None of the manifests in %s changed so there is nothing to apply', out_dir)
+        return []
+    apply_manifests([[out_dir / path for path in group] for group in groups])
+    return [path for group in groups for path in group]
+
+
+def stateful_set_ready(stateful_set: kubernetes.client.V1StatefulSet) -> bool:
+    """Returns True if the controller has seen the latest spec of stateful_set and all its replicas are updated to it
+    and ready. This is the same check as `kubectl rollout status`.
+    """
+    spec, status = stateful_set.spec, stateful_set.status
+    replicas = spec.replicas if spec.replicas is not None else 1
+    if (status.observed_generation or 0) < stateful_set.metadata.generation or (status.ready_replicas or 0) < replicas:
+        return False
+    if spec.update_strategy is not None and spec.update_strategy.type == 'OnDelete':
+        return True
+    return (status.updated_replicas or 0) >= replicas and status.current_revision == status.update_revision
+
+
+def wait_for_stateful_sets(apps_client: kubernetes.client.AppsV1Api, namespace: str, timeout: float) -> None:
+    """Polls the StatefulSets in namespace until they're all ready. Raises TimeoutError if they aren't within timeout
+    seconds.
     """
-    compiler = Compiler()
+    deadline = time.monotonic() + timeout
+    while True:
+        stateful_sets = cast('kubernetes.client.V1StatefulSetList',
+                             apps_client.list_namespaced_stateful_set(namespace=namespace)).items
+        waiting = sorted(s.metadata.name for s in stateful_sets if not stateful_set_ready(s))
+        if len(waiting) == 0:
+            log.info('All %s StatefulSets in %s are ready', len(stateful_sets), namespace)
+            return
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f'StatefulSets {", ".join(waiting)} in {namespace} were not ready after {timeout} '
+                               'seconds')
+        log.info('Waiting for StatefulSets %s to be ready', ', '.join(waiting))
+        time.sleep(READY_POLL_INTERVAL)
+
+# Compiled templates by the sha256 of their source, so that each template is only compiled once however many sites it's
+# expanded for.
+_compiled_templates: Dict[str, Callable[[Dict[str, str]], str]] = {}
+_compile_lock = threading.Lock()
+
+
+def expand_template(source_hash: str, source: str, template_vars: Dict[str, str]) -> str:
+    """Expands the handlebars template source, whose sha256 is source_hash, with template_vars. The template is compiled
+    the first time it's needed and reused after that.
+    """
+    with _compile_lock:
+        if source_hash not in _compiled_templates:
+            from pybars import Compiler
+            _compiled_templates[source_hash] = Compiler().compile(source)
+        template = _compiled_templates[source_hash]
+    return template(template_vars)
+
 
-    TEMPLATE_SUFFIX = '.tmpl.yml'
+def load_templates() -> Templates:
+    """Recursively find all files under K8_DIR and read the ones with a .tmpl.yml extension as handlebars templates.
+
+    Returns a (path, sha256 of the file, template) tuple for each file with the path relative to K8_DIR. The template
+    is a function that expands the template given the template variables, or None for files that aren't templates.
+    Templates are only compiled when they're first expanded. The result can be used to render the manifests for any
+    number of sites.
+    """
+    templates: Templates = []
 
     # As we walk cur_dir we'll find additional subdirectories which we'll push here to be explored in later iterations.
     to_explore: List[Path] = [K8_DIR.absolute()]
@@ -168,25 +302,305 @@ def generate_manifests(template_vars: Dict[str, str], dest: Path) -> None:
             if file_or_dir.is_dir():
                 to_explore.append(file_or_dir)
             else:
-                dest_file = dest / file_or_dir.absolute().relative_to(K8_DIR.absolute())
-                dest_file.parent.mkdir(parents=True, exist_ok=True)
+                rel_path = file_or_dir.absolute().relative_to(K8_DIR.absolute())
+                contents = file_or_dir.read_bytes()
+                source_hash = hashlib.sha256(contents).hexdigest()
+                template = None
                 if str(file_or_dir).endswith(TEMPLATE_SUFFIX):
-                    dest_file = dest_file.parent / (dest_file.name[:-len(TEMPLATE_SUFFIX)] + '.yml')
-                    log.info('Expanding template %s to %s', file_or_dir, dest_file)
-                    with open(file_or_dir, 'rt', encoding='utf-8') as inf:
-                        contents = inf.read()
-                        template = compiler.compile(contents)
-                        out_contents = template(template_vars)
-                        with open(dest_file, 'wt', encoding='utf-8') as outf:
-                            outf.write(out_contents)
-                else:
-                    log.info('Copying %s to %s', file_or_dir, dest_file)
-                    shutil.copy(file_or_dir, dest_file)
+                    template = functools.partial(expand_template, source_hash, contents.decode('utf-8'))
+                templates.append((rel_path, source_hash, template))
+    return templates
+
+
+def read_render_cache(dest: Path) -> Dict[str, Dict[str, str]]:
+    """Returns the RENDER_CACHE_NAME file in dest, or an empty dict if there isn't a readable one."""
+    try:
+        with open(dest / RENDER_CACHE_NAME, 'rt', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_render_cache(dest: Path, cache: Dict[str, Dict[str, str]]) -> None:
+    dest.mkdir(parents=True, exist_ok=True)
+    with open(dest / RENDER_CACHE_NAME, 'wt', encoding='utf-8') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+
+
+def render_manifests(templates: Templates, template_vars: Dict[str, str],
+                     dest: Path) -> List[Tuple[Path, str, int, int]]:
+    """Given templates, as returned by load_templates, and template_vars, a dict from template variable name to the
+    value for that variable, expand the templates and write them to the same relative location in dest. Files that
+    aren't templates are copied unchanged to dest.
+
+    Files are only rendered and written if the template or template_vars changed since they were last written to dest,
+    or the file in dest was changed since. Returns (path relative to dest, change, lines added, lines removed) for each
+    file whose contents differ from what was last applied, according to mark_applied. The change is 'added' or
+    'changed' if the file in dest was added or changed, and 'not applied' if it was already written, e.g. by a dry run,
+    but not applied since. The lines are counted against the file previously in dest.
+    """
+    cache = read_render_cache(dest)
+    vars_hash = hashlib.sha256(json.dumps(template_vars, sort_keys=True).encode('utf-8')).hexdigest()
+
+    changes = []
+    for rel_path, source_hash, template in templates:
+        dest_file = dest / rel_path
+        if template is not None:
+            dest_file = dest_file.parent / (dest_file.name[:-len(TEMPLATE_SUFFIX)] + '.yml')
+            key = hashlib.sha256((source_hash + vars_hash).encode('utf-8')).hexdigest()
+        else:
+            key = source_hash
+        rel_dest = dest_file.relative_to(dest)
+        try:
+            old_contents: Optional[bytes] = dest_file.read_bytes()
+        except OSError:
+            old_contents = None
+        cached = cache.get(rel_dest.as_posix(), {})
+        if old_contents is not None and cached.get('key') == key and \
+                cached.get('output') == hashlib.sha256(old_contents).hexdigest():
+            contents = old_contents
+        elif template is not None:
+            log.info('Expanding template %s to %s', rel_path, dest_file)
+            contents = template(template_vars).encode('utf-8')
+        else:
+            log.info('Copying %s to %s', rel_path, dest_file)
+            contents = (K8_DIR / rel_path).read_bytes()
+        output = hashlib.sha256(contents).hexdigest()
+
+        if contents != old_contents:
+            dest_file.parent.mkdir(parents=True, exist_ok=True)
+            dest_file.write_bytes(contents)
+            old_lines = old_contents.decode('utf-8').splitlines() if old_contents is not None else []
+            diff = list(difflib.unified_diff(old_lines, contents.decode('utf-8').splitlines(), lineterm='', n=0))
+            changes.append((rel_dest, 'added' if old_contents is None else 'changed',
+                            sum(1 for line in diff if line.startswith('+') and not line.startswith('+++')),
+                            sum(1 for line in diff if line.startswith('-') and not line.startswith('---'))))
+        elif cached.get('applied') != output:
+            changes.append((rel_dest, 'not applied', 0, 0))
+        entry = {'key': key, 'output': output}
+        if 'applied' in cached:
+            entry['applied'] = cached['applied']
+        cache[rel_dest.as_posix()] = entry
+
+    write_render_cache(dest, cache)
+    return changes
+
+
+def mark_applied(dest: Path, applied: List[Path]) -> None:
+    """Records that the files in dest that are, or are under, the paths in applied (relative to dest, as returned by
+    apply_k8_running) were applied as render_manifests last wrote them, so the next render_manifests only returns them
+    if they change again. Call it only once they're applied and ready: until then every run returns them again, so a
+    dry run, a failed apply or a timeout waiting for the site to be ready doesn't lose them. Files that weren't applied,
+    e.g. routing.yml without --routing, are returned until they are.
+    """
+    cache = read_render_cache(dest)
+    for rel_path, entry in cache.items():
+        path = Path(rel_path)
+        if any(path == prefix or prefix in path.parents for prefix in applied):
+            entry['applied'] = entry['output']
+    write_render_cache(dest, cache)
+
+
+def print_changes(dest: Path, changes: List[Tuple[Path, str, int, int]]) -> None:
+    """Prints a summary of the changes, as returned by render_manifests, made to the files in dest."""
+    if not changes:
+        print(f'{dest}: no changes')
+    for path, change, added, removed in changes:
+        print(f'{dest / path}: {change} (+{added} -{removed})')
+
+
+def generate_manifests(template_vars: Dict[str, str], dest: Path) -> List[Tuple[Path, str, int, int]]:
+    """Given template_vars, a dict from template variable name to the value for that variable, recursively find all
+    files under K8_DIR, expand them as handlebars templates if they have a .tmpl.yml extension, and copy them to the
+    same relative location in dest.  Files found under K8_DIR that do not end with .tmpl.yml are copied unchanged to
+    dest. Returns the files to apply; see render_manifests.
+    """
+    return render_manifests(load_templates(), template_vars, dest)
+
+
+def load_sites(path: Path, routing: bool) -> List[Dict[str, Any]]:
+    """Reads a --sites file and returns its sites as parse_sites does.
+
+    The file looks like:
+
+        sites:
+          - namespace: mysite
+            title: My Site
+            hostname: mysite.org
+            project_name: mysite   # optional, as for --project_name
+            routing: true          # optional, as for --routing
+    """
+    with open(path, 'rt', encoding='utf-8') as f:
+        spec = yaml.safe_load(f)
+    if not isinstance(spec, dict) or not isinstance(spec.get('sites'), list):
+        raise ValueError('the file must hold a `sites` list')
+    return parse_sites(spec['sites'], routing)
+
+
+def parse_sites(specs: Iterable[Any], routing: bool) -> List[Dict[str, Any]]:
+    """Given the sites from a --sites file, each a dict with a namespace, title, hostname and optionally a project_name
+    and routing, returns a dict for each site with its template variables, as for generate_manifests, under 'vars' and
+    whether to apply its routing.yml under 'routing' (default routing). Raises ValueError if a site is missing
+    something or has a bad value.
+    """
+    sites = []
+    namespaces = set()
+    for i, site in enumerate(specs):
+        if not isinstance(site, dict):
+            raise ValueError(f'site {i + 1} is not a mapping')
+        for key in ('namespace', 'title', 'hostname'):
+            if not site.get(key):
+                raise ValueError(f'site {i + 1} has no {key}')
+        hostname = str(site['hostname'])
+        if hostname.startswith('http') or hostname.find('://') != -1:
+            raise ValueError(f'the hostname of site {i + 1} must not include the http or https prefix')
+        namespace = str(site['namespace'])
+        if namespace in namespaces:
+            raise ValueError(f'there is more than one site in namespace {namespace}')
+        namespaces.add(namespace)
+        sites.append({
+            'vars': {
+                'namespace': namespace,
+                'site-title': str(site['title']),
+                'hostname': hostname,
+                'project-name': str(site.get('project_name') or hostname.replace('.', '-')),
+            },
+            'routing': bool(site.get('routing', routing)),
+        })
+    return sites
+
+
+def render(sites: Iterable[Dict[str, str]], out: Path) -> Dict[str, List[Tuple[Path, str, int, int]]]:
+    """Renders the manifests of sites, each a dict with a namespace, title, hostname and optionally a project_name as in
+    a --sites file, to out / <namespace> without touching the cluster. Returns each site's files that weren't applied
+    yet, as returned by render_manifests, by namespace.
+
+    This is meant to be called from other Python code, e.g. to render many sites in CI, without the cost of starting a
+    new process, or importing kubernetes, per site:
+
+        render = runpy.run_path('setup-script.py')['render']
+        render([{'namespace': 'mysite', 'title': 'My Site', 'hostname': 'mysite.org'}], Path('out'))
+    """
+    templates = load_templates()
+    return {site['vars']['namespace']: render_manifests(templates, site['vars'], out / site['vars']['namespace'])
+            for site in parse_sites(sites, False)}
+
+
+def run_site_step(result: Dict[str, Any], name: str, fn: Callable[..., Any], *args: Any) -> Any:
+    """Calls fn(*args), recording how long it took in result, as returned by render_site, under name and, if it raises
+    an exception, noting that this step failed.
+    """
+    start = time.monotonic()
+    try:
+        return fn(*args)
+    except Exception as e:
+        result['error'] = f'{name}: {e}'
+        raise
+    finally:
+        result['timings'][name] = time.monotonic() - start
+
+
+def render_site(site: Dict[str, Any], templates: Templates, out: Path) -> Dict[str, Any]:
+    """Renders the manifests of one site from load_sites to out / <namespace>.
+
+    Returns a dict with the site's namespace, hostname and output directory, the changes made to its files as returned
+    by render_manifests, how long each of SITE_STEPS took, the total time and the error, if any, that stopped it. Pass
+    it to provision_site to carry on.
+    """
+    namespace = site['vars']['namespace']
+    result: Dict[str, Any] = {'namespace': namespace, 'hostname': site['vars']['hostname'], 'dest': out / namespace,
+                              'routing': site['routing'], 'changes': None, 'admin_password': None, 'timings': {},
+                              'error': None}
+    start = time.monotonic()
+    try:
+        result['changes'] = run_site_step(result, 'render', render_manifests, templates, site['vars'], result['dest'])
+    except Exception:
+        log.exception('Rendering %s failed', namespace)
+    result['total'] = time.monotonic() - start
+    return result
+
+
+def provision_site(result: Dict[str, Any], args: argparse.Namespace, core_client: kubernetes.client.CoreV1Api,
+                   apps_client: kubernetes.client.AppsV1Api) -> None:
+    """Creates the secrets for a site rendered by render_site, applies its manifests that changed (or all of them with
+    --force_apply) and waits for it to be ready, updating result. Only then are its manifests marked as applied. Does
+    nothing if rendering failed.
+    """
+    if result['error'] is not None:
+        return
+    namespace = result['namespace']
+    start = time.monotonic()
+    try:
+        if not args.no_secrets:
+            def create_secrets() -> str:
+                gen_and_store_mdb_secrets(core_client, namespace)
+                return gen_and_store_wp_secrets(core_client, namespace)
+            result['admin_password'] = run_site_step(result, 'secrets', create_secrets)
+        changed = None if args.force_apply else [path for path, _, _, _ in result['changes']]
+        applied = run_site_step(result, 'apply', apply_k8_running, result['dest'], result['routing'], changed)
+        if applied and args.wait_timeout > 0:
+            run_site_step(result, 'ready', wait_for_stateful_sets, apps_client, namespace, args.wait_timeout)
+        mark_applied(result['dest'], applied)
+    except Exception:
+        # One site failing doesn't stop the others.
+        log.exception('Provisioning %s failed', namespace)
+    result['total'] += time.monotonic() - start
+
+
+def print_site_table(results: List[Dict[str, Any]]) -> None:
+    """Prints a table with a row for each result from render_site and provision_site."""
+    rows = [['namespace', 'hostname', 'result'] + SITE_STEPS + ['total']]
+    for result in results:
+        rows.append([result['namespace'], result['hostname'],
+                     'ok' if result['error'] is None else 'FAILED ' + result['error']] +
+                    [f'{result["timings"][step]:.1f}s' if step in result['timings'] else '-' for step in SITE_STEPS] +
+                    [f'{result["total"]:.1f}s'])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+
+def provision_fleet(args: argparse.Namespace) -> int:
+    """Provisions every site in args.sites, args.max_workers at a time, and prints a table of how each went. The
+    templates are compiled, and the kube config loaded, once for all the sites. The manifests of all the sites are
+    rendered, and a summary of what changed printed, before anything is applied. Returns the exit status: 0 if every
+    site succeeded and 1 otherwise.
+    """
+    try:
+        sites = load_sites(args.sites, args.routing)
+    except (OSError, ValueError, yaml.YAMLError) as e:
+        log.error('Unable to read the sites in %s: %s', args.sites, e)
+        return 1
+
+    templates = load_templates()
+    with ThreadPoolExecutor(max_workers=args.max_workers) as pool:
+        results = list(pool.map(lambda site: render_site(site, templates, args.out), sites))
+        for result in results:
+            if result['changes'] is not None:
+                print_changes(result['dest'], result['changes'])
+
+        if not args.dry_run:
+            from kubernetes import kubernetes
+            kubernetes.config.load_kube_config()
+            # The clients share a connection pool and are safe to use from the worker threads.
+            core_client = kubernetes.client.CoreV1Api()
+            apps_client = kubernetes.client.AppsV1Api(core_client.api_client)
+            list(pool.map(lambda result: provision_site(result, args, core_client, apps_client), results))
+
+    print_site_table(results)
+    for result in results:
+        if result['admin_password'] is not None:
+            print(f'Admin password for {result["namespace"]}:', result['admin_password'])
+    return 0 if all(result['error'] is None for result in results) else 1
 
 
 def main() -> None:
     args = parse_args()
+    if args.sites is not None:
+        sys.exit(provision_fleet(args))
+
     if not args.dry_run:
+        from kubernetes import kubernetes
         kubernetes.config.load_kube_config()
         k8_client = kubernetes.client.CoreV1Api()
 
@@ -202,13 +616,15 @@ def main() -> None:
         'hostname': args.hostname,
         'project-name': args.project_name,
     }
-    generate_manifests(template_vars, args.out)
+    changes = generate_manifests(template_vars, args.out)
+    print_changes(args.out, changes)
 
     if not args.dry_run:
-        apply_k8_running(args.out)
-        if args.routing:
-            # See apply_k8_running for why we shell out here.
-            subprocess.check_call(['kubectl', 'apply', '-f', str(args.out / 'routing.yml')])
+        changed = None if args.force_apply else [path for path, _, _, _ in changes]
+        applied = apply_k8_running(args.out, args.routing, changed)
+        if applied and args.wait_timeout > 0:
+            wait_for_stateful_sets(kubernetes.client.AppsV1Api(), args.namespace, args.wait_timeout)
+        mark_applied(args.out, applied)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,111 @@
+from pathlib import Path
+import runpy
+import tempfile
+import unittest
+from unittest import mock
+
+SETUP_SCRIPT = runpy.run_path(str(Path(__file__).parent / 'setup-script.py'))
+apply_k8_running = SETUP_SCRIPT['apply_k8_running']
+mark_applied = SETUP_SCRIPT['mark_applied']
+parse_sites = SETUP_SCRIPT['parse_sites']
+render = SETUP_SCRIPT['render']
+
+
+# Every file render writes.
+EVERYTHING = [Path('running'), Path('maintenance'), Path('routing.yml')]
+
+
+def make_site(i):
+    return {'namespace': f'site{i}', 'title': f'Site {i}', 'hostname': f'site{i}.org'}
+
+
+class TestSetupScript(unittest.TestCase):
+    def test_parse_sites(self):
+        sites = parse_sites([make_site(0), dict(make_site(1), project_name='one', routing=False)], True)
+        self.assertEqual(sites, [
+            {'vars': {'namespace': 'site0', 'site-title': 'Site 0', 'hostname': 'site0.org',
+                      'project-name': 'site0-org'},
+             'routing': True},
+            {'vars': {'namespace': 'site1', 'site-title': 'Site 1', 'hostname': 'site1.org', 'project-name': 'one'},
+             'routing': False},
+        ])
+
+    def test_parse_sites_errors(self):
+        cases = [
+            ([make_site(0), 'site1'], 'site 2 is not a mapping'),
+            ([{'namespace': 'site0', 'title': 'Site 0'}], 'site 1 has no hostname'),
+            ([dict(make_site(0), title='')], 'site 1 has no title'),
+            ([make_site(0), dict(make_site(1), hostname='https://site1.org')],
+             'the hostname of site 2 must not include the http or https prefix'),
+            ([make_site(0), dict(make_site(1), namespace='site0')], 'there is more than one site in namespace site0'),
+        ]
+        for specs, message in cases:
+            with self.subTest(message=message):
+                with self.assertRaises(ValueError) as cm:
+                    parse_sites(specs, False)
+                self.assertEqual(str(cm.exception), message)
+
+    def test_render(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            out = Path(tmp)
+            changes = render([make_site(0), make_site(1)], out)
+            self.assertEqual(sorted(changes), ['site0', 'site1'])
+            for namespace in ('site0', 'site1'):
+                wordpress = out / namespace / 'running' / 'wordpress.yml'
+                self.assertIn((Path('running/wordpress.yml'), 'added'),
+                              [(path, change) for path, change, _, _ in changes[namespace]])
+                self.assertIn(f'namespace: "{namespace}"', wordpress.read_text())
+                self.assertTrue((out / namespace / 'routing.yml').exists())
+
+    def test_render_until_applied(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            out = Path(tmp)
+            added = render([make_site(0)], out)['site0']
+            self.assertTrue(added)
+
+            # As after a dry run or a failed apply: nothing is rewritten but every file is still to be applied.
+            wordpress = out / 'site0' / 'running' / 'wordpress.yml'
+            mtime = wordpress.stat().st_mtime_ns
+            self.assertEqual(render([make_site(0)], out)['site0'],
+                             [(path, 'not applied', 0, 0) for path, _, _, _ in added])
+            self.assertEqual(wordpress.stat().st_mtime_ns, mtime)
+
+            mark_applied(out / 'site0', EVERYTHING)
+            self.assertEqual(render([make_site(0)], out), {'site0': []})
+
+            # A file edited by hand is written, and so applied, again.
+            wordpress.write_text(wordpress.read_text() + '# edited\n')
+            self.assertEqual(render([make_site(0)], out), {'site0': [(Path('running/wordpress.yml'), 'changed', 0, 1)]})
+            mark_applied(out / 'site0', EVERYTHING)
+            changes = render([dict(make_site(0), title='Renamed')], out)['site0']
+            self.assertIn((Path('running/wordpress.yml'), 'changed', 1, 1), changes)
+            self.assertNotIn(Path('running/mariadb.yml'), [path for path, _, _, _ in changes])
+
+    def test_routing_applied_after_a_run_without_it(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            dest = Path(tmp) / 'site0'
+            applied_files = []
+
+            def fake_apply(groups):
+                applied_files.extend(path for group in groups for path in group)
+
+            with mock.patch.dict(apply_k8_running.__globals__, {'apply_manifests': fake_apply}):
+                # A run without --routing only applies running.
+                changes = render([make_site(0)], Path(tmp))['site0']
+                mark_applied(dest, apply_k8_running(dest, False, [path for path, _, _, _ in changes]))
+                self.assertEqual(sorted(applied_files), [dest / 'running' / 'mariadb.yml',
+                                                         dest / 'running' / 'wordpress.yml'])
+
+                # So the next run, with --routing, still has routing.yml to apply.
+                applied_files.clear()
+                changes = render([make_site(0)], Path(tmp))['site0']
+                self.assertEqual(sorted(path for path, _, _, _ in changes),
+                                 [Path('maintenance/phpmyadmin.yml'), Path('routing.yml')])
+                mark_applied(dest, apply_k8_running(dest, True, [path for path, _, _, _ in changes]))
+                self.assertEqual(applied_files, [dest / 'routing.yml'])
+                self.assertEqual(render([make_site(0)], Path(tmp))['site0'],
+                                 [(Path('maintenance/phpmyadmin.yml'), 'not applied', 0, 0)])
+
+
+if __name__ == '__main__':
+    unittest.main()